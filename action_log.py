@@ -0,0 +1,255 @@
+#action_log.py
+# 持久化操作日志：记录先进入内存缓冲区，由后台任务批量写入追加式分段文件，
+# 每批只 fsync 一次，事件循环从不等待磁盘 I/O。
+#
+# 分段文件：actions-<序号>.jsonl，每行一条 JSON 记录，超过大小上限后切换到新分段。
+# 索引文件：actions-<序号>.idx，每 INDEX_EVERY 条记录写入一个 (记录序号, 字节偏移) 条目，
+# 读取时可以通过 mmap 直接跳到指定记录，而不需要把整个分段读入内存。
+import asyncio
+import bisect
+import logging
+import mmap
+import os
+import re
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+from codec import dumps, loads
+from shared_data import registry
+from config import (
+    ACTION_LOG_DIR, ACTION_LOG_SEGMENT_BYTES, ACTION_LOG_BATCH_SIZE,
+    ACTION_LOG_FLUSH_MS, ACTION_LOG_INDEX_EVERY,
+)
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_PATTERN = re.compile(r"^actions-(\d{6})\.jsonl$")
+INDEX_ENTRY = struct.Struct("!QQ")  # 分段内的记录序号, 字节偏移
+
+
+def segment_path(directory, number):
+    return os.path.join(directory, f"actions-{number:06d}.jsonl")
+
+
+def index_path(path):
+    return path[:-len(".jsonl")] + ".idx"
+
+
+def list_segments(directory):
+    """
+    按序号返回目录中的所有分段文件路径。
+    """
+    if not os.path.isdir(directory):
+        return []
+    numbered = []
+    for name in os.listdir(directory):
+        match = SEGMENT_PATTERN.match(name)
+        if match:
+            numbered.append((int(match.group(1)), os.path.join(directory, name)))
+    return [path for _, path in sorted(numbered)]
+
+
+class ActionLogWriter:
+    """
+    后台批量写入器。append 只把记录放入缓冲区；缓冲区达到批量大小或刷新间隔到期时，
+    由单独的写线程把整批记录写入文件并 fsync 一次。
+    """
+
+    def __init__(self, directory, segment_bytes, batch_size, flush_ms, index_every):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.batch_size = batch_size
+        self.flush_interval = flush_ms / 1000
+        self.index_every = max(index_every, 1)
+        self._buffer = []
+        self._wakeup = None
+        self._task = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="action-log")
+        # 以下字段只在写线程中访问
+        self._file = None
+        self._index_file = None
+        self._segment_number = None
+        self._segment_size = 0
+        self._segment_records = 0
+        self.written = 0
+        self.batches = 0
+        self.errors = 0
+
+    def append(self, record):
+        """
+        非阻塞地追加一条记录。
+        """
+        self._buffer.append(record)
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        if len(self._buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if self._buffer:
+                batch, self._buffer = self._buffer, []
+                await loop.run_in_executor(self._executor, self._write_batch, batch)
+
+    async def close(self):
+        """
+        写入剩余记录并关闭文件（服务器关闭时调用）。
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        loop = asyncio.get_running_loop()
+        if self._buffer:
+            batch, self._buffer = self._buffer, []
+            await loop.run_in_executor(self._executor, self._write_batch, batch)
+        await loop.run_in_executor(self._executor, self._close_files)
+
+    # ---- 以下方法在写线程中执行 ----
+
+    def _open_next_segment(self):
+        self._close_files()
+        if self._segment_number is None:
+            os.makedirs(self.directory, exist_ok=True)
+            existing = list_segments(self.directory)
+            # 重启后总是从新分段开始，不在可能不完整的旧分段上继续追加
+            last = SEGMENT_PATTERN.match(os.path.basename(existing[-1])) if existing else None
+            self._segment_number = int(last.group(1)) + 1 if last else 1
+        else:
+            self._segment_number += 1
+        path = segment_path(self.directory, self._segment_number)
+        self._file = open(path, "ab")
+        self._index_file = open(index_path(path), "ab")
+        self._segment_size = 0
+        self._segment_records = 0
+
+    def _close_files(self):
+        for f in (self._file, self._index_file):
+            if f is not None:
+                f.close()
+        self._file = None
+        self._index_file = None
+
+    def _write_batch(self, batch):
+        try:
+            if self._file is None or self._segment_size >= self.segment_bytes:
+                self._open_next_segment()
+            chunks = []
+            index_entries = []
+            offset = self._segment_size
+            for record in batch:
+                line = (dumps(record) + "\n").encode("utf-8")
+                if self._segment_records % self.index_every == 0:
+                    index_entries.append(INDEX_ENTRY.pack(self._segment_records, offset))
+                chunks.append(line)
+                offset += len(line)
+                self._segment_records += 1
+            self._file.write(b"".join(chunks))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            if index_entries:
+                self._index_file.write(b"".join(index_entries))
+                self._index_file.flush()
+            self._segment_size = offset
+            self.written += len(batch)
+            self.batches += 1
+        except Exception as e:
+            self.errors += 1
+            logger.error("Failed to write action log batch (%d records): %s", len(batch), e)
+
+    def stats(self):
+        return {
+            "directory": self.directory,
+            "segment": self._segment_number,
+            "buffered": len(self._buffer),
+            "written": self.written,
+            "batches": self.batches,
+            "errors": self.errors,
+        }
+
+
+class SegmentReader:
+    """
+    通过 mmap 读取单个分段，不会把整个文件读入内存。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._index = []  # [(记录序号, 字节偏移)]
+        idx = index_path(path)
+        if os.path.exists(idx):
+            with open(idx, "rb") as f:
+                data = f.read()
+            usable = len(data) - len(data) % INDEX_ENTRY.size
+            self._index = list(INDEX_ENTRY.iter_unpack(data[:usable]))
+
+    def __iter__(self):
+        return self.records()
+
+    def records(self, start=0):
+        """
+        从分段内第 start 条记录开始逐条返回记录；无法解析的行（例如崩溃时写了一半）会被跳过。
+        """
+        if os.path.getsize(self.path) == 0:
+            return
+        position = bisect.bisect_right(self._index, (start, float("inf"))) - 1
+        record_number, offset = self._index[position] if position >= 0 else (0, 0)
+        with open(self.path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            size = len(mm)
+            while offset < size:
+                end = mm.find(b"\n", offset)
+                if end == -1:
+                    break  # 最后一行不完整
+                if record_number >= start:
+                    try:
+                        yield loads(mm[offset:end])
+                    except ValueError:
+                        pass
+                record_number += 1
+                offset = end + 1
+
+
+def read_log(directory=ACTION_LOG_DIR):
+    """
+    按写入顺序遍历目录中所有分段的记录。
+    """
+    for path in list_segments(directory):
+        yield from SegmentReader(path)
+
+
+# 全局写入器
+action_log = ActionLogWriter(
+    ACTION_LOG_DIR, ACTION_LOG_SEGMENT_BYTES, ACTION_LOG_BATCH_SIZE,
+    ACTION_LOG_FLUSH_MS, ACTION_LOG_INDEX_EVERY,
+)
+
+
+def log_device_change(record, removed):
+    """
+    注册表监听函数：把每次设备状态变化写入操作日志。
+    """
+    entry = {
+        "kind": "device",
+        "ts": time.time(),
+        "device": record.name,
+        "version": record.version,
+        "status": record.status,
+        "brightness": record.brightness,
+        "color": record.color,
+    }
+    if removed:
+        entry["removed"] = True
+    action_log.append(entry)
+
+
+registry.add_listener(log_device_change)
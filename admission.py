@@ -0,0 +1,208 @@
+#admission.py
+# 设备连接准入：网络波动后大量设备同时重连时，限制同时进行的注册握手数量和注册速率（令牌桶），
+# 注册请求按批处理，每批的注册表变更合并为一次推送；手机端命令正在处理时注册工作让路。
+import asyncio
+import contextlib
+import logging
+from config import (
+    ADMISSION_MAX_HANDSHAKES, ADMISSION_RATE, ADMISSION_BURST, ADMISSION_TIMEOUT_MS,
+    REGISTRATION_BATCH_SIZE, REGISTRATION_MAX_DEFER_MS,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class AdmissionRejected(Exception):
+    pass
+
+
+class TokenBucket:
+    """
+    令牌桶：平均每秒 rate 个令牌，最多积累 burst 个。
+    等待者按先后顺序排队，只有队首在等待下一个令牌，避免所有等待者同时被唤醒。
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self._updated = None
+        self._queue = asyncio.Lock()
+
+    def _refill(self, now):
+        if self._updated is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, deadline):
+        """
+        取一个令牌，必要时等待到下一个令牌产生。
+        :param deadline: 事件循环时间上的截止时间
+        :raises AdmissionRejected: 截止时间前拿不到令牌
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            await asyncio.wait_for(self._queue.acquire(), max(deadline - loop.time(), 0))
+        except asyncio.TimeoutError:
+            raise AdmissionRejected("registration rate limit")
+        try:
+            while True:
+                now = loop.time()
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+                if now + wait > deadline:
+                    raise AdmissionRejected("registration rate limit")
+                await asyncio.sleep(wait)
+        finally:
+            self._queue.release()
+
+
+class AdmissionController:
+    """
+    注册握手的准入控制，以及手机端命令的进行中计数（用于让注册工作给命令让路）。
+    """
+
+    def __init__(self, max_handshakes, rate, burst, timeout_ms):
+        self.max_handshakes = max_handshakes
+        self.timeout = timeout_ms / 1000
+        self.bucket = TokenBucket(rate, burst) if rate > 0 else None
+        self._slots = asyncio.Semaphore(max_handshakes)
+        self.commands_in_flight = 0
+        self.in_handshake = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.rate_limited = 0  # rejected 中因注册速率限制被拒绝的次数
+
+    @contextlib.asynccontextmanager
+    async def handshake(self):
+        """
+        在令牌桶和握手并发上限允许时进入；超时抛出 AdmissionRejected。
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout
+        self.waiting += 1
+        try:
+            if self.bucket is not None:
+                await self.bucket.acquire(deadline)
+            await asyncio.wait_for(self._slots.acquire(), max(deadline - loop.time(), 0))
+        except AdmissionRejected:
+            self.rejected += 1
+            self.rate_limited += 1
+            raise
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise AdmissionRejected("too many concurrent registrations")
+        finally:
+            self.waiting -= 1
+        self.admitted += 1
+        self.in_handshake += 1
+        try:
+            yield
+        finally:
+            self.in_handshake -= 1
+            self._slots.release()
+
+    @contextlib.contextmanager
+    def command(self):
+        """
+        标记一条手机端命令正在处理；期间批量注册会推迟（最多 REGISTRATION_MAX_DEFER_MS）。
+        """
+        self.commands_in_flight += 1
+        try:
+            yield
+        finally:
+            self.commands_in_flight -= 1
+
+    def stats(self):
+        return {
+            "max_handshakes": self.max_handshakes,
+            "in_handshake": self.in_handshake,
+            "waiting": self.waiting,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "rate_limited": self.rate_limited,
+            "commands_in_flight": self.commands_in_flight,
+        }
+
+
+class RegistrationBatcher:
+    """
+    收集注册请求并按批处理：一批中的所有注册在同一次事件循环回调中完成，
+    注册表的变更进入同一个推送合并窗口，手机端只收到一次包含所有新设备的增量。
+    """
+
+    def __init__(self, register, controller, batch_size=REGISTRATION_BATCH_SIZE, max_defer_ms=REGISTRATION_MAX_DEFER_MS):
+        """
+        :param register: 同步注册函数 register(*args)，返回值作为注册结果
+        """
+        self.register = register
+        self.controller = controller
+        self.batch_size = max(batch_size, 1)
+        self.max_defer = max_defer_ms / 1000
+        self._pending = []  # [(参数, Future)]
+        self._wakeup = None
+        self._task = None
+        self.batches = 0
+        self.registered = 0
+        self.largest_batch = 0
+        self.deferred = 0
+
+    async def submit(self, *args):
+        """
+        排队注册并等待所在批次处理完成。
+        :return: register 的返回值
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((args, future))
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = loop.create_task(self._run())
+        self._wakeup.set()
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while self._pending:
+                # 手机端命令优先：有命令正在处理时稍后再注册
+                deadline = loop.time() + self.max_defer
+                if self.controller.commands_in_flight:
+                    self.deferred += 1
+                while self.controller.commands_in_flight and loop.time() < deadline:
+                    await asyncio.sleep(0.005)
+
+                batch = self._pending[:self.batch_size]
+                del self._pending[:self.batch_size]
+                for args, future in batch:
+                    if future.done():
+                        continue  # 等待期间连接已断开
+                    try:
+                        future.set_result(self.register(*args))
+                    except Exception as e:
+                        future.set_exception(e)
+                self.batches += 1
+                self.registered += len(batch)
+                self.largest_batch = max(self.largest_batch, len(batch))
+                if len(batch) > 1:
+                    logger.debug("Registered a batch of %d device(s).", len(batch), extra={"rate_key": "registration_batch"})
+                # 让出事件循环，批次之间命令和其他任务可以运行
+                await asyncio.sleep(0)
+
+    def stats(self):
+        return {
+            "pending": len(self._pending),
+            "batches": self.batches,
+            "registered": self.registered,
+            "largest_batch": self.largest_batch,
+            "deferred": self.deferred,
+        }
+
+
+admission = AdmissionController(ADMISSION_MAX_HANDSHAKES, ADMISSION_RATE, ADMISSION_BURST, ADMISSION_TIMEOUT_MS)
@@ -0,0 +1,308 @@
+#analytics.py
+# 实验数据分析：把操作日志加载为列式 NumPy 数组，按 (会话, 任务) 向量化计算指标，并导出为紧凑的列式文件。
+#
+# 指标（每个会话 x 每个任务）：
+#   completion_time  从会话开始（最近一次 session_start）到任务首次完成的秒数，未完成为 NaN
+#   attempts         完成前（含完成那一次）该任务的操作记录条数
+#   errors           未成功的尝试次数
+#   wrong_device     规则 when.device 指定目标设备时，完成前选择/进入其他设备的次数
+#   overshoot        规则 when.brightness 指定目标亮度时，亮度超过目标的最大值（不超过为 0；没有目标或没有相关事件为 NaN）
+#
+# 用法：python analytics.py [--log-dir DIR] [--tasks FILE] [--columns out.npz] [--metrics out.npz] [--json]
+import argparse
+import numpy as np
+from action_log import read_log
+from codec import dumps
+from config import ACTION_LOG_DIR, TASKS_FILE
+from rules import load_rules
+
+CATEGORICAL = ("kind", "session", "task", "status", "event", "device", "value")
+MISSING = 0  # 分类列中缺失值的编码
+
+
+class Categories:
+    """
+    分类列的字符串 <-> 整数编码表，编码 0 表示缺失。
+    """
+
+    def __init__(self, values=None):
+        self.values = [""] if values is None else list(values)
+        self.codes = {value: code for code, value in enumerate(self.values) if code != MISSING}
+
+    def __len__(self):
+        return len(self.values)
+
+    def encode(self, value):
+        if value is None:
+            return MISSING
+        value = str(value)
+        code = self.codes.get(value)
+        if code is None:
+            code = len(self.values)
+            self.codes[value] = code
+            self.values.append(value)
+        return code
+
+    def code(self, value):
+        """
+        查询已有的编码；不存在时返回 -1（不会与任何行匹配）。
+        """
+        return self.codes.get(str(value), -1) if value is not None else MISSING
+
+
+class ActionColumns:
+    """
+    列式存储的操作日志：每个字段一个数组，分类字段保存为整数编码。
+    """
+
+    def __init__(self, columns, categories):
+        self.columns = columns
+        self.categories = categories
+
+    def __len__(self):
+        return len(self.columns["ts"])
+
+    def __getitem__(self, field):
+        return self.columns[field]
+
+    def code(self, field, value):
+        return self.categories[field].code(value)
+
+    @classmethod
+    def from_records(cls, records):
+        """
+        一次遍历把记录解码到各列，之后的计算都在数组上完成。
+        """
+        categories = {field: Categories() for field in CATEGORICAL}
+        encoders = [(field, categories[field].encode) for field in CATEGORICAL]
+        ts = []
+        brightness = []
+        codes = {field: [] for field in CATEGORICAL}
+        for record in records:
+            ts.append(record.get("ts", np.nan))
+            value = record.get("brightness")
+            brightness.append(value if isinstance(value, int) else -1)
+            for field, encode in encoders:
+                codes[field].append(encode(record.get(field)))
+        columns = {
+            "ts": np.asarray(ts, dtype=np.float64),
+            "brightness": np.asarray(brightness, dtype=np.int32),
+        }
+        for field in CATEGORICAL:
+            columns[field] = np.asarray(codes[field], dtype=np.int32)
+        return cls(columns, categories)
+
+    @classmethod
+    def from_log(cls, directory=ACTION_LOG_DIR):
+        return cls.from_records(read_log(directory))
+
+    def save(self, path):
+        """
+        导出为压缩的 .npz 列式文件（分类表保存为 cat_<字段> 字符串数组）。
+        """
+        arrays = dict(self.columns)
+        for field, table in self.categories.items():
+            arrays[f"cat_{field}"] = np.asarray(table.values, dtype=str)
+        np.savez_compressed(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            columns = {name: data[name] for name in data.files if not name.startswith("cat_")}
+            categories = {field: Categories(data[f"cat_{field}"].tolist()) for field in CATEGORICAL}
+        return cls(columns, categories)
+
+
+class Metrics:
+    """
+    计算结果：每个指标是形状为 (会话数, 任务数) 的数组。
+    """
+
+    FIELDS = ("completion_time", "attempts", "errors", "wrong_device", "overshoot")
+
+    def __init__(self, sessions, tasks, values):
+        self.sessions = sessions
+        self.tasks = tasks
+        self.values = values
+
+    def save(self, path):
+        np.savez_compressed(
+            path,
+            sessions=np.asarray(self.sessions, dtype=str),
+            tasks=np.asarray(self.tasks, dtype=str),
+            **self.values,
+        )
+
+    def task_summary(self):
+        completion_time = self.values["completion_time"]
+        completed = ~np.isnan(completion_time)
+        count = max(len(self.sessions), 1)
+        summary = {}
+        for column, task in enumerate(self.tasks):
+            done = completed[:, column]
+            times = completion_time[done, column]
+            overshoot = self.values["overshoot"][:, column]
+            summary[task] = {
+                "completed": int(done.sum()),
+                "completion_rate": float(done.sum() / count),
+                "median_time": float(np.median(times)) if times.size else None,
+                "p90_time": float(np.percentile(times, 90)) if times.size else None,
+                "mean_attempts": float(self.values["attempts"][:, column].mean()) if self.sessions else None,
+                "errors": int(self.values["errors"][:, column].sum()),
+                "wrong_device": int(self.values["wrong_device"][:, column].sum()),
+                "max_overshoot": None if np.isnan(overshoot).all() else int(np.nanmax(overshoot)),
+            }
+        return summary
+
+    def session_summary(self):
+        completion_time = self.values["completion_time"]
+        completed = (~np.isnan(completion_time)).sum(axis=1)
+        has_time = completed > 0
+        total_time = np.full(len(self.sessions), np.nan)
+        total_time[has_time] = np.nanmax(completion_time[has_time], axis=1)
+        errors = self.values["errors"].sum(axis=1)
+        wrong_device = self.values["wrong_device"].sum(axis=1)
+        overshoot = self.values["overshoot"]
+        has_overshoot = ~np.isnan(overshoot).all(axis=1)
+        max_overshoot = np.full(len(self.sessions), np.nan)
+        max_overshoot[has_overshoot] = np.nanmax(overshoot[has_overshoot], axis=1)
+        return {
+            session: {
+                "completed": int(completed[row]),
+                "total_time": None if np.isnan(total_time[row]) else float(total_time[row]),
+                "errors": int(errors[row]),
+                "wrong_device": int(wrong_device[row]),
+                "overshoot": None if np.isnan(max_overshoot[row]) else int(max_overshoot[row]),
+            }
+            for row, session in enumerate(self.sessions)
+        }
+
+    def as_dict(self):
+        return {"tasks": self.task_summary(), "sessions": self.session_summary()}
+
+
+def _targets(rule_engine):
+    """
+    从规则中提取每个任务的目标：(触发事件, 目标设备, 亮度设备, 目标亮度)。
+    """
+    targets = {}
+    for rule in rule_engine.rules:
+        events, device, brightness_device, brightness = targets.get(rule.task_name, ((), None, None, None))
+        events = events + rule.events
+        if isinstance(rule.when.get("device"), str):
+            device = rule.when["device"]
+        if isinstance(rule.when.get("brightness"), int):
+            brightness_device = rule.device
+            brightness = rule.when["brightness"]
+        targets[rule.task_name] = (events, device, brightness_device, brightness)
+    return targets
+
+
+def compute_metrics(columns, rule_engine):
+    """
+    向量化计算所有会话、所有任务的指标；循环只发生在任务（规则文件中的少量条目）上。
+    """
+    kind = columns["kind"]
+    session = columns["session"]
+    ts = columns["ts"]
+    n = len(columns.categories["session"])
+
+    # 会话起点：最近一次 session_start；没有开始记录的会话使用其第一条记录的时间
+    origin = np.full(n, np.nan)
+    starts = kind == columns.code("kind", "session_start")
+    np.fmax.at(origin, session[starts], ts[starts])
+    first_seen = np.full(n, np.nan)
+    np.fmin.at(first_seen, session, ts)
+    origin = np.where(np.isnan(origin), first_seen, origin)
+    after_origin = ts >= origin[session]
+
+    is_action = (kind == columns.code("kind", "action")) & after_origin
+    is_task = (kind == columns.code("kind", "task")) & after_origin
+    is_event = (kind == columns.code("kind", "event")) & after_origin
+    completed_status = columns["status"] == columns.code("status", "completed")
+
+    tasks = [task["name"] for task in rule_engine.tasks]
+    targets = _targets(rule_engine)
+    values = {
+        "completion_time": np.full((n, len(tasks)), np.nan),
+        "attempts": np.zeros((n, len(tasks)), dtype=np.int32),
+        "errors": np.zeros((n, len(tasks)), dtype=np.int32),
+        "wrong_device": np.zeros((n, len(tasks)), dtype=np.int32),
+        "overshoot": np.full((n, len(tasks)), np.nan),
+    }
+
+    for column, task in enumerate(tasks):
+        task_rows = columns["task"] == columns.code("task", task)
+        done = np.full(n, np.nan)
+        completions = is_task & task_rows & completed_status
+        np.fmin.at(done, session[completions], ts[completions])
+        completed = ~np.isnan(done)
+        values["completion_time"][:, column] = done - origin
+
+        # 完成之前（含完成的那一次）的记录；未完成的会话统计全部记录
+        before_done = ~(ts > done[session])
+        attempts = np.bincount(session[is_action & task_rows & before_done], minlength=n)
+        values["attempts"][:, column] = attempts
+        values["errors"][:, column] = np.maximum(attempts - completed, 0)
+
+        events, device, brightness_device, brightness = targets.get(task, ((), None, None, None))
+        event_rows = is_event & np.isin(columns["event"], [columns.code("event", e) for e in events])
+        if device is not None:
+            wrong = event_rows & before_done & (columns["device"] != columns.code("device", device))
+            values["wrong_device"][:, column] = np.bincount(session[wrong], minlength=n)
+        if brightness is not None:
+            rows = event_rows & (columns["brightness"] >= 0)
+            if brightness_device is not None:
+                rows &= columns["device"] == columns.code("device", brightness_device)
+            # 没有相关事件的会话保持 NaN（未尝试），不能记为没有超出
+            overshoot = np.full(n, np.nan)
+            np.fmax.at(overshoot, session[rows], np.maximum(columns["brightness"][rows] - brightness, 0))
+            values["overshoot"][:, column] = overshoot
+
+    # 去掉编码 0（缺失会话）和日志中没有任何会话记录的编码
+    present = np.bincount(session, minlength=n) > 0
+    present[MISSING] = False
+    rows = np.flatnonzero(present)
+    sessions = [columns.categories["session"].values[row] for row in rows]
+    return Metrics(sessions, tasks, {field: array[rows] for field, array in values.items()})
+
+
+def analyze(directory=ACTION_LOG_DIR, tasks_file=TASKS_FILE):
+    """
+    读取操作日志并返回可 JSON 序列化的指标汇总。
+    """
+    return compute_metrics(ActionColumns.from_log(directory), load_rules(tasks_file)).as_dict()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compute task metrics from the action log.")
+    parser.add_argument("--log-dir", default=ACTION_LOG_DIR, help="action log directory")
+    parser.add_argument("--input", help="load a previously exported columns .npz instead of the log")
+    parser.add_argument("--tasks", default=TASKS_FILE, help="task rule file")
+    parser.add_argument("--columns", help="export the raw log as a columnar .npz file")
+    parser.add_argument("--metrics", help="export the metric matrices as a .npz file")
+    parser.add_argument("--json", action="store_true", help="print the full summary as JSON")
+    args = parser.parse_args(argv)
+
+    columns = ActionColumns.load(args.input) if args.input else ActionColumns.from_log(args.log_dir)
+    metrics = compute_metrics(columns, load_rules(args.tasks))
+    if args.columns:
+        columns.save(args.columns)
+    if args.metrics:
+        metrics.save(args.metrics)
+
+    if args.json:
+        print(dumps(metrics.as_dict()))
+        return
+    print(f"{len(columns)} records, {len(metrics.sessions)} sessions")
+    print(f"{'task':<20}{'done':>6}{'rate':>7}{'median s':>10}{'attempts':>10}{'errors':>8}{'wrong':>7}{'over':>6}")
+    for task, row in metrics.task_summary().items():
+        median = "-" if row["median_time"] is None else f"{row['median_time']:.1f}"
+        attempts = "-" if row["mean_attempts"] is None else f"{row['mean_attempts']:.2f}"
+        overshoot = "-" if row["max_overshoot"] is None else row["max_overshoot"]
+        print(f"{task:<20}{row['completed']:>6}{row['completion_rate']:>7.0%}{median:>10}"
+              f"{attempts:>10}{row['errors']:>8}{row['wrong_device']:>7}{overshoot:>6}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,509 @@
+#benchmark.py
+# 模拟设备群的负载生成器和基准测试。
+#
+# 模拟 N 个设备（DEVICE_NAME: / PING / STATUS: 文本协议）、M 个手机端（/ws + /command）和
+# K 个头显（头显端口 /ws），按指定的工作负载运行一段时间，报告吞吐量、端到端延迟（p50 / p99）
+# 和每个连接的内存占用，并把结果保存为 JSON，便于比较不同版本。
+#
+# 运行方式（--mode）：
+#   spawn      默认。在本机另起一个 main.py 子进程（使用空闲端口），内存为服务器进程的 RSS；
+#              加 --workers N 时以多进程模式运行（内存只统计主进程）
+#   inprocess  在本进程的事件循环中启动服务器（负载生成器与服务器共享 CPU，内存包含客户端）
+#   external   连接 --host 上已运行的服务器，不报告内存
+#
+# 工作负载（--workload）：
+#   slider     每个手机端以 --rate 次/秒向随机设备发送命令（模拟拖动滑块），可加 --coalesce
+#   reconnect  设备反复断开并重新连接（模拟网络抖动后的重连风暴）
+#   idle       所有连接保持空闲，只有心跳；用于测量每个连接的内存
+#
+# 例：python benchmark.py --devices 200 --phones 20 --headsets 20 --workload slider --duration 30
+#     python benchmark.py --workload idle --devices 2000 --compare bench_results/<旧结果>.json
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import aiohttp
+import websockets
+
+# 不从 config 导入：inprocess 模式需要在服务器模块读取配置之前设置环境变量
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULTS_DIR = os.path.join(BASE_DIR, "bench_results")
+COLORS = ("Red", "Green", "Blue")
+CONNECT_CONCURRENCY = 100  # 同时进行的连接握手数量
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def process_rss(pid):
+    """
+    返回进程的常驻内存（字节）；无法读取时返回 None。
+    """
+    try:
+        with open(f"/proc/{pid}/status", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def percentiles(samples):
+    if not samples:
+        return {"count": 0, "p50_ms": None, "p99_ms": None, "max_ms": None}
+    ordered = sorted(samples)
+
+    def pick(q):
+        return round(ordered[min(int(q * len(ordered)), len(ordered) - 1)] * 1000, 2)
+
+    return {"count": len(ordered), "p50_ms": pick(0.50), "p99_ms": pick(0.99), "max_ms": round(ordered[-1] * 1000, 2)}
+
+
+class Target:
+    """
+    被测服务器的地址，以及（本机时）用于读取内存的进程号。
+    """
+
+    def __init__(self, host, device_port, http_port, headset_port, pid=None):
+        self.host = host
+        self.device_uri = f"ws://{host}:{device_port}"
+        self.http_url = f"http://{host}:{http_port}"
+        self.headset_url = f"http://{host}:{headset_port}"
+        self.pid = pid
+
+    def rss(self):
+        return process_rss(self.pid) if self.pid is not None else None
+
+
+class Bench:
+    """
+    记录时间点并计算延迟：命令发出 -> 设备收到 -> 手机端看到新状态。
+    """
+
+    def __init__(self):
+        self.pending_device = {}  # (设备, 亮度, 颜色) -> 发出时间
+        self.pending_phone = {}
+        self.pending_visible = {}  # 设备 -> 开始连接的时间
+        self.http = []
+        self.device_delivery = []
+        self.phone_update = []
+        self.device_visible = []
+        self.counters = {
+            "commands_sent": 0, "commands_ok": 0, "commands_failed": 0,
+            "device_commands": 0, "pings": 0, "reconnects": 0, "connect_errors": 0,
+            "phone_messages": 0, "phone_bytes": 0, "headset_messages": 0, "headset_bytes": 0,
+        }
+
+    def count(self, name, amount=1):
+        self.counters[name] += amount
+
+    def command_sent(self, device, brightness, color, started):
+        key = (device, brightness, color.lower())
+        self.pending_device[key] = started
+        self.pending_phone[key] = started
+
+    def device_received(self, device, brightness, color):
+        started = self.pending_device.pop((device, brightness, color.lower()), None)
+        if started is not None:
+            self.device_delivery.append(time.perf_counter() - started)
+
+    def phone_received(self, update):
+        name = update.get("device_name")
+        now = time.perf_counter()
+        started = self.pending_visible.pop(name, None)
+        if started is not None and not update.get("removed"):
+            self.device_visible.append(now - started)
+        started = self.pending_phone.pop((name, update.get("brightness"), str(update.get("color")).lower()), None)
+        if started is not None:
+            self.phone_update.append(now - started)
+
+
+async def run_device(target, bench, name, stop, connect_limit, lifetime=None):
+    """
+    模拟一个文本协议设备：注册、回复 PING、执行命令并回复 STATUS。
+    :param lifetime: 连接保持的秒数范围 (最短, 最长)；设置后到期断开并重连
+    """
+    while not stop.is_set():
+        try:
+            async with connect_limit:
+                bench.pending_visible[name] = time.perf_counter()
+                ws = await websockets.connect(target.device_uri, max_size=None)
+                await ws.send(f"DEVICE_NAME:{name}")
+        except (OSError, websockets.exceptions.WebSocketException):
+            bench.count("connect_errors")
+            await asyncio.sleep(0.5)
+            continue
+
+        deadline = None if lifetime is None else time.monotonic() + random.uniform(*lifetime)
+        try:
+            while not stop.is_set():
+                timeout = 0.5 if deadline is None else max(min(deadline - time.monotonic(), 0.5), 0)
+                if deadline is not None and timeout == 0:
+                    break
+                try:
+                    message = await asyncio.wait_for(ws.recv(), timeout)
+                except asyncio.TimeoutError:
+                    continue
+                if message == "PING":
+                    bench.count("pings")
+                    await ws.send("PONG")
+                    continue
+                parts = message.split() if isinstance(message, str) else []
+                if len(parts) == 2 and parts[1].isdigit():
+                    color, brightness = parts[0], int(parts[1])
+                    bench.count("device_commands")
+                    bench.device_received(name, brightness, color)
+                    await ws.send(f"STATUS:brightness={brightness},color={color}")
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            await ws.close()
+        if lifetime is None:
+            return
+        bench.count("reconnects")
+
+
+async def read_phone(ws, bench):
+    async for msg in ws:
+        if msg.type != aiohttp.WSMsgType.TEXT:
+            continue
+        bench.count("phone_messages")
+        bench.count("phone_bytes", len(msg.data))
+        message = json.loads(msg.data)
+        for update in message.get("data") or ():
+            bench.phone_received(update)
+
+
+async def read_headset(ws, bench):
+    async for msg in ws:
+        if msg.type == aiohttp.WSMsgType.TEXT:
+            bench.count("headset_messages")
+            bench.count("headset_bytes", len(msg.data))
+
+
+async def drive_slider(target, http, bench, session_id, devices, rate, coalesce, stop):
+    """
+    以固定速率向随机设备发送 "<颜色> <亮度>" 命令；随机的颜色和亮度用于区分每条命令的到达时间。
+    """
+    interval = 1 / rate
+    next_at = time.perf_counter()
+    while not stop.is_set():
+        device = random.choice(devices)
+        brightness = random.randint(1, 1000)
+        color = random.choice(COLORS)
+        started = time.perf_counter()
+        bench.command_sent(device, brightness, color, started)
+        bench.count("commands_sent")
+        body = {"device": device, "command": f"{color} {brightness}", "session": session_id, "coalesce": coalesce}
+        try:
+            async with http.post(f"{target.http_url}/command", json=body) as response:
+                await response.read()
+                bench.count("commands_ok" if response.status == 200 else "commands_failed")
+        except aiohttp.ClientError:
+            bench.count("commands_failed")
+        bench.http.append(time.perf_counter() - started)
+        next_at += interval
+        delay = next_at - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        else:
+            next_at = time.perf_counter()  # 落后时不补发，避免突发
+
+
+async def scrape_metrics(http, target):
+    """
+    读取服务器 /metrics 中的事件循环延迟和命令往返时间平均值。
+    """
+    try:
+        async with http.get(f"{target.http_url}/metrics") as response:
+            text = await response.text()
+    except aiohttp.ClientError:
+        return {}
+    values = {}
+    for line in text.splitlines():
+        if line.startswith("#") or " " not in line:
+            continue
+        name, value = line.rsplit(" ", 1)
+        values[name] = float(value)
+
+    def mean(metric):
+        count = sum(v for k, v in values.items() if k.startswith(f"{metric}_count"))
+        total = sum(v for k, v in values.items() if k.startswith(f"{metric}_sum"))
+        return round(total / count * 1000, 3) if count else None
+
+    return {
+        "loop_lag_mean_ms": mean("ar_event_loop_lag_seconds"),
+        "command_rtt_mean_ms": mean("ar_command_rtt_seconds"),
+        "fanout_mean_ms": mean("ar_broadcast_fanout_seconds"),
+        "lock_wait_mean_ms": mean("ar_session_lock_wait_seconds"),
+    }
+
+
+async def run_workload(target, args):
+    bench = Bench()
+    stop = asyncio.Event()
+    connect_limit = asyncio.Semaphore(CONNECT_CONCURRENCY)
+    devices = [f"bench-{i:05d}" for i in range(args.devices)]
+    sessions = [f"bench-{i}" for i in range(max(args.phones, 1))]
+    tasks = []
+
+    rss_before = target.rss()
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as http:
+        lifetime = (0.2, 1.0) if args.workload == "reconnect" else None
+        for name in devices:
+            tasks.append(asyncio.create_task(run_device(target, bench, name, stop, connect_limit, lifetime)))
+
+        async def connect(url):
+            async with connect_limit:
+                return await http.ws_connect(url, max_msg_size=0)
+
+        # 会话只能通过 POST /sessions 创建
+        for session_id in sessions:
+            async with http.post(f"{target.http_url}/sessions", json={"session": session_id}) as resp:
+                resp.raise_for_status()
+
+        phones = await asyncio.gather(*(connect(f"{target.http_url}/ws?session={s}") for s in sessions[:args.phones]))
+        headsets = await asyncio.gather(*(
+            connect(f"{target.headset_url}/ws?session={sessions[i % len(sessions)]}") for i in range(args.headsets)
+        ))
+        tasks += [asyncio.create_task(read_phone(ws, bench)) for ws in phones]
+        tasks += [asyncio.create_task(read_headset(ws, bench)) for ws in headsets]
+
+        # 等待设备全部注册（重连风暴中不需要）
+        settle = time.monotonic() + 30
+        while args.workload != "reconnect" and bench.pending_visible and time.monotonic() < settle:
+            await asyncio.sleep(0.1)
+        rss_connected = target.rss()
+        connections = args.devices + args.phones + args.headsets
+
+        if args.workload == "slider" and args.phones and devices:
+            for session_id in sessions[:args.phones]:
+                tasks.append(asyncio.create_task(
+                    drive_slider(target, http, bench, session_id, devices, args.rate, args.coalesce, stop)))
+
+        started = time.perf_counter()
+        await asyncio.sleep(args.duration)
+        elapsed = time.perf_counter() - started
+        stop.set()
+        server_metrics = await scrape_metrics(http, target)
+        rss_after = target.rss()
+
+        for ws in phones + headsets:
+            await ws.close()
+        await asyncio.wait(tasks, timeout=5)
+        for task in tasks:
+            task.cancel()
+
+    memory = None
+    if rss_before is not None and rss_connected is not None:
+        memory = {
+            "rss_before_mb": round(rss_before / 2**20, 2),
+            "rss_connected_mb": round(rss_connected / 2**20, 2),
+            "rss_after_mb": round(rss_after / 2**20, 2) if rss_after else None,
+            "bytes_per_connection": round((rss_connected - rss_before) / connections) if connections else None,
+        }
+    counters = bench.counters
+    return {
+        "throughput": {
+            "commands_per_s": round(counters["commands_ok"] / elapsed, 1),
+            "device_commands_per_s": round(counters["device_commands"] / elapsed, 1),
+            "phone_messages_per_s": round(counters["phone_messages"] / elapsed, 1),
+            "headset_messages_per_s": round(counters["headset_messages"] / elapsed, 1),
+            "reconnects_per_s": round(counters["reconnects"] / elapsed, 1),
+        },
+        "latency": {
+            "command_http": percentiles(bench.http),
+            "device_delivery": percentiles(bench.device_delivery),
+            "phone_update": percentiles(bench.phone_update),
+            "device_visible": percentiles(bench.device_visible),
+        },
+        "memory": memory,
+        "server": server_metrics,
+        "counters": counters,
+        "elapsed_s": round(elapsed, 2),
+    }
+
+
+async def wait_for_server(target, timeout=15):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as http:
+        while time.monotonic() < deadline:
+            try:
+                async with http.get(f"{target.http_url}/metrics") as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"Server at {target.http_url} did not start within {timeout} s.")
+
+
+def isolated_state_env():
+    """
+    返回让服务器把操作日志和快照写入临时目录的环境变量，基准测试不读写正式的数据文件。
+    """
+    return {
+        "AR_ACTION_LOG_DIR": tempfile.mkdtemp(prefix="ar-bench-log-"),
+        "AR_SNAPSHOT_FILE": os.path.join(tempfile.mkdtemp(prefix="ar-bench-state-"), "state_snapshot.json"),
+    }
+
+
+async def start_in_process(ports):
+    """
+    在当前事件循环中启动三个服务器，返回清理函数。
+    """
+    # 配置在导入时读取，必须在导入服务器模块之前设置
+    os.environ.update(isolated_state_env())
+    from aiohttp import web
+    from device_websocket import start_websocket_server
+    from phone_server import start_http_server
+    from headset_server import start_headset_server
+    from tasktracker import start_experiment
+
+    device_server = await start_websocket_server("127.0.0.1", ports[0])
+    runners = []
+    for app, port in ((start_http_server(), ports[1]), (start_headset_server(), ports[2])):
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        runners.append(runner)
+    start_experiment()
+
+    async def cleanup():
+        for runner in runners:
+            await runner.cleanup()
+        device_server.close()
+        await device_server.wait_closed()
+
+    return cleanup
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BASE_DIR, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_result(result, directory):
+    os.makedirs(directory, exist_ok=True)
+    name = f"{time.strftime('%Y%m%d-%H%M%S')}-{result['params']['workload']}.json"
+    path = os.path.join(directory, name)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=2)
+    return path
+
+
+def compare(result, baseline_path):
+    """
+    打印与旧结果相比的变化（延迟和内存越低越好，吞吐量越高越好）。
+    """
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    print(f"\nCompared with {baseline_path} (revision {baseline.get('revision')}):")
+    rows = []
+    for section in ("throughput", "server"):
+        for key, value in (result.get(section) or {}).items():
+            rows.append((f"{section}.{key}", (baseline.get(section) or {}).get(key), value))
+    for name, stats in result["latency"].items():
+        for key in ("p50_ms", "p99_ms"):
+            rows.append((f"latency.{name}.{key}", baseline["latency"].get(name, {}).get(key), stats[key]))
+    if result.get("memory") and baseline.get("memory"):
+        rows.append(("memory.bytes_per_connection",
+                     baseline["memory"]["bytes_per_connection"], result["memory"]["bytes_per_connection"]))
+    for name, old, new in rows:
+        if old is None or new is None:
+            continue
+        change = f"{(new - old) / old:+.1%}" if old else "n/a"
+        print(f"  {name:<40}{old:>12}{new:>12}{change:>10}")
+
+
+def print_result(result):
+    params = result["params"]
+    print(f"workload={params['workload']} devices={params['devices']} phones={params['phones']} "
+          f"headsets={params['headsets']} duration={result['elapsed_s']}s mode={params['mode']}")
+    print("throughput:", ", ".join(f"{k}={v}" for k, v in result["throughput"].items()))
+    for name, stats in result["latency"].items():
+        if stats["count"]:
+            print(f"latency {name:<16} n={stats['count']:<7} p50={stats['p50_ms']} ms  p99={stats['p99_ms']} ms  max={stats['max_ms']} ms")
+    if result["memory"]:
+        print("memory:", ", ".join(f"{k}={v}" for k, v in result["memory"].items()))
+    if result["server"]:
+        print("server:", ", ".join(f"{k}={v}" for k, v in result["server"].items()))
+
+
+async def benchmark(args):
+    process = None
+    cleanup = None
+    if args.mode == "external":
+        target = Target(args.host, args.device_port, args.http_port, args.headset_port)
+    else:
+        ports = (free_port(), free_port(), free_port())
+        if args.mode == "spawn":
+            env = dict(os.environ, AR_DEVICE_PORT=str(ports[0]), AR_HTTP_PORT=str(ports[1]),
+                       AR_HEADSET_PORT=str(ports[2]), AR_LOG_LEVEL=args.server_log_level,
+                       AR_WORKERS=str(args.workers), **isolated_state_env())
+            process = subprocess.Popen([sys.executable, os.path.join(BASE_DIR, "main.py")], env=env)
+            target = Target("127.0.0.1", *ports, pid=process.pid)
+        else:
+            cleanup = await start_in_process(ports)
+            target = Target("127.0.0.1", *ports, pid=os.getpid())
+    try:
+        await wait_for_server(target)
+        return await run_workload(target, args)
+    finally:
+        if cleanup is not None:
+            await cleanup()
+        if process is not None:
+            process.terminate()
+            try:
+                await asyncio.to_thread(process.wait, 10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                await asyncio.to_thread(process.wait)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load generator and benchmark for the AR experiment server.")
+    parser.add_argument("--workload", choices=("slider", "reconnect", "idle"), default="slider")
+    parser.add_argument("--devices", type=int, default=50)
+    parser.add_argument("--phones", type=int, default=5)
+    parser.add_argument("--headsets", type=int, default=5)
+    parser.add_argument("--duration", type=float, default=10, help="seconds to run the workload")
+    parser.add_argument("--rate", type=float, default=20, help="commands per second per phone (slider)")
+    parser.add_argument("--coalesce", action="store_true", help="send slider commands in latest-wins mode")
+    parser.add_argument("--mode", choices=("spawn", "inprocess", "external"), default="spawn")
+    parser.add_argument("--workers", type=int, default=0, help="phone worker processes of the spawned server")
+    parser.add_argument("--host", default="127.0.0.1", help="server host (external mode)")
+    parser.add_argument("--device-port", type=int, default=8765)
+    parser.add_argument("--http-port", type=int, default=8080)
+    parser.add_argument("--headset-port", type=int, default=8766)
+    parser.add_argument("--server-log-level", default="WARNING", help="log level of the spawned server")
+    parser.add_argument("--output", default=RESULTS_DIR, help="directory for result files")
+    parser.add_argument("--no-save", action="store_true", help="do not write a result file")
+    parser.add_argument("--compare", help="previous result file to compare against")
+    args = parser.parse_args(argv)
+
+    result = asyncio.run(benchmark(args))
+    result = {"revision": git_revision(), "time": time.time(), "params": vars(args), **result}
+    print_result(result)
+    if not args.no_save:
+        print(f"saved: {save_result(result, args.output)}")
+    if args.compare:
+        compare(result, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+#broadcaster.py
+# 面向手机端和头显的广播器：每个客户端拥有独立的有界发送队列和写任务，
+# 慢客户端只会阻塞自己的队列，不会拖慢其他客户端或调用方。
+# 每条消息对每种编码只编码一次，使用相同编码的客户端共享同一个帧
+import asyncio
+import logging
+from codec import ENCODER, JSON, encode_frame
+from logging_setup import payloads_enabled
+
+logger = logging.getLogger(__name__)
+
+DROP_OLDEST = "drop_oldest"  # 丢弃最旧的消息
+COALESCE = "coalesce"  # 清空队列，只保留最新的快照
+DISCONNECT = "disconnect"  # 断开跟不上的客户端
+POLICIES = (DROP_OLDEST, COALESCE, DISCONNECT)
+
+
+class ClientChannel:
+    """
+    单个客户端的发送队列，由专用的写任务按顺序发送。
+    """
+
+    def __init__(self, broadcaster, ws, maxsize, policy, remote=None, encoding=JSON):
+        self.broadcaster = broadcaster
+        self.ws = ws
+        self.remote = remote
+        self.policy = policy
+        self.encoding = encoding
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.sent = 0
+        self.bytes_sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.writer = asyncio.create_task(self._drain())
+
+    def offer(self, frame):
+        """
+        非阻塞地放入一个已编码的帧，队列已满时按策略处理。
+        :return: 客户端是否仍然保留
+        """
+        if not self.queue.full():
+            self.queue.put_nowait(frame)
+            return True
+
+        if self.policy == DISCONNECT:
+            logger.warning("%s client send queue full. Disconnecting.", self.broadcaster.name)
+            self.broadcaster.discard(self.ws)
+            asyncio.create_task(self.ws.close())
+            return False
+
+        if self.policy == COALESCE:
+            # 丢弃队列中所有旧消息，用最新快照替代
+            self.coalesced += self.queue.qsize()
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(self.broadcaster.snapshot_frame(frame, self.encoding))
+            return True
+
+        # DROP_OLDEST
+        self.queue.get_nowait()
+        self.dropped += 1
+        self.queue.put_nowait(frame)
+        return True
+
+    async def _drain(self):
+        try:
+            while True:
+                frame = await self.queue.get()
+                if isinstance(frame, str):
+                    await self.ws.send_str(frame)
+                else:
+                    await self.ws.send_bytes(frame)
+                self.sent += 1
+                self.bytes_sent += len(frame)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning("Failed to send to %s client: %s", self.broadcaster.name, e)
+            self.broadcaster.discard(self.ws)
+
+    def close(self):
+        self.writer.cancel()
+
+    def stats(self):
+        return {
+            "remote": self.remote,
+            "depth": self.queue.qsize(),
+            "max_depth": self.queue.maxsize,
+            "policy": self.policy,
+            "encoding": self.encoding,
+            "compress": bool(self.ws.compress),
+            "sent": self.sent,
+            "bytes_sent": self.bytes_sent,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+        }
+
+
+class Broadcaster:
+    """
+    管理一组客户端的发送队列。publish 只负责入队，从不等待网络发送。
+    """
+
+    def __init__(self, name, maxsize, policy, snapshot=None):
+        """
+        :param name: 广播器名称（用于日志和统计）
+        :param maxsize: 每个客户端队列的最大长度
+        :param policy: 队列已满时的策略
+        :param snapshot: 返回最新完整快照消息的函数，coalesce 策略使用
+        """
+        if policy not in POLICIES:
+            logger.error("Unknown queue policy '%s' for %s, using '%s'.", policy, name, COALESCE)
+            policy = COALESCE
+        self.name = name
+        self.maxsize = maxsize
+        self.policy = policy
+        self.snapshot = snapshot
+        self.channels = {}  # WebSocket -> ClientChannel
+
+    def __len__(self):
+        return len(self.channels)
+
+    def __iter__(self):
+        return iter(list(self.channels))
+
+    def add(self, ws, remote=None, encoding=JSON):
+        channel = ClientChannel(self, ws, self.maxsize, self.policy, remote, encoding)
+        self.channels[ws] = channel
+        return channel
+
+    def set_encoding(self, ws, encoding):
+        """
+        切换客户端之后消息的编码（已在队列中的帧不变）。
+        """
+        channel = self.channels.get(ws)
+        if channel is not None:
+            channel.encoding = encoding
+
+    def discard(self, ws):
+        channel = self.channels.pop(ws, None)
+        if channel is not None:
+            channel.close()
+
+    def snapshot_frame(self, fallback, encoding=JSON):
+        """
+        coalesce 策略使用：按客户端的编码编码最新快照，没有快照函数时使用当前帧。
+        """
+        if self.snapshot is None:
+            return fallback
+        return encode_frame(self.snapshot(), encoding)
+
+    def send(self, ws, message):
+        """
+        通过客户端自己的队列发送消息，保证与广播消息的顺序一致。
+        """
+        channel = self.channels.get(ws)
+        if channel is None:
+            return False
+        return channel.offer(encode_frame(message, channel.encoding))
+
+    def publish(self, message):
+        """
+        将消息按每种编码各编码一次后放入所有客户端的队列，返回收到消息的客户端数量。
+        """
+        if not self.channels:
+            return 0
+        frames = {}
+        delivered = 0
+        for channel in list(self.channels.values()):
+            frame = frames.get(channel.encoding)
+            if frame is None:
+                frame = frames[channel.encoding] = encode_frame(message, channel.encoding)
+            if channel.offer(frame):
+                delivered += 1
+        if payloads_enabled():
+            logger.debug("%s broadcast: %s", self.name, frames.get(JSON) or encode_frame(message))
+        return delivered
+
+    def queue_depth(self):
+        """
+        :return: (所有客户端队列中的消息总数, 单个客户端的最大队列深度)
+        """
+        depths = [channel.queue.qsize() for channel in self.channels.values()]
+        return sum(depths), max(depths, default=0)
+
+    def stats(self):
+        return {
+            "encoder": ENCODER,
+            "clients": len(self.channels),
+            "policy": self.policy,
+            "queues": [channel.stats() for channel in self.channels.values()],
+        }
@@ -0,0 +1,219 @@
+#bus.py
+# 多进程模式的本地状态总线：主进程拥有所有设备连接、会话状态和操作日志，
+# 手机端工作进程通过 Unix 域套接字订阅设备注册表，保存一份版本号与主进程一致的副本。
+#
+# 帧格式：4 字节大端长度 + JSON。每个工作进程一条连接，消息按发送顺序到达：
+#   工作进程 -> 主进程  {"t": "subscribe", "worker": N}         订阅，主进程回复完整状态
+#                       {"t": "resync"}                        副本与增量不衔接，请求完整状态
+#                       {"t": "event", "event", "device", "session", "data"}  转发任务事件
+#   主进程 -> 工作进程  {"t": "state", "version", "devices"}   完整状态
+#                       {"t": "devices", "since", "version", "data"}  每个合并窗口一次的增量
+import asyncio
+import logging
+import struct
+import tasktracker
+from codec import dumps, loads
+from config import BUS_SOCKET, BUS_BUFFER_LIMIT
+from notifier import update_hooks
+from scheduler import update_scheduler
+from shared_data import registry
+
+logger = logging.getLogger(__name__)
+
+FRAME_HEADER = struct.Struct("!I")
+CONNECT_TIMEOUT = 10  # 工作进程等待主进程总线就绪的最长时间（秒）
+
+
+def encode(message):
+    data = dumps(message).encode("utf-8")
+    return FRAME_HEADER.pack(len(data)) + data
+
+
+async def read_frame(reader):
+    """
+    :raises asyncio.IncompleteReadError: 连接已关闭
+    """
+    header = await reader.readexactly(FRAME_HEADER.size)
+    (length,) = FRAME_HEADER.unpack(header)
+    return loads(await reader.readexactly(length))
+
+
+def state_message():
+    return {
+        "t": "state",
+        "version": registry.version,
+        "devices": [dict(record.as_dict(), version=record.version) for record in registry],
+    }
+
+
+class BusServer:
+    """
+    主进程一侧：向订阅的工作进程发布注册表增量，处理工作进程转发的事件。
+    """
+
+    def __init__(self, path=BUS_SOCKET, buffer_limit=BUS_BUFFER_LIMIT):
+        self.path = path
+        self.buffer_limit = buffer_limit
+        self._server = None
+        self._subscribers = {}  # StreamWriter -> 工作进程编号
+        self.published = 0
+        self.events = 0
+        self.dropped = 0
+
+    async def start(self):
+        self._server = await asyncio.start_unix_server(self._handle, path=self.path)
+        update_hooks.append(self.publish_devices)
+        logger.info("State bus listening on %s.", self.path)
+
+    async def close(self):
+        if self.publish_devices in update_hooks:
+            update_hooks.remove(self.publish_devices)
+        if self._server is not None:
+            self._server.close()
+            for writer in list(self._subscribers):
+                writer.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    def _send_state(self, writer):
+        # 先推送合并窗口中等待的变更，之后的增量从完整状态的版本号开始
+        update_scheduler.flush()
+        writer.write(encode(state_message()))
+
+    async def _handle(self, reader, writer):
+        worker = None
+        try:
+            while True:
+                message = await read_frame(reader)
+                kind = message.get("t")
+                if kind == "subscribe":
+                    worker = message.get("worker")
+                    self._send_state(writer)
+                    self._subscribers[writer] = worker
+                    logger.info("Phone worker %s subscribed to the state bus.", worker)
+                elif kind == "resync":
+                    logger.warning("Phone worker %s requested a resync.", worker)
+                    self._send_state(writer)
+                elif kind == "event":
+                    self.events += 1
+                    await tasktracker.dispatch_event(
+                        message["event"], message.get("device"), message.get("session"), **(message.get("data") or {}))
+                else:
+                    logger.warning("Unknown bus message from worker %s: %r", worker, kind, extra={"rate_key": "bus_unknown"})
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            logger.exception("State bus connection of worker %s failed: %s", worker, e)
+        finally:
+            self._subscribers.pop(writer, None)
+            writer.close()
+            if worker is not None:
+                logger.info("Phone worker %s left the state bus.", worker)
+
+    def publish_devices(self, since, version, updates):
+        """
+        notifier 的推送钩子：同一帧写给所有工作进程。积压过多的工作进程被断开，重连后重新同步。
+        """
+        if not self._subscribers:
+            return
+        frame = encode({"t": "devices", "since": since, "version": version, "data": updates})
+        for writer, worker in list(self._subscribers.items()):
+            if writer.transport.get_write_buffer_size() > self.buffer_limit:
+                logger.warning("Phone worker %s is not keeping up with the state bus; disconnecting.", worker)
+                self._subscribers.pop(writer, None)
+                writer.close()
+                self.dropped += 1
+                continue
+            writer.write(frame)
+        self.published += 1
+
+    def stats(self):
+        return {
+            "workers": sorted(self._subscribers.values()),
+            "published": self.published,
+            "events": self.events,
+            "dropped": self.dropped,
+        }
+
+
+class BusClient:
+    """
+    工作进程一侧：维护注册表副本，把本进程的任务事件转发给主进程。
+    """
+
+    def __init__(self, worker_id, path=BUS_SOCKET):
+        self.worker_id = worker_id
+        self.path = path
+        self._writer = None
+        self._task = None
+        self._resyncing = False
+        self.resyncs = 0
+
+    async def connect(self, timeout=CONNECT_TIMEOUT):
+        """
+        连接总线（主进程可能仍在启动，失败时重试）并等待第一次完整状态。
+        :raises ConnectionError: 超时仍无法连接
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            try:
+                reader, self._writer = await asyncio.open_unix_connection(self.path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError) as e:
+                if loop.time() > deadline:
+                    raise ConnectionError(f"State bus {self.path} is not available: {e}")
+                await asyncio.sleep(0.1)
+        self._writer.write(encode({"t": "subscribe", "worker": self.worker_id}))
+        self._handle(await read_frame(reader))
+        tasktracker.event_forwarder = self.forward_event
+        self._task = loop.create_task(self._run(reader))
+
+    async def wait_closed(self):
+        """
+        等待主进程关闭总线连接。
+        """
+        await self._task
+
+    def close(self):
+        tasktracker.event_forwarder = None
+        if self._task is not None:
+            self._task.cancel()
+        if self._writer is not None:
+            self._writer.close()
+
+    async def _run(self, reader):
+        try:
+            while True:
+                self._handle(await read_frame(reader))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            logger.warning("State bus connection to the primary process closed.")
+
+    def _handle(self, message):
+        kind = message.get("t")
+        if kind == "state":
+            registry.replace(message["version"], message["devices"])
+            self._resyncing = False
+        elif kind == "devices":
+            if self._resyncing:
+                return
+            if not registry.apply(message["since"], message["version"], message["data"]):
+                logger.warning(
+                    "State bus delta %d..%d does not follow replica version %d; resyncing.",
+                    message["since"], message["version"], registry.version)
+                self._resyncing = True
+                self.resyncs += 1
+                self._writer.write(encode({"t": "resync"}))
+                return
+        else:
+            logger.warning("Unknown bus message: %r", kind, extra={"rate_key": "bus_unknown"})
+            return
+        # 主进程已经按窗口合并过，副本的变更立即推送给本进程的手机端
+        update_scheduler.mark("devices", ())
+        update_scheduler.flush()
+
+    def forward_event(self, event_type, device, session_id, data):
+        self._writer.write(encode({"t": "event", "event": event_type, "device": device, "session": session_id, "data": data}))
+
+
+bus_server = BusServer()
@@ -0,0 +1,102 @@
+#codec.py
+# 广播消息的 JSON 编码：优先使用已安装的更快编码器（orjson / ujson），否则使用标准库
+#
+# 客户端可以按连接协商更紧凑的编码（见 negotiate_encoding）：
+#   json     默认，现有客户端不受影响
+#   compact  键名只出现一次的 JSON：消息中的对象列表（设备、任务）改为 {"fields": [...], "rows": [[...], ...]}
+#   msgpack  compact 结构的 MessagePack 二进制帧（需要安装 msgpack）
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+if orjson is not None:
+    ENCODER = "orjson"
+
+    def dumps(message):
+        return orjson.dumps(message).decode("utf-8")
+
+    loads = orjson.loads
+elif ujson is not None:
+    ENCODER = "ujson"
+
+    def dumps(message):
+        return ujson.dumps(message, ensure_ascii=False)
+
+    loads = ujson.loads
+else:
+    ENCODER = "json"
+
+    def dumps(message):
+        return json.dumps(message, ensure_ascii=False, separators=(",", ":"))
+
+    loads = json.loads
+
+
+JSON = "json"
+COMPACT = "compact"
+MSGPACK = "msgpack"
+ENCODINGS = (JSON, COMPACT, MSGPACK) if msgpack is not None else (JSON, COMPACT)
+
+
+def negotiate_encoding(requested):
+    """
+    :param requested: 客户端请求的编码（?encoding= 或 hello 消息）
+    :return: 支持时返回该编码，否则返回 json
+    """
+    return requested if requested in ENCODINGS else JSON
+
+
+def hello_message(encoding):
+    """
+    对客户端 {"type": "hello", "encoding": ...} 的回复（使用协商后的编码发送）。
+    """
+    return {"type": "hello", "encoding": encoding, "encodings": list(ENCODINGS)}
+
+
+def _rows(items):
+    fields = []
+    seen = set()
+    for item in items:
+        for key in item:
+            if key not in seen:
+                seen.add(key)
+                fields.append(key)
+    return {"fields": fields, "rows": [[item.get(key) for key in fields] for item in items]}
+
+
+def compact_message(message):
+    """
+    把消息中顶层的对象列表改为字段名 + 行数组，其余字段不变。
+    """
+    compacted = {}
+    for key, value in message.items():
+        if isinstance(value, list) and value and all(isinstance(item, dict) for item in value):
+            value = _rows(value)
+        compacted[key] = value
+    return compacted
+
+
+def encode_frame(message, encoding=JSON):
+    """
+    将消息编码为不可变的帧，同一帧可以发送给所有使用相同编码的客户端。
+    :return: json / compact 为文本帧（str），msgpack 为二进制帧（bytes）
+    """
+    if encoding == COMPACT:
+        return dumps(compact_message(message))
+    if encoding == MSGPACK:
+        return msgpack.packb(compact_message(message))
+    return dumps(message)
@@ -0,0 +1,139 @@
+#config.py
+# 服务器可调参数，均可以通过环境变量覆盖
+import logging
+import os
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+# 默认数据文件相对于代码目录，而不是当前工作目录
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def env_int(name, default):
+    value = os.environ.get(name)
+    if value is None or value == "":
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        logger.error("Invalid integer for %s: %r, using %s", name, value, default)
+        return default
+
+
+def env_str(name, default):
+    return os.environ.get(name) or default
+
+
+# 监听端口：设备 WebSocket、手机端 HTTP / WebSocket、头显 WebSocket
+DEVICE_PORT = env_int("AR_DEVICE_PORT", 8765)
+HTTP_PORT = env_int("AR_HTTP_PORT", 8080)
+HEADSET_PORT = env_int("AR_HEADSET_PORT", 8766)
+
+# 每个客户端发送队列的最大长度
+SEND_QUEUE_SIZE = env_int("AR_SEND_QUEUE_SIZE", 64)
+
+# 发送队列已满时的处理策略：drop_oldest / coalesce / disconnect
+PHONE_QUEUE_POLICY = env_str("AR_PHONE_QUEUE_POLICY", "coalesce")
+HEADSET_QUEUE_POLICY = env_str("AR_HEADSET_QUEUE_POLICY", "coalesce")
+
+# 更新合并窗口（毫秒）：窗口内的设备和任务变更合并为每个主题一次推送，
+# 默认约等于头显 30fps 的帧间隔
+FLUSH_WINDOW_MS = env_int("AR_FLUSH_WINDOW_MS", 33)
+
+# 命令确认超时（毫秒）：超过该时间没有收到设备的 STATUS 确认，视为超时
+COMMAND_ACK_TIMEOUT_MS = env_int("AR_COMMAND_ACK_TIMEOUT_MS", 10000)
+
+# 命令合并模式：同一设备同一属性的新命令会替换尚未发送的旧命令（1 开启，0 关闭），
+# 请求中的 "coalesce" 字段可以覆盖该默认值
+COMMAND_COALESCING = env_int("AR_COMMAND_COALESCING", 0)
+
+# 合并模式下，发送下一条同属性命令前等待上一条确认的最长时间（毫秒）
+COMMAND_READY_TIMEOUT_MS = env_int("AR_COMMAND_READY_TIMEOUT_MS", 250)
+
+# 设备心跳：空闲超过 INTERVAL 发送 PING，之后 TIMEOUT 内仍无任何消息则断开（毫秒）
+HEARTBEAT_INTERVAL_MS = env_int("AR_HEARTBEAT_INTERVAL_MS", 5000)
+HEARTBEAT_TIMEOUT_MS = env_int("AR_HEARTBEAT_TIMEOUT_MS", 5000)
+
+# /devices 长轮询的最长等待时间（秒）
+LONG_POLL_MAX_WAIT = env_int("AR_LONG_POLL_MAX_WAIT", 60)
+
+# 批量/场景命令的默认截止时间（毫秒）
+BATCH_TIMEOUT_MS = env_int("AR_BATCH_TIMEOUT_MS", 2000)
+
+# 设备分组和场景定义：SCENES_FILE 为随代码提供的默认定义（只读），
+# 通过 PUT /groups、PUT /scenes 修改后的定义保存到 SCENES_DATA_FILE，启动时优先加载它
+SCENES_FILE = env_str("AR_SCENES_FILE", os.path.join(BASE_DIR, "scenes.json"))
+SCENES_DATA_FILE = env_str("AR_SCENES_DATA_FILE", os.path.join(BASE_DIR, "data", "scenes.json"))
+
+# 实验任务（规则）定义文件
+TASKS_FILE = env_str("AR_TASKS_FILE", os.path.join(BASE_DIR, "tasks.json"))
+
+# 操作日志：追加写入的分段文件目录、单个分段的最大字节数、批量写入参数
+ACTION_LOG_DIR = env_str("AR_ACTION_LOG_DIR", os.path.join(BASE_DIR, "logs"))
+ACTION_LOG_SEGMENT_BYTES = env_int("AR_ACTION_LOG_SEGMENT_BYTES", 16 * 1024 * 1024)
+ACTION_LOG_BATCH_SIZE = env_int("AR_ACTION_LOG_BATCH_SIZE", 256)
+ACTION_LOG_FLUSH_MS = env_int("AR_ACTION_LOG_FLUSH_MS", 200)
+ACTION_LOG_INDEX_EVERY = env_int("AR_ACTION_LOG_INDEX_EVERY", 256)
+
+# 每个会话在内存中保留的最近操作记录条数（完整记录在操作日志中）
+ACTION_MEMORY_LIMIT = env_int("AR_ACTION_MEMORY_LIMIT", 1000)
+
+# 实验会话数量上限（会话只能通过 POST /sessions 创建，之后常驻内存）
+MAX_SESSIONS = env_int("AR_MAX_SESSIONS", 256)
+
+# 日志：级别、输出格式（text / json）、是否输出消息内容（调试用，运行时可通过 /logging 切换）、
+# 高频事件（PING、状态上报等）每秒每类最多输出的条数
+LOG_LEVEL = env_str("AR_LOG_LEVEL", "INFO")
+LOG_FORMAT = env_str("AR_LOG_FORMAT", "text")
+LOG_PAYLOADS = env_int("AR_LOG_PAYLOADS", 0)
+LOG_RATE_LIMIT = env_int("AR_LOG_RATE_LIMIT", 5)
+
+# 性能诊断：AR_PROFILE=1（或 main.py --profile）启用事件循环卡顿检测，
+# 回调阻塞事件循环超过 STALL_THRESHOLD_MS 时记录其调用栈；
+# 采样分析器（/admin/profile）的采样间隔、最长运行时间和结果目录
+PROFILE = env_int("AR_PROFILE", 0)
+STALL_THRESHOLD_MS = env_int("AR_STALL_THRESHOLD_MS", 100)
+PROFILE_INTERVAL_MS = env_int("AR_PROFILE_INTERVAL_MS", 5)
+PROFILE_MAX_SECONDS = env_int("AR_PROFILE_MAX_SECONDS", 300)
+PROFILE_DIR = env_str("AR_PROFILE_DIR", os.path.join(BASE_DIR, "profiles"))
+
+# 管理接口（/admin/*、PUT /logging、PUT /scenes、PUT /groups）只接受本机（回环地址）请求；
+# 设置 ADMIN_TOKEN 后，其他地址的请求携带 "Authorization: Bearer <令牌>" 也可访问
+ADMIN_TOKEN = env_str("AR_ADMIN_TOKEN", "")
+
+# 热重启快照：注册表、任务进度和会话计时定期（有变化时）写入快照文件，关闭时再写一次，
+# 启动时在开始监听之前恢复；恢复的设备在宽限期内未重新连接则移除。INTERVAL 为 0 时不使用快照
+SNAPSHOT_FILE = env_str("AR_SNAPSHOT_FILE", os.path.join(BASE_DIR, "state_snapshot.json"))
+SNAPSHOT_INTERVAL_MS = env_int("AR_SNAPSHOT_INTERVAL_MS", 5000)
+SNAPSHOT_GRACE_MS = env_int("AR_SNAPSHOT_GRACE_MS", 60000)
+
+# 设备连接准入：同时进行的注册握手上限、注册速率（令牌桶：每秒令牌数和桶容量）、
+# 等待准入或等待 DEVICE_NAME 的最长时间（毫秒，超时后以 1013 关闭连接，设备稍后重试）
+ADMISSION_MAX_HANDSHAKES = env_int("AR_ADMISSION_MAX_HANDSHAKES", 64)
+ADMISSION_RATE = env_int("AR_ADMISSION_RATE", 200)
+ADMISSION_BURST = env_int("AR_ADMISSION_BURST", 100)
+ADMISSION_TIMEOUT_MS = env_int("AR_ADMISSION_TIMEOUT_MS", 10000)
+
+# 批量注册：每批最多处理的设备数；有手机端命令正在处理时，注册最多推迟的时间（毫秒）
+REGISTRATION_BATCH_SIZE = env_int("AR_REGISTRATION_BATCH_SIZE", 100)
+REGISTRATION_MAX_DEFER_MS = env_int("AR_REGISTRATION_MAX_DEFER_MS", 100)
+
+# 多进程模式：手机端工作进程数量（0 = 单进程）。工作进程以 SO_REUSEPORT 共同监听手机端 HTTP 端口，
+# 通过 Unix 域套接字上的状态总线（BUS_SOCKET）从主进程同步设备状态；
+# 主进程的手机端接口只监听 PHONE_SOCKET，供工作进程转发命令等请求。
+# 总线上某个工作进程积压的数据超过 BUS_BUFFER_LIMIT 字节时断开它，工作进程重连后重新同步
+WORKERS = env_int("AR_WORKERS", 0)
+BUS_SOCKET = env_str("AR_BUS_SOCKET", os.path.join(tempfile.gettempdir(), f"ar-bus-{HTTP_PORT}.sock"))
+PHONE_SOCKET = env_str("AR_PHONE_SOCKET", os.path.join(tempfile.gettempdir(), f"ar-phone-{HTTP_PORT}.sock"))
+BUS_BUFFER_LIMIT = env_int("AR_BUS_BUFFER_LIMIT", 4 * 1024 * 1024)
+
+# 设备状态历史的各级环形缓冲区："分辨率秒:条目数"，分辨率 0 表示逐条记录原始变化。
+# 每个设备最多占用 总条目数 × 20 字节（默认约 18 KB）
+HISTORY_LEVELS = env_str("AR_HISTORY_LEVELS", "0:256,10:360,300:288")
+# 设备从注册表移除（断开后被清理）多久之后丢弃其历史，避免不再出现的设备名称持续占用内存
+HISTORY_RETENTION_MS = env_int("AR_HISTORY_RETENTION_MS", 3600000)
+
+# 手机端和头显 WebSocket 的 permessage-deflate：aiohttp 默认接受客户端提出的压缩（即 1），
+# 设为 0 时关闭压缩（服务器 CPU 受限、客户端都在局域网内时）；本设置不会增加新的压缩能力
+WS_COMPRESS = env_int("AR_WS_COMPRESS", 1)
@@ -0,0 +1,345 @@
+#device_actor.py
+# 设备 Actor：每个已连接的设备拥有自己的命令队列、发送任务和状态，
+# 不同设备的命令可以并行处理，不再共用一把全局锁
+import asyncio
+import itertools
+import logging
+from collections import deque
+import websockets
+from shared_data import registry
+from tasktracker import dispatch_event
+from config import COMMAND_ACK_TIMEOUT_MS, COMMAND_COALESCING, COMMAND_READY_TIMEOUT_MS
+from device_protocol import PROTO_TEXT, PROTO_BIN1, PING_FRAME, encode_command, encode_text_command
+from metrics import command_latency, command_rtt
+from heartbeat import heartbeat
+
+logger = logging.getLogger(__name__)
+
+_command_ids = itertools.count(1)
+
+PING = "PING"  # 心跳消息，与命令共用设备的发送队列
+
+
+def parse_command(command):
+    """
+    Parses the command string and extracts brightness and color.
+
+    :param command: Command string in the format "COLOR BRIGHTNESS".
+    :return: (brightness, color) tuple.
+    """
+    try:
+        parts = command.split()
+        if len(parts) == 2:
+            color = parts[0]
+            brightness = int(parts[1])
+            return brightness, color
+    except Exception as e:
+        logger.error("Failed to parse command: %s", e)
+    # 如果解析失败，返回默认值
+    return 0, "off"
+
+
+def command_key(command):
+    """
+    返回命令控制的属性，用于合并同一属性的命令；不可合并的命令返回 None。
+    "COLOR BRIGHTNESS" 同时设置颜色和亮度，SWITCH_ON / SWITCH_OFF 控制开关。
+    """
+    parts = command.split()
+    if len(parts) == 2 and parts[1].lstrip("-").isdigit():
+        return "light"
+    if command in ("SWITCH_ON", "SWITCH_OFF"):
+        return "power"
+    return None
+
+
+class DeviceCommand:
+    """
+    一条发往设备的命令。sent 在命令写入网络后完成，acked 在设备的 STATUS 确认后完成。
+    """
+
+    def __init__(self, device_name, command, coalesce=False, session_id=None):
+        loop = asyncio.get_running_loop()
+        self.id = next(_command_ids)
+        self.device_name = device_name
+        self.command = command
+        self.session_id = session_id  # 发出命令的实验会话
+        self.key = command_key(command)
+        self.coalesce = coalesce and self.key is not None
+        self.brightness, self.color = parse_command(command)
+        self.created_at = loop.time()
+        self.sent_at = None
+        self.rtt = None
+        self.sent = loop.create_future()  # 结果: "sent" 或错误信息
+        self.acked = loop.create_future()  # 结果: "acked" / "timeout" / "superseded" / "disconnected" / "dropped"
+        self._timeout_handle = None
+
+    def matches(self, brightness, color):
+        return self.brightness == brightness and str(self.color).lower() == str(color).lower()
+
+    def resolve_sent(self, result):
+        if not self.sent.done():
+            self.sent.set_result(result)
+
+    def resolve_ack(self, result):
+        if self._timeout_handle is not None:
+            self._timeout_handle.cancel()
+            self._timeout_handle = None
+        if not self.acked.done():
+            self.acked.set_result(result)
+
+    def result(self):
+        """
+        返回命令当前的结果摘要。
+        """
+        return {
+            "id": self.id,
+            "device": self.device_name,
+            "command": self.command,
+            "sent": self.sent.result() if self.sent.done() else None,
+            "ack": self.acked.result() if self.acked.done() else None,
+            "rtt_ms": round(self.rtt * 1000, 2) if self.rtt is not None else None,
+        }
+
+
+class DeviceActor:
+    """
+    拥有单个设备连接的 Actor。命令按顺序经过设备自己的队列发送，
+    设备的 STATUS 回复按命令 ID（bin1 设备和声明 ids=1 的文本设备）或期望状态（其他文本设备）
+    匹配为确认，并记录往返时间。
+    网桥后面的子设备共用网桥的连接，命令帧中带有子设备的槽位。
+    """
+
+    def __init__(self, name, websocket, protocol=PROTO_TEXT, slot=None, echo_ids=False):
+        """
+        :param protocol: 注册时协商的协议（text / bin1）
+        :param slot: 网桥子设备的槽位；None 表示直接连接的设备
+        :param echo_ids: 设备会在 STATUS 中回传命令 ID，文本命令附带 ";id=<命令 ID>"
+        """
+        self.name = name
+        self.websocket = websocket
+        self.protocol = protocol
+        self.slot = slot
+        self.echo_ids = echo_ids
+        self.inbox = asyncio.Queue()
+        self.awaiting_ack = deque()  # 已发送、等待 STATUS 确认的命令（按发送顺序）
+        self.current = None  # 正在发送的命令
+        self.queued = {}  # 合并模式下尚未发送的命令：属性 -> DeviceCommand
+        self.sent_count = 0
+        self.dropped_count = 0  # 被更新的同属性命令替换、从未发送的命令数
+        self.acked_count = 0
+        self.timeout_count = 0
+        self.last_rtt = None
+        self.closed = False
+        self.last_seen = asyncio.get_running_loop().time()  # 最近一次收到设备消息的时间
+        self.last_ping = float("-inf")  # 最近一次发送 PING 的时间
+        self.task = asyncio.create_task(self._run())
+
+    def touch(self):
+        """
+        收到设备的任何消息时调用，用于心跳检测。
+        """
+        self.last_seen = asyncio.get_running_loop().time()
+
+    def ping(self, now):
+        """
+        由心跳调度器调用：将 PING 放入发送队列。
+        """
+        self.last_ping = now
+        self.inbox.put_nowait(PING)
+
+    def submit(self, command, coalesce=None, session_id=None):
+        """
+        将命令放入设备的队列，立即返回 DeviceCommand，调用方可以等待 sent / acked。
+        :param coalesce: 是否启用合并模式；None 时使用 AR_COMMAND_COALESCING 的默认值
+        :param session_id: 发出命令的实验会话，任务事件交给该会话处理
+        """
+        if coalesce is None:
+            coalesce = bool(COMMAND_COALESCING)
+        cmd = DeviceCommand(self.name, command, coalesce, session_id)
+        if cmd.coalesce:
+            # 同一属性只保留最新的命令，旧命令直接丢弃
+            previous = self.queued.get(cmd.key)
+            if previous is not None:
+                self._drop(previous, cmd)
+            self.queued[cmd.key] = cmd
+        self.inbox.put_nowait(cmd)
+        return cmd
+
+    def _drop(self, cmd, newer):
+        self.dropped_count += 1
+        cmd.resolve_sent(f"Superseded: Command '{cmd.command}' replaced by '{newer.command}' for '{self.name}'.")
+        cmd.resolve_ack("dropped")
+
+    async def _run(self):
+        while True:
+            cmd = await self.inbox.get()
+            if cmd is PING:
+                await self._send_ping()
+                continue
+            if cmd.sent.done():
+                continue  # 排队期间已被新命令替换
+            self.current = cmd
+            if cmd.coalesce:
+                await self._wait_ready(cmd)
+                if self.queued.get(cmd.key) is cmd:
+                    del self.queued[cmd.key]
+                if cmd.sent.done():
+                    self.current = None
+                    continue  # 等待期间已被新命令替换
+            await self._send(cmd)
+            self.current = None
+
+    async def _send_ping(self):
+        try:
+            await self.websocket.send(PING_FRAME if self.protocol == PROTO_BIN1 else PING)
+        except Exception as e:
+            # 连接已断开时由读取循环负责清理
+            logger.warning("Failed to send PING to '%s': %s", self.name, e)
+
+    async def _wait_ready(self, cmd):
+        """
+        合并模式：等待同属性的上一条命令被确认（最多 AR_COMMAND_READY_TIMEOUT_MS），
+        等待期间到达的新命令会替换当前命令，只有最新值会发送给设备。
+        """
+        in_flight = [c.acked for c in self.awaiting_ack if c.key == cmd.key and not c.acked.done()]
+        if in_flight:
+            await asyncio.wait(in_flight, timeout=COMMAND_READY_TIMEOUT_MS / 1000)
+
+    def _encode(self, cmd):
+        """
+        bin1 设备的颜色/亮度命令编码为二进制帧，其余命令保持文本（声明 ids=1 的设备附带命令 ID）。
+        网桥子设备只能通过二进制帧寻址，无法编码的命令返回 None。
+        """
+        if self.protocol == PROTO_BIN1 and cmd.key == "light":
+            frame = encode_command(cmd.id, cmd.brightness, cmd.color, self.slot)
+            if frame is not None:
+                return frame
+        if self.slot is not None:
+            return None
+        if self.echo_ids:
+            return encode_text_command(cmd.command, cmd.id)
+        return cmd.command
+
+    async def _send(self, cmd):
+        frame = self._encode(cmd)
+        if frame is None:
+            cmd.resolve_sent(f"Error: Command '{cmd.command}' cannot be sent to bridged device '{self.name}'.")
+            cmd.resolve_ack("error")
+            return
+        try:
+            await self.websocket.send(frame)
+        except websockets.exceptions.ConnectionClosed:
+            logger.warning("Failed to send command. Device '%s' disconnected.", self.name)
+            cmd.resolve_sent(f"Error: Failed to send command. Device '{self.name}' disconnected.")
+            cmd.resolve_ack("disconnected")
+            return
+        except Exception as e:
+            logger.error("Failed to send command to '%s': %s", self.name, e)
+            cmd.resolve_sent(f"Error: {e}")
+            cmd.resolve_ack("error")
+            return
+
+        loop = asyncio.get_running_loop()
+        cmd.sent_at = loop.time()
+        self.sent_count += 1
+        self.awaiting_ack.append(cmd)
+        cmd._timeout_handle = loop.call_later(COMMAND_ACK_TIMEOUT_MS / 1000, self._expire, cmd)
+        logger.debug("Command '%s' (id %d) sent to '%s'", cmd.command, cmd.id, self.name, extra={"rate_key": "command_sent"})
+
+        # 乐观更新：先按命令写入期望状态，收到设备 STATUS 后再校正
+        if self._owns_record():
+            registry.update(self.name, brightness=cmd.brightness, color=cmd.color)
+            logger.debug("Updated state for '%s': brightness=%s, color=%s", self.name, cmd.brightness, cmd.color, extra={"rate_key": "state_diff"})
+            await dispatch_event("command_applied", self.name, cmd.session_id, brightness=cmd.brightness, color=cmd.color)
+
+        cmd.resolve_sent(f"Success: Command '{cmd.command}' sent to '{self.name}'.")
+
+    def _expire(self, cmd):
+        cmd._timeout_handle = None
+        if cmd in self.awaiting_ack:
+            self.awaiting_ack.remove(cmd)
+        if not cmd.acked.done():
+            self.timeout_count += 1
+            logger.warning("Command %d to '%s' not acknowledged within %d ms.", cmd.id, self.name, COMMAND_ACK_TIMEOUT_MS)
+            cmd.resolve_ack("timeout")
+
+    async def on_status(self, brightness, color, command_id=None):
+        """
+        处理设备上报的 STATUS：匹配等待确认的命令，并以设备上报的状态为准校正本地状态。
+        :param command_id: 设备在 STATUS 中回传的命令 ID（bin1 或声明 ids=1 的文本设备）；
+                           None 时按（颜色, 亮度）匹配
+        """
+        self._acknowledge(brightness, color, command_id)
+
+        if not self._owns_record():
+            return
+        changed = registry.update(self.name, brightness=brightness, color=color)
+        logger.debug("Updated state for '%s': brightness=%s, color=%s", self.name, brightness, color, extra={"rate_key": "state_diff"})
+        if changed:
+            # 设备实际状态与乐观写入不一致时，重新检测任务
+            await dispatch_event("status_reported", self.name, brightness=brightness, color=color)
+
+    def _owns_record(self):
+        # 网桥本身没有注册表记录；同名设备重连后旧 Actor 也不再拥有记录
+        record = registry.get(self.name)
+        return record is not None and record.actor is self
+
+    def _acknowledge(self, brightness, color, command_id):
+        matched = None
+        for cmd in self.awaiting_ack:
+            if command_id is not None:
+                if cmd.id == command_id:
+                    matched = cmd
+                    break
+            elif cmd.matches(brightness, color):
+                matched = cmd
+        if matched is None:
+            return
+
+        now = asyncio.get_running_loop().time()
+        # 匹配到的命令之前发送的命令已被覆盖
+        while self.awaiting_ack:
+            cmd = self.awaiting_ack.popleft()
+            if cmd is matched:
+                break
+            cmd.resolve_ack("superseded")
+        matched.rtt = now - matched.sent_at
+        command_rtt.observe(matched.rtt, self.protocol)
+        command_latency.observe(now - matched.created_at)
+        self.last_rtt = matched.rtt
+        self.acked_count += 1
+        matched.resolve_ack("acked")
+        logger.debug("Command %d acknowledged by '%s' in %.1f ms", matched.id, self.name, matched.rtt * 1000, extra={"rate_key": "command_ack"})
+
+    def close(self):
+        """
+        设备断开时停止 Actor，并结束所有未完成的命令。
+        """
+        self.closed = True
+        heartbeat.discard(self)
+        self.task.cancel()
+        pending = [self.current] if self.current is not None else []
+        while not self.inbox.empty():
+            item = self.inbox.get_nowait()
+            if item is not PING:
+                pending.append(item)
+        self.queued.clear()
+        for cmd in pending:
+            cmd.resolve_sent(f"Error: Device '{self.name}' disconnected.")
+            cmd.resolve_ack("disconnected")
+        while self.awaiting_ack:
+            self.awaiting_ack.popleft().resolve_ack("disconnected")
+
+    def stats(self):
+        return {
+            "protocol": self.protocol,
+            "echo_ids": self.echo_ids,
+            "bridge_slot": self.slot,
+            "queued": self.inbox.qsize(),
+            "awaiting_ack": len(self.awaiting_ack),
+            "sent": self.sent_count,
+            "dropped": self.dropped_count,
+            "acked": self.acked_count,
+            "timeouts": self.timeout_count,
+            "last_rtt_ms": round(self.last_rtt * 1000, 2) if self.last_rtt is not None else None,
+        }
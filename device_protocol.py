@@ -0,0 +1,166 @@
+#device_protocol.py
+# 设备通信协议：旧固件使用的文本协议，以及在 DEVICE_NAME: 注册时协商的紧凑二进制协议（bin1）。
+#
+# 注册：DEVICE_NAME:<名称>[;proto=bin1][;bridge=1]
+#   支持 bin1 的设备收到服务器回复的 "PROTO:bin1" 后开始使用二进制帧；
+#   没有 proto 参数的旧固件继续使用文本协议。协商后文本帧仍然有效。
+#   文本协议的设备可以加 ;ids=1：服务器发送的文本命令带上 ";id=<命令 ID>"，
+#   设备在 STATUS 中回传 id=<命令 ID> 用于精确匹配确认；未加该参数的设备只按（颜色, 亮度）匹配确认。
+#
+# 二进制帧（网络字节序），帧头为 版本(u8) + 类型(u8)：
+#   STATUS        设备 -> 服务器  命令ID(u32, 0 表示无) 亮度(u16) 颜色(u8)
+#   STATUS_BATCH  网桥 -> 服务器  数量(u16) + 数量 x [槽位(u16) 命令ID(u32) 亮度(u16) 颜色(u8)]
+#   CHILDREN      网桥 -> 服务器  数量(u16) + 数量 x [名称长度(u8) UTF-8 名称]，槽位按注册顺序递增
+#   COMMAND       服务器 -> 设备  命令ID(u32) 亮度(u16) 颜色(u8)
+#   CHILD_COMMAND 服务器 -> 网桥  槽位(u16) 命令ID(u32) 亮度(u16) 颜色(u8)
+#   PING / PONG   只有帧头
+import struct
+
+PROTO_TEXT = "text"
+PROTO_BIN1 = "bin1"
+VERSION = 1
+
+STATUS = 0x01
+STATUS_BATCH = 0x02
+CHILDREN = 0x03
+COMMAND = 0x10
+CHILD_COMMAND = 0x11
+PING = 0x20
+PONG = 0x21
+
+HEADER = struct.Struct("!BB")
+COUNT = struct.Struct("!H")
+STATE = struct.Struct("!IHB")  # 命令ID, 亮度, 颜色
+SLOT_STATE = struct.Struct("!HIHB")  # 槽位, 命令ID, 亮度, 颜色
+
+# 颜色枚举表：索引即线上编码
+COLORS = ("off", "Red", "Green", "Blue", "White", "Yellow", "Purple", "Orange", "Cyan", "Pink")
+_COLOR_INDEX = {name.lower(): index for index, name in enumerate(COLORS)}
+
+PING_FRAME = HEADER.pack(VERSION, PING)
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+def parse_registration(message):
+    """
+    解析注册消息 "DEVICE_NAME:<名称>[;key=value...]"。
+    :return: (设备名称, 参数字典)
+    """
+    body = message.split(":", 1)[1]
+    parts = body.split(";")
+    params = {}
+    for part in parts[1:]:
+        if "=" in part:
+            key, value = part.split("=", 1)
+            params[key.strip()] = value.strip()
+    return parts[0].strip(), params
+
+
+def encode_text_command(command, command_id):
+    """
+    文本命令附带命令 ID："Red 80" -> "Red 80;id=12"（只发送给注册时声明 ids=1 的设备）。
+    """
+    return f"{command};id={command_id}"
+
+
+def parse_status(message):
+    """
+    解析文本 STATUS 消息 "STATUS:brightness=..,color=..[,id=..]"。
+    :return: (brightness, color, command_id)，缺失的字段为 None
+    """
+    brightness = None
+    color = None
+    command_id = None
+    for item in message[len("STATUS:"):].split(","):
+        key, value = item.split("=")
+        key = key.strip()
+        value = value.strip()
+        if key == "brightness":
+            brightness = int(value)
+        elif key == "color":
+            color = value
+        elif key == "id":
+            command_id = int(value)
+    return brightness, color, command_id
+
+
+def color_code(color):
+    """
+    返回颜色的枚举编码；不在颜色表中的颜色返回 None（需要退回文本协议）。
+    """
+    return _COLOR_INDEX.get(str(color).lower())
+
+
+def color_name(code):
+    if code >= len(COLORS):
+        raise ProtocolError(f"Unknown color code {code}")
+    return COLORS[code]
+
+
+def encode_command(command_id, brightness, color, slot=None):
+    """
+    编码二进制命令帧；颜色或亮度无法编码时返回 None。
+    :param slot: 网桥子设备的槽位；None 表示直接连接的设备
+    """
+    code = color_code(color)
+    if code is None or not 0 <= brightness <= 0xFFFF:
+        return None
+    command_id &= 0xFFFFFFFF
+    if slot is None:
+        return HEADER.pack(VERSION, COMMAND) + STATE.pack(command_id, brightness, code)
+    return HEADER.pack(VERSION, CHILD_COMMAND) + SLOT_STATE.pack(slot, command_id, brightness, code)
+
+
+def decode_frame(data):
+    """
+    解码设备发来的二进制帧。
+    :return: (帧类型, 内容)。STATUS 内容为 (command_id, brightness, color)；
+             STATUS_BATCH 内容为 [(slot, command_id, brightness, color), ...]；
+             CHILDREN 内容为名称列表；PING / PONG 内容为 None
+    """
+    if len(data) < HEADER.size:
+        raise ProtocolError("Frame too short")
+    version, frame_type = HEADER.unpack_from(data, 0)
+    if version != VERSION:
+        raise ProtocolError(f"Unsupported protocol version {version}")
+    offset = HEADER.size
+
+    if frame_type == STATUS:
+        command_id, brightness, code = STATE.unpack_from(data, offset)
+        return STATUS, (command_id or None, brightness, color_name(code))
+
+    if frame_type == STATUS_BATCH:
+        (count,) = COUNT.unpack_from(data, offset)
+        offset += COUNT.size
+        if len(data) < offset + count * SLOT_STATE.size:
+            raise ProtocolError("Truncated STATUS_BATCH frame")
+        entries = []
+        for slot, command_id, brightness, code in SLOT_STATE.iter_unpack(data[offset:offset + count * SLOT_STATE.size]):
+            entries.append((slot, command_id or None, brightness, color_name(code)))
+        return STATUS_BATCH, entries
+
+    if frame_type == CHILDREN:
+        (count,) = COUNT.unpack_from(data, offset)
+        offset += COUNT.size
+        names = []
+        for _ in range(count):
+            if offset >= len(data):
+                raise ProtocolError("Truncated CHILDREN frame")
+            length = data[offset]
+            offset += 1
+            if offset + length > len(data):
+                raise ProtocolError("Truncated CHILDREN frame")
+            try:
+                names.append(bytes(data[offset:offset + length]).decode("utf-8"))
+            except UnicodeDecodeError as e:
+                raise ProtocolError(f"Invalid device name in CHILDREN frame: {e}") from e
+            offset += length
+        return CHILDREN, names
+
+    if frame_type in (PING, PONG):
+        return frame_type, None
+
+    raise ProtocolError(f"Unknown frame type {frame_type}")
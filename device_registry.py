@@ -0,0 +1,318 @@
+#device_registry.py
+# 设备注册表：用 __slots__ 记录保存每个设备的连接和状态，名称 -> 索引映射提供 O(1) 查找。
+# 每次状态变化分配单调递增的版本号并标记为脏，推送时只遍历发生变化的设备。
+#
+# 并发约定：注册表只在事件循环线程中通过同步方法修改，方法内部没有 await，
+# 因此不需要任何锁；调用方不要在两次 await 之间缓存记录的状态。
+from collections import deque
+
+HISTORY_SIZE = 1024  # 保留的变更记录条数，超出后落后太多的客户端需要完整快照
+
+
+class DeviceRecord:
+    __slots__ = ("name", "index", "websocket", "actor", "status", "brightness", "color", "version", "dirty", "restored")
+
+    def __init__(self, name, index):
+        self.name = name
+        self.index = index
+        self.websocket = None
+        self.actor = None
+        self.status = "offline"
+        self.brightness = 0
+        self.color = "off"
+        self.version = 0
+        self.dirty = False
+        self.restored = False  # 从快照恢复、设备尚未重新连接
+
+    def as_dict(self):
+        """
+        转换为推送给客户端的记录格式。
+        """
+        return {
+            "device_name": self.name,
+            "status": self.status,
+            "brightness": self.brightness,
+            "color": self.color,
+        }
+
+
+def removed_record(name):
+    """
+    已移除设备的记录（保持与旧协议一致：离线、亮度 0、颜色 off）。
+    """
+    return {
+        "device_name": name,
+        "status": "offline",
+        "brightness": 0,
+        "color": "off",
+        "removed": True,
+    }
+
+
+class DeviceRegistry:
+    """
+    所有已连接设备的唯一数据源。
+    """
+
+    def __init__(self, history_size=HISTORY_SIZE):
+        self.version = 0
+        self._records = []  # 索引 -> DeviceRecord（空闲槽位为 None）
+        self._index = {}  # 设备名称 -> 索引
+        self._free = []  # 可复用的空闲索引
+        self._dirty = {}  # 待推送的脏记录：设备名称 -> DeviceRecord
+        self._removed = set()  # 待推送的已移除设备名称
+        self._history = deque(maxlen=history_size)  # (版本号, 设备名称)
+        self._floor = 0  # 历史能够回答的最早版本：早于它的客户端需要完整快照
+        self._listeners = []
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def __iter__(self):
+        """
+        按索引顺序遍历当前所有设备记录。
+        """
+        return (record for record in self._records if record is not None)
+
+    def get(self, name):
+        index = self._index.get(name)
+        if index is None:
+            return None
+        return self._records[index]
+
+    def names(self):
+        return list(self._index)
+
+    def add_listener(self, listener):
+        """
+        注册变更监听函数 listener(record, removed)，每次版本号变化时同步调用。
+        """
+        self._listeners.append(listener)
+
+    def _allocate(self, name):
+        if self._free:
+            index = self._free.pop()
+        else:
+            index = len(self._records)
+            self._records.append(None)
+        record = DeviceRecord(name, index)
+        self._records[index] = record
+        self._index[name] = index
+        self._removed.discard(name)
+        return record
+
+    def add(self, name, websocket=None, actor=None):
+        """
+        登记设备并重置其状态；同名设备已存在时复用原记录。
+        """
+        record = self.get(name)
+        if record is None:
+            record = self._allocate(name)
+        else:
+            record.status = "offline"
+            record.brightness = 0
+            record.color = "off"
+        record.websocket = websocket
+        record.actor = actor
+        record.restored = False
+        self._changed(record)
+        return record
+
+    def attach(self, name, websocket, actor):
+        """
+        设备重新连接时，如果存在从快照恢复的记录，只绑定连接并保留其状态（不分配新版本号，客户端看不到变化）。
+        :return: 绑定的记录；没有可复用的恢复记录时返回 None
+        """
+        record = self.get(name)
+        if record is None or not record.restored:
+            return None
+        record.websocket = websocket
+        record.actor = actor
+        record.restored = False
+        return record
+
+    def restore(self, version, devices):
+        """
+        从快照恢复版本号和设备状态（启动时、开始监听之前调用，不通知监听函数）。
+        :param devices: [{"device_name", "status", "brightness", "color", "version"}]
+        """
+        for entry in devices:
+            record = self.get(entry["device_name"]) or self._allocate(entry["device_name"])
+            record.status = entry["status"]
+            record.brightness = entry["brightness"]
+            record.color = entry["color"]
+            record.version = entry.get("version", 0)
+            record.restored = True
+        self.version = max(self.version, version)
+        self._floor = self.version
+
+    def restored_names(self):
+        """
+        返回从快照恢复、但设备尚未重新连接的设备名称。
+        """
+        return [record.name for record in self if record.restored]
+
+    def remove(self, name, websocket=None):
+        """
+        移除设备。指定 websocket 时只有记录仍属于该连接才会移除（同名设备可能已经重连）。
+        :return: 被移除的记录；没有移除时返回 None
+        """
+        record = self.get(name)
+        if record is None or (websocket is not None and record.websocket is not websocket):
+            return None
+        self._drop(record)
+        self._bump(name)
+        for listener in self._listeners:
+            listener(record, True)
+        return record
+
+    def update(self, name, status=None, brightness=None, color=None):
+        """
+        更新设备状态；只有值确实变化时才分配新版本号。
+        :return: 状态是否发生了变化
+        """
+        record = self.get(name)
+        if record is None:
+            return False
+        changed = False
+        if status is not None and status != record.status:
+            record.status = status
+            changed = True
+        if brightness is not None and brightness != record.brightness:
+            record.brightness = brightness
+            changed = True
+        if color is not None and str(color).lower() != str(record.color).lower():
+            record.color = color
+            changed = True
+        if changed:
+            self._changed(record)
+        return changed
+
+    def _remember(self, version, name):
+        if len(self._history) == self._history.maxlen:
+            self._floor = self._history[0][0]
+        self._history.append((version, name))
+
+    def _bump(self, name):
+        self.version += 1
+        self._remember(self.version, name)
+        return self.version
+
+    def _mark_dirty(self, record):
+        if not record.dirty:
+            record.dirty = True
+            self._dirty[record.name] = record
+
+    def _drop(self, record):
+        del self._index[record.name]
+        self._records[record.index] = None
+        self._free.append(record.index)
+        if record.dirty:
+            record.dirty = False
+            del self._dirty[record.name]
+        self._removed.add(record.name)
+
+    def _set_state(self, record, entry, version):
+        record.status = entry["status"]
+        record.brightness = entry["brightness"]
+        record.color = entry["color"]
+        record.version = version
+        self._mark_dirty(record)
+
+    def _changed(self, record):
+        record.version = self._bump(record.name)
+        self._mark_dirty(record)
+        for listener in self._listeners:
+            listener(record, False)
+
+    def take_dirty(self):
+        """
+        取出自上次调用以来发生变化的设备记录（含已移除设备），并清除脏标记。
+        """
+        updates = []
+        for record in self._dirty.values():
+            record.dirty = False
+            updates.append(record.as_dict())
+        updates.extend(removed_record(name) for name in self._removed)
+        self._dirty = {}
+        self._removed = set()
+        return updates
+
+    def changes_since(self, version):
+        """
+        返回指定版本之后的变更（每个设备只保留当前状态）。
+        :param version: 客户端已知的最新版本号
+        :return: 变更记录列表；历史不足以覆盖时返回 None，客户端应改用完整快照
+        """
+        if version == self.version:
+            return []
+        if version < 0 or version > self.version or version < self._floor:
+            return None
+
+        names = []
+        seen = set()
+        for entry_version, name in reversed(self._history):
+            if entry_version <= version:
+                break
+            if name not in seen:
+                seen.add(name)
+                names.append(name)
+        updates = []
+        for name in reversed(names):
+            record = self.get(name)
+            updates.append(record.as_dict() if record is not None else removed_record(name))
+        return updates
+
+    # ---- 多进程模式：工作进程中的注册表副本，版本号与主进程一致 ----
+    # 副本的变更不通知监听函数（操作日志只由主进程写入），调用方随后立即推送脏记录。
+
+    def apply(self, since, version, updates):
+        """
+        应用主进程推送的一次增量。
+        :param since: 增量的起始版本，必须等于副本当前的版本
+        :param updates: 变更记录列表（格式同 take_dirty）
+        :return: 是否已应用；False 表示与副本不衔接，需要重新同步
+        """
+        if since != self.version or version < since:
+            return False
+        for entry in updates:
+            name = entry["device_name"]
+            record = self.get(name)
+            if entry.get("removed"):
+                if record is not None:
+                    self._drop(record)
+                else:
+                    self._removed.add(name)
+            else:
+                self._set_state(record or self._allocate(name), entry, version)
+            self._remember(version, name)
+        self.version = version
+        return True
+
+    def replace(self, version, devices):
+        """
+        用主进程的完整状态替换副本（首次同步或增量不衔接时）。历史从该版本重新开始。
+        :param devices: [{"device_name", "status", "brightness", "color", "version"}]
+        """
+        names = set()
+        for entry in devices:
+            name = entry["device_name"]
+            names.add(name)
+            record = self.get(name)
+            if record is None or (record.status, record.brightness, record.color) != (entry["status"], entry["brightness"], entry["color"]):
+                self._set_state(record or self._allocate(name), entry, entry.get("version", version))
+        for record in list(self):
+            if record.name not in names:
+                self._drop(record)
+        self.version = version
+        self._history.clear()
+        self._floor = version
+
+    def snapshot(self):
+        """
+        返回所有设备的当前记录。
+        """
+        return [record.as_dict() for record in self]
@@ -1,183 +1,238 @@
 import asyncio
+import logging
+import struct
 import websockets
-from shared_data import connected_clients, device_states
-from asyncio import Lock
-from notifier import notify_websocket_clients
-from tasktracker import check_tasks_5_to_7
+from admission import admission, AdmissionRejected, RegistrationBatcher
+from shared_data import registry
+from device_actor import DeviceActor
+from heartbeat import heartbeat
+from config import DEVICE_PORT
+from logging_setup import payloads_enabled
+from device_protocol import (
+    PROTO_TEXT, PROTO_BIN1, VERSION, HEADER, STATUS, STATUS_BATCH, CHILDREN, PING, PONG,
+    ProtocolError, decode_frame, parse_registration, parse_status,
+)
+
+logger = logging.getLogger(__name__)
+
+bridges = {}  # 在线网桥：名称 -> 连接（网桥没有注册表记录）
+
+def device_actor(device_name):
+    """
+    返回已连接设备的 Actor；设备未连接时返回 None。
+    """
+    record = registry.get(device_name)
+    return record.actor if record is not None else None
 
-lock = Lock()  # 全局锁，确保字典安全更新
+def is_direct_device(device_name):
+    """
+    判断名称是否属于一个仍在线、直接连接的设备或网桥。网桥子设备不能覆盖这类设备。
+    """
+    if device_name in bridges:
+        return True
+    actor = device_actor(device_name)
+    return actor is not None and not actor.closed and actor.slot is None
+
+def register_device(device_name, websocket, protocol=PROTO_TEXT, slot=None, echo_ids=False):
+    """
+    登记新连接的设备（或网桥子设备），创建其 Actor 并重置状态。
+    服务器重启后重新连接的设备保留快照中恢复的状态，之后由设备上报的 STATUS 校正。
+    注册表的修改会自动进入推送合并窗口。
+    """
+    old_record = registry.get(device_name)
+    if old_record is not None and old_record.actor is not None:
+        old_record.actor.close()
+    actor = DeviceActor(device_name, websocket, protocol, slot, echo_ids)
+    if registry.attach(device_name, websocket, actor) is None:
+        registry.add(device_name, websocket, actor)
+    return actor
+
+# 非网桥设备的注册经批处理器完成：一批注册在同一次回调中修改注册表，合并为一次推送
+registrations = RegistrationBatcher(register_device, admission)
+
+def unregister_device(device_name, websocket):
+    """
+    清理断开的设备（同名设备可能已经重新连接，只清理属于本连接的资源）。
+    :return: 是否确实清理了该设备
+    """
+    record = registry.remove(device_name, websocket)
+    if record is None:
+        return False
+    if record.actor is not None:
+        record.actor.close()
+    return True
 
 # WebSocket 事件处理
-async def handler(websocket, path):
+async def handler(websocket, path=None):
     device_name = None
+    actor = None
+    children = []  # 网桥的子设备名称，按槽位排列
     try:
-        print("New device attempting to connect...")
-        # 等待设备发送其名称
-        device_name = await websocket.recv()
-        if not device_name.startswith("DEVICE_NAME:"):
-            print(f"Invalid registration message: {device_name}")
-            await websocket.close()
-            return
-
-        device_name = device_name.split(":", 1)[1].strip()
-        client_ip = websocket.remote_address[0]
-
-        async with lock:  # 线程安全地更新设备列表
-            connected_clients[device_name] = websocket
-            device_states[device_name] = {
-                "status": "offline",
-                "brightness": 0,
-                "color": "off",
-            }
-        print(f"Device '{device_name}' connected with IP: {client_ip}")
-
-        # 通知 WebSocket 客户端新设备已连接
-        await notify_websocket_clients(device_states)
-
-        # 监听消息并发送心跳
-        while True:
-            pong_task = None
-            try:
-                await asyncio.sleep(5)  # 每隔 1 秒发送一次心跳
-                print(f"Sending PING to {device_name}...")
-                await websocket.send("PING")  # 主动发送 PING 消息
-
-                # 等待设备的消息（包括状态更新或 PONG 响应）
-                pong_task = asyncio.create_task(websocket.recv())
-                done, pending = await asyncio.wait([pong_task], timeout=5)
-
-                if pong_task in done:
-                    response = pong_task.result()
-                    if response.startswith("STATUS:"):
-                        # 解析设备状态
-                        await process_device_status(device_name, response)
-                    else:
-                        print(f"Unexpected response from '{device_name}': {response}")
-                else:
-                    print(f"Device '{device_name}' unresponsive. Disconnecting...")
-                    break
-
-            except websockets.exceptions.ConnectionClosedOK:
-                print(f"Device '{device_name}' closed connection gracefully.")
-                break
-            except asyncio.TimeoutError:
-                print(f"Device '{device_name}' timed out. Disconnecting...")
-                break
-            except Exception as e:
-                print(f"Unexpected error for '{device_name}': {e}")
-                break
-            finally:
-                # 清理未完成的任务
-                if pong_task:
-                    pong_task.cancel()
-                    try:
-                        await pong_task
-                    except asyncio.CancelledError:
-                        pass
-
+        logger.debug("New device attempting to connect...")
+        # 准入控制：限制同时进行的注册握手数量和注册速率，非网桥设备的注册按批处理
+        async with admission.handshake():
+            # 等待设备发送其名称
+            registration = await asyncio.wait_for(websocket.recv(), admission.timeout)
+            if not isinstance(registration, str) or not registration.startswith("DEVICE_NAME:"):
+                logger.warning("Invalid registration message: %r", registration)
+                await websocket.close()
+                return
+
+            device_name, params = parse_registration(registration)
+            protocol = PROTO_BIN1 if params.get("proto") == PROTO_BIN1 else PROTO_TEXT
+            is_bridge = params.get("bridge") == "1"
+            echo_ids = params.get("ids") == "1"
+            client_ip = websocket.remote_address[0]
+
+            if protocol == PROTO_BIN1:
+                await websocket.send(f"PROTO:{PROTO_BIN1}")
+
+            if is_bridge:
+                # 网桥本身不是灯具，只负责心跳；子设备通过 CHILDREN 帧注册
+                actor = DeviceActor(device_name, websocket, protocol)
+                bridges[device_name] = websocket
+                logger.info("Bridge '%s' connected with IP: %s (%s)", device_name, client_ip, protocol)
+            else:
+                actor = await registrations.submit(device_name, websocket, protocol, None, echo_ids)
+                logger.info("Device '%s' connected with IP: %s (%s)", device_name, client_ip, protocol)
+
+        # 持续读取设备消息：STATUS 到达后立即处理；心跳由共享的调度器负责
+        heartbeat.add(actor)
+        async for message in websocket:
+            actor.touch()
+            if isinstance(message, bytes):
+                await process_binary_frame(device_name, websocket, message, children)
+            elif message.startswith("STATUS:") and not is_bridge:
+                # 解析设备状态
+                await process_device_status(device_name, message)
+            elif message != "PONG":
+                logger.warning("Unexpected response from '%s': %r", device_name, message, extra={"rate_key": "unexpected_message"})
+        logger.info("Device '%s' closed connection gracefully.", device_name)
+
+    except (AdmissionRejected, asyncio.TimeoutError) as e:
+        # 设备固件会在连接关闭后重试；1013 = Try Again Later
+        logger.warning("Rejected device connection from %s: %s", websocket.remote_address[0], str(e) or "registration timed out", extra={"rate_key": "admission_rejected"})
+        await websocket.close(code=1013, reason="Try again later")
     except websockets.exceptions.ConnectionClosed:
-        print(f"Device '{device_name}' disconnected.")
+        logger.info("Device '%s' disconnected.", device_name)
     finally:
-        # 清理断开的设备
-        async with lock:
-            if device_name in connected_clients:
-                del connected_clients[device_name]
-            if device_name in device_states:
-                del device_states[device_name]
-        await notify_websocket_clients(device_states)
-        print(f"Cleaned up resources for '{device_name}'.")
+        for name in children + [device_name]:
+            unregister_device(name, websocket)
+        if actor is not None:
+            actor.close()
+            if is_bridge and bridges.get(device_name) is websocket:
+                del bridges[device_name]
+        logger.debug("Cleaned up resources for '%s'.", device_name)
 
 # 处理设备状态更新
 async def process_device_status(device_name, response):
+    """
+    解析 STATUS 消息并交给设备 Actor 处理。
+    注册时声明 ids=1 的设备在 STATUS 中附带 id=<命令 ID>，用于精确匹配命令确认；
+    其他设备按（颜色, 亮度）匹配。
+    """
     try:
-        print(f"Processing status update from '{device_name}': {response}")
-        status_data = response[len("STATUS:"):].split(",")
-        brightness = None
-        color = None
-
-        for item in status_data:
-            key, value = item.split("=")
-            key = key.strip()
-            value = value.strip()
-            if key == "brightness":
-                brightness = int(value)
-            elif key == "color":
-                color = value
-
-        if brightness is not None and color is not None:
-            async with lock:
-                device_states[device_name]["brightness"] = brightness
-                device_states[device_name]["color"] = color
-            print(f"Updated state for '{device_name}': {device_states[device_name]}")
-            await notify_websocket_clients(device_states)  # 推送更新到 WebSocket 客户端
+        if payloads_enabled():
+            logger.debug("Processing status update from '%s': %s", device_name, response, extra={"rate_key": "status_payload"})
+        brightness, color, command_id = parse_status(response)
+
+        actor = device_actor(device_name)
+        if brightness is not None and color is not None and actor is not None:
+            await actor.on_status(brightness, color, command_id)
         else:
-            print(f"Incomplete status data from '{device_name}': {response}")
+            logger.warning("Incomplete status data from '%s': %r", device_name, response, extra={"rate_key": "bad_status"})
     except Exception as e:
-        print(f"Error parsing STATUS from '{device_name}': {e}")
+        logger.warning("Error parsing STATUS from '%s': %s", device_name, e, extra={"rate_key": "bad_status"})
+
+# 处理二进制帧
+async def process_binary_frame(device_name, websocket, data, children):
+    """
+    处理 bin1 协议的二进制帧。网桥可以在一个 STATUS_BATCH 帧中上报多个子设备的状态。
+    :param children: 该连接上已注册的子设备名称列表（按槽位），CHILDREN 帧会追加
+    """
+    try:
+        frame_type, payload = decode_frame(data)
+    except (ProtocolError, struct.error) as e:
+        logger.warning("Invalid binary frame from '%s': %s", device_name, e, extra={"rate_key": "bad_frame"})
+        return
+
+    if frame_type == STATUS:
+        command_id, brightness, color = payload
+        actor = device_actor(device_name)
+        if actor is not None:
+            await actor.on_status(brightness, color, command_id)
+    elif frame_type == STATUS_BATCH:
+        for slot, command_id, brightness, color in payload:
+            if slot >= len(children):
+                logger.warning("Unknown slot %d in STATUS_BATCH from '%s'.", slot, device_name, extra={"rate_key": "bad_frame"})
+                continue
+            actor = device_actor(children[slot])
+            if actor is not None and actor.websocket is websocket:
+                await actor.on_status(brightness, color, command_id)
+    elif frame_type == CHILDREN:
+        registered = 0
+        for child_name in payload:
+            # 槽位按注册顺序递增，被拒绝的名称也占用一个槽位（该槽位的状态会被忽略）
+            if is_direct_device(child_name):
+                logger.warning("Bridge '%s' child '%s' collides with a connected device; ignoring it.",
+                               device_name, child_name)
+            else:
+                register_device(child_name, websocket, PROTO_BIN1, slot=len(children))
+                registered += 1
+            children.append(child_name)
+        logger.info("Bridge '%s' registered %d device(s).", device_name, registered)
+    elif frame_type == PING:
+        await websocket.send(HEADER.pack(VERSION, PONG))
 
 # 向指定设备发送命令
-async def send_command_to_device(device_name, command):
+def dispatch_command(device_name, command, coalesce=None, session_id=None):
+    """
+    将命令放入目标设备 Actor 的队列。
+
+    :param device_name: Name of the target device
+    :param command: Command to send to the device
+    :param coalesce: Latest-wins mode for this command (None uses the server default)
+    :param session_id: Experiment session that issued the command
+    :return: DeviceCommand, or None if the device is not connected
+    """
+    actor = device_actor(device_name)
+    if actor is None:
+        return None
+    return actor.submit(command, coalesce, session_id)
+
+async def send_command_to_device(device_name, command, wait_ack=False, coalesce=None, session_id=None):
     """
     Sends a command to a specific connected device and updates its state proactively.
+    Only the target device's actor is involved, so commands to different devices run in parallel.
 
     :param device_name: Name of the target device
     :param command: Command to send to the device
-    :return: A status message
-    """
-    async with lock:
-        if device_name not in connected_clients:
-            return f"Error: Device '{device_name}' not connected."
-
-        try:
-            # 发送命令到设备
-            await connected_clients[device_name].send(command)
-            print(f"Command '{command}' sent to '{device_name}'")
-
-            # 模拟主动状态更新
-            # 解析命令并更新设备状态
-            brightness, color = parse_command(command)
-            device_states[device_name]["brightness"] = brightness
-            device_states[device_name]["color"] = color
-
-            print(f"Updated state for '{device_name}': {device_states[device_name]}")
-            
-            await check_tasks_5_to_7(device_name, brightness, color)
-            # 通知前端状态变化
-            await notify_websocket_clients(device_states)
-
-            return f"Success: Command '{command}' sent to '{device_name}'."
-        except websockets.exceptions.ConnectionClosed:
-            print(f"Failed to send command. Device '{device_name}' disconnected.")
-            del connected_clients[device_name]
-            del device_states[device_name]
-            return f"Error: Failed to send command. Device '{device_name}' disconnected."
-            
-def parse_command(command):
-    """
-    Parses the command string and extracts brightness and color.
-
-    :param command: Command string in the format "COLOR BRIGHTNESS".
-    :return: (brightness, color) tuple.
+    :param wait_ack: Also wait for the device's STATUS acknowledgment
+    :param coalesce: Latest-wins mode: a newer command for the same attribute replaces this one
+    :param session_id: Experiment session that issued the command
+    :return: A status message ("Success", "Superseded" or "Error")
     """
-    try:
-        parts = command.split()
-        if len(parts) == 2:
-            color = parts[0]
-            brightness = int(parts[1])
-            return brightness, color
-    except Exception as e:
-        print(f"[Error] Failed to parse command: {e}")
-    # 如果解析失败，返回默认值
-    return 0, "off"
+    cmd = dispatch_command(device_name, command, coalesce, session_id)
+    if cmd is None:
+        return f"Error: Device '{device_name}' not connected."
+
+    result = await cmd.sent
+    if wait_ack and result.startswith("Success"):
+        ack = await cmd.acked
+        if ack == "acked":
+            result += f" Acknowledged in {cmd.rtt * 1000:.1f} ms."
+        else:
+            result += f" Acknowledgment: {ack}."
+    return result
 
 
 
 # 启动 WebSocket 服务
-async def start_websocket_server():
-    print("Starting WebSocket server...")
+async def start_websocket_server(host="0.0.0.0", port=DEVICE_PORT):
+    logger.info("Starting WebSocket server...")
     server = await websockets.serve(
         handler,
-        "0.0.0.0",
-        8765,
+        host,
+        port,
     )
     return server
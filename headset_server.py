@@ -1,60 +1,173 @@
-import asyncio
+import logging
+import time
 from aiohttp import web, WSMsgType
+from broadcaster import Broadcaster
+from codec import loads, negotiate_encoding, hello_message
+from config import SEND_QUEUE_SIZE, HEADSET_QUEUE_POLICY, WS_COMPRESS
+from logging_setup import payloads_enabled
+from scheduler import update_scheduler
+from metrics import fanout_duration
+from history import device_history, query_window
+from tasktracker import DEFAULT_SESSION, get_session
 
-# 保存与头显的 WebSocket 连接
-headset_clients = set()
-lock = asyncio.Lock()  # 线程安全锁
+logger = logging.getLogger(__name__)
 
-async def push_task_list():
+
+def task_list_message(session_id):
+    """
+    构造包含会话完整任务列表的快照消息（带版本号）。
+    """
+    session = get_session(session_id)
+    return {
+        "type": "task_update",
+        "session": session.session_id,
+        "version": session.version,
+        "full": True,
+        "data": [dict(task) for task in session.task_list],
+    }
+
+
+def task_patch_message(session_id, since, updates):
+    """
+    构造增量消息：只包含版本 since 之后状态发生变化的任务。
+    """
+    return {
+        "type": "task_patch",
+        "session": session_id,
+        "since": since,
+        "version": get_session(session_id).version,
+        "data": updates,
+    }
+
+
+def task_sync_message(session_id, since):
     """
-    将任务列表推送给所有已连接的头显客户端。
+    根据头显已知的版本号返回增量消息；历史不足时退回完整快照。
     """
-    from tasktracker import get_task_list  # 动态导入，避免循环依赖
-    task_list = get_task_list()  # 获取任务列表
+    updates = get_session(session_id).changes_since(since)
+    if updates is None:
+        return task_list_message(session_id)
+    return task_patch_message(session_id, since, updates)
 
-    if not headset_clients:
-        print("[Info] No headset connected. Skipping push.")
-        return
 
-    message = {"type": "task_update", "data": task_list}
-    async with lock:
-        disconnected_clients = []
-        for ws in headset_clients:
-            try:
-                await ws.send_json(message)
-                print(f"[Info] Task list pushed to headset: {message}")
-            except Exception as e:
-                print(f"[Error] Failed to send task list to headset: {e}")
-                disconnected_clients.append(ws)
+# 保存与头显的 WebSocket 连接：会话 ID -> 该会话头显的广播器（每个头显有独立的发送队列）
+headset_clients = {}
 
-        # 移除断开的客户端
-        for ws in disconnected_clients:
-            headset_clients.discard(ws)
-            print("[Info] Disconnected headset removed.")
+def session_clients(session_id):
+    """
+    返回会话的头显广播器，不存在时创建。
+    """
+    clients = headset_clients.get(session_id)
+    if clients is None:
+        clients = Broadcaster(
+            f"headset:{session_id}", SEND_QUEUE_SIZE, HEADSET_QUEUE_POLICY,
+            snapshot=lambda: task_list_message(session_id),
+        )
+        headset_clients[session_id] = clients
+    return clients
+
+def flush_task_lists(session_ids):
+    """
+    合并窗口结束时调用：只把状态发生变化的任务推送给对应会话的头显（只入队，不等待发送完成）。
+    """
+    for session_id in session_ids:
+        since, updates = get_session(session_id).take_dirty()
+        if not updates:
+            continue
+        clients = headset_clients.get(session_id)
+        if not clients:
+            logger.debug("No headset connected to session '%s'. Skipping push.", session_id)
+            continue
+        started = time.perf_counter()
+        delivered = clients.publish(task_patch_message(session_id, since, updates))
+        fanout_duration.observe(time.perf_counter() - started, "tasks")
+        logger.debug("%d task change(s) of session '%s' queued for %d headset(s).", len(updates), session_id, delivered, extra={"rate_key": "headset_push"})
+
+
+update_scheduler.register("tasks", flush_task_lists)
+
+
+def push_task_list(session_id=None):
+    """
+    记录会话的任务列表变更，合并窗口结束时统一推送给该会话的头显。
+    """
+    update_scheduler.mark("tasks", [session_id or DEFAULT_SESSION])
+
+def headset_stats():
+    return {session_id: clients.stats() for session_id, clients in headset_clients.items()}
+
+def device_history_message(request):
+    device = request.get("device")
+    try:
+        since, until, step = query_window(request.get("since"), request.get("until"), request.get("step"))
+    except (TypeError, ValueError) as e:
+        return {"type": "device_history", "device": device, "error": str(e)}
+    result = device_history.query(device, since, until, step) if isinstance(device, str) else None
+    if result is None:
+        return {"type": "device_history", "device": device, "error": "No history for this device."}
+    return dict(result, type="device_history")
+
+def handle_headset_message(clients, ws, session_id, data):
+    """
+    处理头显请求：{"type": "sync", "since": N} 获取增量，{"type": "snapshot"} 获取完整快照，
+    {"type": "history", "device": 名称, "since": 时间, "step": 秒} 获取设备状态历史（用于趋势叠加显示），
+    {"type": "hello", "encoding": "compact" | "msgpack"} 切换之后消息的编码（回复 hello 和一次完整任务列表）。
+    """
+    try:
+        request = loads(data)
+    except ValueError:
+        request = None
+    if isinstance(request, dict) and request.get("type") == "sync" and isinstance(request.get("since"), int):
+        clients.send(ws, task_sync_message(session_id, request["since"]))
+    elif isinstance(request, dict) and request.get("type") == "snapshot":
+        clients.send(ws, task_list_message(session_id))
+    elif isinstance(request, dict) and request.get("type") == "hello":
+        encoding = negotiate_encoding(request.get("encoding"))
+        clients.set_encoding(ws, encoding)
+        clients.send(ws, hello_message(encoding))
+        clients.send(ws, task_list_message(session_id))
+    elif isinstance(request, dict) and request.get("type") == "history":
+        clients.send(ws, device_history_message(request))
+    elif payloads_enabled():
+        logger.debug("Received from headset: %s", data)
 
 async def websocket_handler(request):
     """
-    处理头显客户端的 WebSocket 连接。
+    处理头显客户端的 WebSocket 连接。头显通过 ?session=<会话 ID> 绑定会话，
+    只接收该会话的任务更新；重连的头显可以通过 ?since=N 只获取版本 N 之后的变化，
+    通过 ?encoding=compact / msgpack 选择更紧凑的消息编码（默认 JSON）。
     """
-    ws = web.WebSocketResponse()
+    session_id = request.query.get("session") or DEFAULT_SESSION
+    # 会话只能通过 POST /sessions 创建；未知的会话不建立连接
+    if get_session(session_id) is None:
+        return web.json_response({"status": "error", "message": f"Session '{session_id}' not found."}, status=404)
+    ws = web.WebSocketResponse(compress=bool(WS_COMPRESS))
     await ws.prepare(request)
 
-    async with lock:
-        headset_clients.add(ws)
-    print("[Info] Headset connected.")
+    clients = session_clients(session_id)
+    # 先推送窗口中等待的变化，再登记新头显并只向它发送快照或增量，避免它收到早于快照的增量
+    update_scheduler.flush()
+    clients.add(ws, request.remote, negotiate_encoding(request.query.get("encoding")))
+    since = request.query.get("since")
+    if since is not None and since.isdigit():
+        clients.send(ws, task_sync_message(session_id, int(since)))
+    else:
+        clients.send(ws, task_list_message(session_id))
+    logger.info("Headset connected to session '%s'.", session_id)
 
     try:
         async for msg in ws:
             if msg.type == WSMsgType.TEXT:
-                print(f"[Info] Received from headset: {msg.data}")
+                handle_headset_message(clients, ws, session_id, msg.data)
             elif msg.type == WSMsgType.ERROR:
-                print(f"[Error] WebSocket error: {ws.exception()}")
+                logger.warning("WebSocket error: %s", ws.exception())
     except Exception as e:
-        print(f"[Error] WebSocket connection error: {e}")
+        logger.warning("WebSocket connection error: %s", e)
     finally:
-        async with lock:
-            headset_clients.discard(ws)
-        print("[Info] Headset disconnected.")
+        clients.discard(ws)
+        if not clients and headset_clients.get(session_id) is clients:
+            del headset_clients[session_id]
+        logger.info("Headset disconnected from session '%s'.", session_id)
     return ws
 
 def start_headset_server():
@@ -0,0 +1,110 @@
+#heartbeat.py
+# 所有设备共用的心跳调度器：用一个最小堆按截止时间排列设备，
+# 只有一个任务负责发送 PING 和检测超时，而不是每个设备一个循环
+import asyncio
+import heapq
+import itertools
+import logging
+from config import HEARTBEAT_INTERVAL_MS, HEARTBEAT_TIMEOUT_MS
+
+logger = logging.getLogger(__name__)
+
+
+class HeartbeatScheduler:
+    """
+    设备空闲达到 interval 时发送 PING；空闲达到 interval + timeout 时断开连接。
+    设备的任何消息（STATUS、PONG 等）都会刷新其 last_seen。
+    """
+
+    def __init__(self, interval_ms, timeout_ms):
+        self.interval = interval_ms / 1000
+        self.timeout = timeout_ms / 1000
+        self._heap = []  # [截止时间, 序号, actor]；actor 为 None 表示条目已被移除
+        self._entries = {}  # actor -> 它在堆中的条目（每个设备最多一个）
+        self._counter = itertools.count()
+        self._wakeup = None
+        self._task = None
+        self.pings = 0
+        self.disconnects = 0
+
+    def add(self, actor):
+        """
+        开始跟踪设备的心跳。设备断开时应调用 discard()。
+        """
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = loop.create_task(self._run())
+        self._push(loop.time() + self.interval, actor)
+
+    def discard(self, actor):
+        """
+        停止跟踪设备：立即释放堆条目对 actor（及其连接）的引用，条目本身在到期时被丢弃。
+        """
+        entry = self._entries.pop(actor, None)
+        if entry is not None:
+            entry[2] = None
+
+    def _push(self, deadline, actor):
+        earliest = self._heap[0][0] if self._heap else None
+        entry = [deadline, next(self._counter), actor]
+        self._entries[actor] = entry
+        heapq.heappush(self._heap, entry)
+        if earliest is None or deadline < earliest:
+            self._wakeup.set()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._heap:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+
+            delay = self._heap[0][0] - loop.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                continue
+
+            _, _, actor = heapq.heappop(self._heap)
+            if actor is None:
+                continue
+            del self._entries[actor]
+            if actor.closed:
+                continue
+            try:
+                self._check(actor, loop.time())
+            except Exception as e:
+                logger.error("Heartbeat check failed for '%s': %s", actor.name, e)
+
+    def _check(self, actor, now):
+        idle = now - actor.last_seen
+        if idle >= self.interval + self.timeout:
+            logger.warning("Device '%s' unresponsive. Disconnecting...", actor.name)
+            self.disconnects += 1
+            asyncio.create_task(actor.websocket.close())
+            return
+
+        if idle >= self.interval:
+            if actor.last_ping < actor.last_seen:
+                logger.debug("Sending PING to %s...", actor.name, extra={"rate_key": "ping"})
+                actor.ping(now)
+                self.pings += 1
+            self._push(actor.last_seen + self.interval + self.timeout, actor)
+        else:
+            self._push(actor.last_seen + self.interval, actor)
+
+    def stats(self):
+        return {
+            "tracked": len(self._entries),
+            "pings": self.pings,
+            "disconnects": self.disconnects,
+        }
+
+
+# 全局心跳调度器
+heartbeat = HeartbeatScheduler(HEARTBEAT_INTERVAL_MS, HEARTBEAT_TIMEOUT_MS)
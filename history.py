@@ -0,0 +1,320 @@
+#history.py
+# 设备状态历史：每个设备一组定长环形缓冲区，按时间记录亮度、颜色和在线状态的变化。
+# 各级缓冲区分辨率不同（默认：原始变化 256 条、10 秒桶 1 小时、5 分钟桶 24 小时），
+# 每次变化同时写入所有级别，原始记录被覆盖后较早的数据仍保留在较粗的级别中，内存占用有固定上限。
+#
+# 每列是一个 array（时间 8 字节、亮度 / 最小 / 最大值各 2 字节、颜色和状态编码各 1 字节、变化次数 4 字节），
+# 按需增长到容量后循环覆盖。时间单调递增，范围查询用二分查找定位起点，不扫描整个缓冲区。
+# 设备从注册表移除超过保留时间后，其缓冲区被丢弃。
+import time
+from array import array
+from config import HISTORY_LEVELS, HISTORY_RETENTION_MS
+from device_protocol import COLORS
+from shared_data import registry
+
+UNKNOWN = 255  # 编码表已满时的编码
+
+
+class CodeTable:
+    """
+    字符串 <-> 单字节编码（不区分大小写），最多 255 个不同的值。
+    """
+
+    def __init__(self, values=()):
+        self.values = []
+        self.codes = {}
+        for value in values:
+            self.encode(value)
+
+    def encode(self, value):
+        key = str(value).lower()
+        code = self.codes.get(key)
+        if code is None:
+            if len(self.values) >= UNKNOWN:
+                return UNKNOWN
+            code = len(self.values)
+            self.codes[key] = code
+            self.values.append(str(value))
+        return code
+
+    def decode(self, code):
+        return self.values[code] if code < len(self.values) else None
+
+
+colors = CodeTable(COLORS)
+statuses = CodeTable(("offline", "online"))
+
+
+def _clamp_brightness(value):
+    try:
+        return max(-32768, min(32767, int(value)))
+    except (TypeError, ValueError):
+        return 0
+
+
+class Ring:
+    """
+    一个分辨率级别的环形缓冲区。resolution 为 0 时每次变化一条记录，
+    否则同一时间桶内的变化合并为一条：亮度取最后的值并记录最小 / 最大值。
+    """
+
+    __slots__ = ("resolution", "capacity", "start", "t", "value", "low", "high", "color", "status", "count")
+
+    def __init__(self, resolution, capacity):
+        self.resolution = resolution
+        self.capacity = capacity
+        self.start = 0  # 最旧条目的物理位置（写满之后才会移动）
+        self.t = array("d")
+        self.value = array("h")
+        self.low = array("h")
+        self.high = array("h")
+        self.color = array("B")
+        self.status = array("B")
+        self.count = array("I")
+
+    def __len__(self):
+        return len(self.t)
+
+    @property
+    def full(self):
+        return len(self.t) == self.capacity
+
+    def _pos(self, i):
+        """
+        逻辑序号（0 = 最旧）-> 物理位置。
+        """
+        pos = self.start + i
+        return pos - self.capacity if pos >= self.capacity else pos
+
+    def oldest(self):
+        return self.t[self.start] if self.t else None
+
+    def add(self, ts, brightness, color, status):
+        if self.resolution:
+            ts = ts - ts % self.resolution
+            if self.t:
+                last = self._pos(len(self.t) - 1)
+                if self.t[last] == ts:
+                    self.value[last] = brightness
+                    self.low[last] = min(self.low[last], brightness)
+                    self.high[last] = max(self.high[last], brightness)
+                    self.color[last] = color
+                    self.status[last] = status
+                    self.count[last] += 1
+                    return
+        if not self.full:
+            self.t.append(ts)
+            self.value.append(brightness)
+            self.low.append(brightness)
+            self.high.append(brightness)
+            self.color.append(color)
+            self.status.append(status)
+            self.count.append(1)
+            return
+        # 已满：覆盖最旧的条目
+        pos = self.start
+        self.start = pos + 1 if pos + 1 < self.capacity else 0
+        self.t[pos] = ts
+        self.value[pos] = brightness
+        self.low[pos] = brightness
+        self.high[pos] = brightness
+        self.color[pos] = color
+        self.status[pos] = status
+        self.count[pos] = 1
+
+    def bisect(self, ts):
+        """
+        返回第一个时间大于 ts 的逻辑序号。
+        """
+        lo, hi = 0, len(self.t)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.t[self._pos(mid)] <= ts:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def nbytes(self):
+        return sum(column.itemsize * len(column) for column in (self.t, self.value, self.low, self.high, self.color, self.status, self.count))
+
+
+def parse_levels(spec):
+    """
+    解析 "分辨率秒:条目数,..."，按分辨率从细到粗排序。
+    :raises ValueError: 格式错误
+    """
+    levels = []
+    for part in spec.split(","):
+        resolution, _, capacity = part.strip().partition(":")
+        resolution, capacity = float(resolution), int(capacity)
+        if resolution < 0 or capacity <= 0:
+            raise ValueError(f"Invalid history level {part!r}")
+        levels.append((resolution, capacity))
+    if not levels:
+        raise ValueError("No history levels configured")
+    return sorted(levels)
+
+
+def query_window(since=None, until=None, step=None):
+    """
+    解析查询参数（字符串或数字）。负的 since / until 表示相对现在的秒数，例如 since=-600 为最近 10 分钟。
+    :return: (since, until, step)
+    :raises ValueError: 参数不是数字或 step 为负
+    """
+    now = time.time()
+    window = []
+    for value in (since, until):
+        if value is None or value == "":
+            window.append(None)
+            continue
+        value = float(value)
+        window.append(now + value if value < 0 else value)
+    step = float(step) if step not in (None, "") else 0
+    if step < 0:
+        raise ValueError("'step' must not be negative.")
+    return window[0], window[1], step
+
+
+class DeviceHistory:
+    """
+    所有设备的状态历史。作为注册表监听函数记录每次变化（设备移除记为离线）。
+    """
+
+    def __init__(self, levels, retention=0):
+        """
+        :param levels: [(分辨率秒, 条目数), ...]，按分辨率从细到粗
+        :param retention: 设备移除后保留其历史的秒数
+        """
+        self.levels = levels
+        self.retention = retention
+        self._devices = {}  # 设备名称 -> [Ring, ...]（与 levels 顺序相同）
+        self._removed = {}  # 已移除的设备名称 -> 移除时间（按移除顺序）
+
+    def __contains__(self, name):
+        return name in self._devices
+
+    def record(self, name, brightness, color, status, ts=None):
+        rings = self._devices.get(name)
+        if rings is None:
+            rings = [Ring(resolution, capacity) for resolution, capacity in self.levels]
+            self._devices[name] = rings
+        ts = time.time() if ts is None else ts
+        brightness = _clamp_brightness(brightness)
+        color = colors.encode(color)
+        status = statuses.encode(status)
+        for ring in rings:
+            ring.add(ts, brightness, color, status)
+
+    def on_change(self, record, removed):
+        """
+        注册表监听函数。
+        """
+        now = time.time()
+        if removed:
+            self.record(record.name, 0, "off", "offline", now)
+            self._removed.pop(record.name, None)
+            self._removed[record.name] = now
+        else:
+            self._removed.pop(record.name, None)
+            self.record(record.name, record.brightness, record.color, record.status, now)
+        self.evict(now)
+
+    def evict(self, now=None):
+        """
+        丢弃移除时间早于保留期限的设备历史（重新注册的设备不会被丢弃）。
+        :return: 丢弃的设备数量
+        """
+        deadline = (time.time() if now is None else now) - self.retention
+        evicted = 0
+        while self._removed:
+            name = next(iter(self._removed))
+            if self._removed[name] > deadline:
+                break
+            del self._removed[name]
+            self._devices.pop(name, None)
+            evicted += 1
+        return evicted
+
+    def _select(self, rings, since, step):
+        """
+        选择覆盖 since 的级别：优先选择分辨率不超过 step 的最粗级别，其次是覆盖范围内最细的级别；
+        没有级别覆盖 since 时使用最粗的级别。
+        """
+        covering = [ring for ring in rings if not ring.full or ring.oldest() <= since]
+        if not covering:
+            return rings[-1]
+        fitting = [ring for ring in covering if ring.resolution <= step]
+        return fitting[-1] if fitting else covering[0]
+
+    def query(self, name, since=None, until=None, step=0):
+        """
+        查询设备在 [since, until] 内的状态变化。结果的第一个点是 since 时刻正在生效的状态（如果有）。
+        :param since: 起始时间（Unix 时间戳）；None 表示所有保留的数据
+        :param until: 结束时间；None 表示到现在
+        :param step: 期望的时间间隔（秒），大于所选级别的分辨率时按 step 重新分桶
+        :return: 列式结果字典；设备没有历史时返回 None
+        """
+        rings = self._devices.get(name)
+        if rings is None:
+            return None
+        step = max(step or 0, 0)
+        if since is None:
+            since = rings[-1].oldest()
+        ring = self._select(rings, since, step)
+        first = max(ring.bisect(since) - 1, 0)
+        last = len(ring) if until is None else ring.bisect(until)
+        bucket = step if step > ring.resolution else 0
+
+        result = {"t": [], "brightness": [], "min": [], "max": [], "color": [], "status": [], "count": []}
+        t, value, low, high = result["t"], result["brightness"], result["min"], result["max"]
+        color, status, count = result["color"], result["status"], result["count"]
+        for i in range(first, last):
+            pos = ring._pos(i)
+            ts = ring.t[pos]
+            if bucket:
+                ts = ts - ts % bucket
+                if t and t[-1] == ts:
+                    value[-1] = ring.value[pos]
+                    low[-1] = min(low[-1], ring.low[pos])
+                    high[-1] = max(high[-1], ring.high[pos])
+                    color[-1] = ring.color[pos]
+                    status[-1] = ring.status[pos]
+                    count[-1] += ring.count[pos]
+                    continue
+            t.append(ts)
+            value.append(ring.value[pos])
+            low.append(ring.low[pos])
+            high.append(ring.high[pos])
+            color.append(ring.color[pos])
+            status.append(ring.status[pos])
+            count.append(ring.count[pos])
+
+        result["t"] = [round(ts, 3) for ts in t]
+        result["color"] = [colors.decode(code) for code in color]
+        result["status"] = [statuses.decode(code) for code in status]
+        return dict(
+            device=name,
+            since=since,
+            until=until,
+            resolution=ring.resolution,
+            step=max(bucket, ring.resolution),
+            oldest=ring.oldest(),
+            **result,
+        )
+
+    def stats(self):
+        return {
+            "devices": len(self._devices),
+            "removed": len(self._removed),
+            "levels": [{"resolution": resolution, "capacity": capacity} for resolution, capacity in self.levels],
+            "entries": sum(len(ring) for rings in self._devices.values() for ring in rings),
+            "bytes": self.nbytes(),
+        }
+
+    def nbytes(self):
+        return sum(ring.nbytes() for rings in self._devices.values() for ring in rings)
+
+
+device_history = DeviceHistory(parse_levels(HISTORY_LEVELS), HISTORY_RETENTION_MS / 1000)
+registry.add_listener(device_history.on_change)
@@ -0,0 +1,143 @@
+#logging_setup.py
+# 日志：各模块使用 logging.getLogger(__name__)。所有记录先经过限流过滤器，再由 QueueHandler 放入队列，
+# 由后台线程（QueueListener）格式化并写出，事件循环不会阻塞在 stdout / journald 上。
+#
+# 高频事件在调用时带上 extra={"rate_key": "<类别>"}，同一类别每秒最多输出 LOG_RATE_LIMIT 条，
+# 被抑制的条数附加在该类别下一条输出的记录上。
+# 消息内容（payload）只在 payloads_enabled() 为真时才应格式化和输出。
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+from codec import dumps
+from config import LOG_LEVEL, LOG_FORMAT, LOG_PAYLOADS, LOG_RATE_LIMIT
+
+_payloads = bool(LOG_PAYLOADS)
+_listener = None
+_rate_filter = None
+
+
+def payloads_enabled():
+    """
+    是否输出消息内容。热路径上应先检查，避免在关闭时序列化消息。
+    """
+    return _payloads
+
+
+def set_payloads(enabled):
+    global _payloads
+    _payloads = bool(enabled)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    按 rate_key 限流：每个类别每秒最多通过 per_second 条记录。
+    过滤在调用方线程中执行，被抑制的记录不会进入队列。
+    """
+
+    def __init__(self, per_second):
+        super().__init__()
+        self.per_second = per_second
+        self._windows = {}  # rate_key -> [窗口开始时间, 已通过条数, 已抑制条数]
+        self.suppressed = 0
+
+    def filter(self, record):
+        key = getattr(record, "rate_key", None)
+        if key is None or self.per_second <= 0:
+            return True
+        now = time.monotonic()
+        window = self._windows.get(key)
+        if window is None or now - window[0] >= 1:
+            if window is not None and window[2]:
+                record.suppressed = window[2]
+            window = [now, 0, 0]
+            self._windows[key] = window
+        if window[1] >= self.per_second:
+            window[2] += 1
+            self.suppressed += 1
+            return False
+        window[1] += 1
+        return True
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record):
+        text = super().format(record)
+        suppressed = getattr(record, "suppressed", None)
+        if suppressed:
+            text += f" (+{suppressed} similar suppressed)"
+        return text
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    每条记录输出一行 JSON，便于日志系统按字段检索。
+    """
+
+    def format(self, record):
+        entry = {
+            "ts": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        suppressed = getattr(record, "suppressed", None)
+        if suppressed:
+            entry["suppressed"] = suppressed
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return dumps(entry)
+
+
+def setup_logging(level=LOG_LEVEL, fmt=LOG_FORMAT, stream=None):
+    """
+    配置根日志器：限流过滤器 + 队列处理器，后台线程负责写出。服务器启动时调用一次。
+    """
+    global _listener, _rate_filter
+    if _listener is not None:
+        return
+    records = queue.SimpleQueue()
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(JsonFormatter() if fmt == "json" else TextFormatter())
+
+    handler = logging.handlers.QueueHandler(records)
+    _rate_filter = RateLimitFilter(LOG_RATE_LIMIT)
+    handler.addFilter(_rate_filter)
+
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    set_level(level)
+    _listener = logging.handlers.QueueListener(records, output)
+    _listener.start()
+
+
+def set_level(level):
+    """
+    修改根日志器级别。
+    :raises ValueError: 未知的日志级别
+    """
+    if isinstance(level, str):
+        level = level.upper()
+    logging.getLogger().setLevel(level)
+
+
+def stop_logging():
+    """
+    写出队列中剩余的记录并停止后台线程（服务器关闭时调用）。
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def logging_stats():
+    return {
+        "level": logging.getLevelName(logging.getLogger().level),
+        "payloads": _payloads,
+        "suppressed": _rate_filter.suppressed if _rate_filter is not None else 0,
+    }
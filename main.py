@@ -1,55 +1,150 @@
+import argparse
 import asyncio
+import logging
+import os
+import signal
+import sys
 from aiohttp import web
+from logging_setup import setup_logging, stop_logging
 from device_websocket import start_websocket_server
-from phone_server import start_http_server
+from phone_server import start_http_server, BOOT_ID
 from headset_server import start_headset_server
 from tasktracker import start_experiment
+from action_log import action_log
+from config import PROFILE, DEVICE_PORT, HTTP_PORT, HEADSET_PORT, SNAPSHOT_INTERVAL_MS, WORKERS, PHONE_SOCKET
+from profiler import stall_watchdog, profiler
+from snapshot import restore_snapshot, save_snapshot, snapshot_writer
+from bus import bus_server
 
-async def main():
+logger = logging.getLogger("main")
+
+async def start_workers(count):
+    """
+    启动手机端工作进程（python main.py --worker N），继承当前的环境变量。
+    """
+    env = dict(os.environ, AR_BOOT_ID=BOOT_ID)
+    return [
+        await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__), "--worker", str(worker_id), env=env)
+        for worker_id in range(count)
+    ]
+
+async def stop_workers(processes):
+    for process in processes:
+        if process.returncode is None:
+            process.terminate()
+    for process in processes:
+        try:
+            await asyncio.wait_for(process.wait(), 5)
+        except asyncio.TimeoutError:
+            logger.warning("Phone worker (pid %d) did not exit; killing it.", process.pid)
+            process.kill()
+            await process.wait()
+
+def remove_socket(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+async def main(profile=False, workers=0):
     """
     主函数：同时启动 WebSocket 服务（设备和头显）和 HTTP 服务。
+    :param profile: 是否启用事件循环卡顿检测
+    :param workers: 手机端工作进程数量；大于 0 时本进程只通过 Unix 域套接字提供手机端接口，
+                    由工作进程以 SO_REUSEPORT 监听 HTTP 端口并经状态总线同步设备状态
     """
-    print("Starting all services...")
+    logger.info("Starting all services...")
+    # SIGTERM（进程管理器停止服务）与 Ctrl+C 一样走正常的关闭流程，并停止工作进程
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    if profile:
+        stall_watchdog.start()
+
+    # 在开始监听之前恢复重启前的设备状态和任务进度
+    restored = SNAPSHOT_INTERVAL_MS > 0 and restore_snapshot()
 
     # 启动 WebSocket 服务器（设备连接）
     websocket_server = await start_websocket_server()
-    print("Device WebSocket server started on port 8765.")
+    logger.info("Device WebSocket server started on port %d.", DEVICE_PORT)
 
     # 启动 HTTP 服务器（面向手机端）
     http_app = start_http_server()
     http_runner = web.AppRunner(http_app)
     await http_runner.setup()
-    http_site = web.TCPSite(http_runner, "0.0.0.0", 8080)
-    await http_site.start()
-    print("HTTP server started on port 8080.")
+    if workers > 0:
+        await bus_server.start()
+        http_site = web.UnixSite(http_runner, PHONE_SOCKET)
+        await http_site.start()
+        logger.info("Phone API for workers listening on %s.", PHONE_SOCKET)
+    else:
+        http_site = web.TCPSite(http_runner, "0.0.0.0", HTTP_PORT)
+        await http_site.start()
+        logger.info("HTTP server started on port %d.", HTTP_PORT)
 
     # 启动 WebSocket 服务器（头显连接）
     headset_app = start_headset_server()
     headset_runner = web.AppRunner(headset_app)
     await headset_runner.setup()
-    headset_site = web.TCPSite(headset_runner, "0.0.0.0", 8766)
+    headset_site = web.TCPSite(headset_runner, "0.0.0.0", HEADSET_PORT)
     await headset_site.start()
-    print("Headset WebSocket server started on port 8766.")
+    logger.info("Headset WebSocket server started on port %d.", HEADSET_PORT)
+
+    # 启动实验（记录开始时间）；热重启时沿用快照中的计时和任务进度
+    if not restored:
+        start_experiment()
+    if SNAPSHOT_INTERVAL_MS > 0:
+        snapshot_writer.start()
 
-    # 启动实验（记录开始时间）
-    start_experiment()
+    # 所有服务就绪后再启动工作进程
+    worker_processes = await start_workers(workers) if workers > 0 else []
+    if workers > 0:
+        logger.info("Started %d phone worker(s) on port %d.", workers, HTTP_PORT)
 
     # 保持所有服务运行
     try:
         while True:
             await asyncio.sleep(1)
     except asyncio.CancelledError:
-        print("Shutting down...")
+        logger.info("Shutting down...")
     finally:
+        await stop_workers(worker_processes)
+        # 在关闭设备连接（会移除注册表中的设备）之前写入最终快照
+        if SNAPSHOT_INTERVAL_MS > 0:
+            snapshot_writer.stop()
+            save_snapshot()
         # 优雅地关闭 HTTP 和 WebSocket 服务
         await http_runner.cleanup()
         await headset_runner.cleanup()
+        if workers > 0:
+            await bus_server.close()
+            remove_socket(bus_server.path)
+            remove_socket(PHONE_SOCKET)
         websocket_server.close()
         await websocket_server.wait_closed()
-        print("All services stopped.")
+        # 写入缓冲区中剩余的操作日志
+        await action_log.close()
+        stall_watchdog.stop()
+        if profiler.running:
+            await asyncio.get_running_loop().run_in_executor(None, profiler.stop)
+        logger.info("All services stopped.")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="AR experiment server")
+    parser.add_argument("--profile", action="store_true",
+                        help="detect event loop stalls and log the blocking stack (same as AR_PROFILE=1)")
+    parser.add_argument("--workers", type=int, default=WORKERS,
+                        help="run the phone HTTP/WS server in N SO_REUSEPORT worker processes (same as AR_WORKERS=N)")
+    parser.add_argument("--worker", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    setup_logging()
     try:
-        asyncio.run(main())
+        if args.worker is not None:
+            from worker import run_worker
+            asyncio.run(run_worker(args.worker))
+        else:
+            asyncio.run(main(profile=args.profile or bool(PROFILE), workers=args.workers))
     except KeyboardInterrupt:
-        print("Server stopped manually.")
+        logger.info("Server stopped manually.")
+    finally:
+        # 写出日志队列中剩余的记录
+        stop_logging()
@@ -0,0 +1,151 @@
+#metrics.py
+# 服务器自身的性能指标，以 Prometheus 文本格式通过 /metrics 输出。
+# 记录只是一次二分查找和几次整数加法，可以在生产环境中常开；
+# 仪表（gauge）的值在抓取时才通过回调计算，平时没有任何开销。
+import asyncio
+import bisect
+import logging
+
+logger = logging.getLogger(__name__)
+
+# 默认的延迟分桶（秒）：覆盖 0.5 ms 到 10 s
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LOOP_LAG_INTERVAL = 0.5  # 事件循环延迟的采样间隔（秒）
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{value}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """
+    累积分桶直方图，可以带一组标签；每组标签值有独立的计数。
+    """
+
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self.labelnames = tuple(labelnames)
+        self._series = {}  # 标签值元组 -> [各分桶计数..., +Inf 计数, 总和]
+
+    def observe(self, value, *labels):
+        series = self._series.get(labels)
+        if series is None:
+            series = [0] * (len(self.buckets) + 1) + [0.0]
+            self._series[labels] = series
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        bucket_names = self.labelnames + ("le",)
+        for labels, series in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(bucket_names, labels + (_format_value(bound),))} {cumulative}")
+            label_text = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_text} {_format_value(series[-1])}")
+            lines.append(f"{self.name}_count{label_text} {cumulative}")
+        return lines
+
+
+class Gauge:
+    """
+    抓取时计算的仪表。回调返回数值，或 [(标签值元组, 数值), ...]。
+    """
+
+    def __init__(self, name, help_text, callback, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.callback = callback
+        self.labelnames = tuple(labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        try:
+            value = self.callback()
+        except Exception as e:
+            logger.error("Failed to collect gauge %s: %s", self.name, e)
+            return lines
+        samples = value if isinstance(value, list) else [((), value)]
+        for labels, sample in samples:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(sample)}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS, labelnames=()):
+        metric = Histogram(name, help_text, buckets, labelnames)
+        self._metrics[name] = metric
+        return metric
+
+    def gauge(self, name, help_text, callback, labelnames=()):
+        metric = Gauge(name, help_text, callback, labelnames)
+        self._metrics[name] = metric
+        return metric
+
+    def render(self):
+        """
+        以 Prometheus 文本格式（0.0.4）输出所有指标。
+        """
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+command_latency = metrics.histogram(
+    "ar_command_latency_seconds", "Time from command submission (/command, batch, scene) to device acknowledgement.")
+command_rtt = metrics.histogram(
+    "ar_command_rtt_seconds", "Time from writing a command to the device socket to its acknowledgement.",
+    labelnames=("protocol",))
+fanout_duration = metrics.histogram(
+    "ar_broadcast_fanout_seconds", "Time spent building and enqueuing one broadcast for all clients of a topic.",
+    labelnames=("topic",))
+lock_wait = metrics.histogram(
+    "ar_session_lock_wait_seconds", "Time spent waiting to acquire an experiment session lock.")
+loop_lag = metrics.histogram(
+    "ar_event_loop_lag_seconds", "Extra delay of a periodic event loop timer beyond its scheduled time.")
+
+_last_loop_lag = 0.0
+_loop_monitor = None
+
+
+async def _monitor_loop_lag():
+    global _last_loop_lag
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + LOOP_LAG_INTERVAL
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        _last_loop_lag = max(loop.time() - expected, 0.0)
+        loop_lag.observe(_last_loop_lag)
+
+
+def start_loop_monitor():
+    """
+    启动事件循环延迟采样任务（重复调用无副作用）。
+    """
+    global _loop_monitor
+    if _loop_monitor is None or _loop_monitor.done():
+        _loop_monitor = asyncio.get_running_loop().create_task(_monitor_loop_lag())
+
+
+metrics.gauge("ar_event_loop_lag_last_seconds", "Most recent event loop lag sample.", lambda: _last_loop_lag)
@@ -1,124 +1,182 @@
 #notifier.py
 import asyncio
-from asyncio import Lock
-import copy
-from tasktracker import check_task_1
+import logging
+import time
+from codec import loads, negotiate_encoding, hello_message
+from tasktracker import dispatch_event
+from broadcaster import Broadcaster
+from config import SEND_QUEUE_SIZE, PHONE_QUEUE_POLICY, WS_COMPRESS
+from logging_setup import payloads_enabled
+from scheduler import update_scheduler
+from shared_data import registry
+from metrics import fanout_duration
 
-lock = Lock()
-websocket_clients = set()  # 用于存储前端 WebSocket 客户端
-last_notified_device_states = {}  # 用于存储上次推送的设备状态
+logger = logging.getLogger(__name__)
 
-# 通知所有 WebSocket 客户端设备状态更新
-async def notify_websocket_clients(device_states, full_update=False):
+published_version = 0  # 最近一次推送给客户端的注册表版本号
+version_waiters = set()  # 等待下一次推送的 Future（用于 /devices 长轮询）
+update_hooks = []  # 每次推送后调用 hook(since, version, updates)，例如多进程模式的状态总线
+
+
+def snapshot_message():
     """
-    通知 WebSocket 客户端设备状态更新。
-    :param device_states: 当前的设备状态字典
-    :param full_update: 是否发送完整状态更新
+    构造完整设备状态快照消息（带版本号）。
     """
-    global last_notified_device_states
+    return {"type": "device_update", "version": registry.version, "full": True, "data": registry.snapshot()}
 
-    updates = []
-    if full_update:
-        # 如果是完整更新，直接发送所有设备的状态
-        updates = [
-            {
-                "device_name": name,
-                "status": state.get("status", "offline"),
-                "brightness": state.get("brightness", 0),
-                "color": state.get("color", "off"),
-            }
-            for name, state in device_states.items()
-        ]
-        last_notified_device_states = copy.deepcopy(device_states)  # 使用深拷贝
-        print("[Debug] Full update: All device states sent.")
-    else:
-        # 检测设备状态变化
-        for name, state in device_states.items():
-            last_state = last_notified_device_states.get(name, {})
-
-            # 检测状态变化或新增设备
-            if (
-                state.get("status") != last_state.get("status") or
-                state.get("brightness") != last_state.get("brightness") or
-                state.get("color", "").lower() != last_state.get("color", "").lower()
-            ):
-                updates.append({
-                    "device_name": name,
-                    "status": state.get("status", "offline"),
-                    "brightness": state.get("brightness", 0),
-                    "color": state.get("color", "off"),
-                })
-                last_notified_device_states[name] = copy.deepcopy(state)
-                print(f"[Debug] State change detected for '{name}': {state}")
-
-        # 检测已移除的设备
-        for name in set(last_notified_device_states.keys()) - set(device_states.keys()):
-            updates.append({
-                "device_name": name,
-                "status": "offline",
-                "brightness": 0,
-                "color": "off",
-            })
-            print(f"[Debug] Removed device detected: {name}")
-            del last_notified_device_states[name]
-
-    if not updates and not full_update:
-        print("[Debug] No state changes detected. Skipping notification.")
+
+# 前端 WebSocket 客户端，每个客户端有独立的发送队列
+websocket_clients = Broadcaster("phone", SEND_QUEUE_SIZE, PHONE_QUEUE_POLICY, snapshot=snapshot_message)
+
+
+def delta_message(since, updates):
+    """
+    构造增量消息：包含从版本 since 之后到当前版本的所有变更。
+    """
+    return {"type": "device_delta", "since": since, "version": registry.version, "data": updates}
+
+
+def sync_message(since):
+    """
+    根据客户端已知的版本号返回增量消息；历史不足时退回完整快照。
+    """
+    updates = registry.changes_since(since)
+    if updates is None:
+        return snapshot_message()
+    return delta_message(since, updates)
+
+
+def sync_published_version():
+    """
+    注册表版本在推送之外前进时（从快照恢复）调用，之后的增量从当前版本开始。
+    """
+    global published_version
+    published_version = registry.version
+
+
+def flush_device_updates(_keys=None):
+    """
+    合并窗口结束时调用：只取出注册表中标记为脏的设备，推送一次带版本号的增量。
+    """
+    global published_version, version_waiters
+
+    since = published_version
+    updates = registry.take_dirty()
+    published_version = registry.version
+    if version_waiters and published_version != since:
+        waiters, version_waiters = version_waiters, set()
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(published_version)
+    if published_version != since:
+        for hook in update_hooks:
+            hook(since, published_version, updates)
+    if not updates:
+        logger.debug("No state changes detected. Skipping notification.", extra={"rate_key": "state_diff"})
         return
 
-    # 确保未变化的设备也包含在通知中
-    if not full_update:
-        for name in device_states.keys():
-            if name not in [update["device_name"] for update in updates]:
-                updates.append({
-                    "device_name": name,
-                    "status": device_states[name].get("status", "offline"),
-                    "brightness": device_states[name].get("brightness", 0),
-                    "color": device_states[name].get("color", "off"),
-                })
+    # 只入队，不等待网络发送；慢客户端由各自的写任务处理
+    started = time.perf_counter()
+    delivered = websocket_clients.publish(delta_message(since, updates))
+    fanout_duration.observe(time.perf_counter() - started, "devices")
+    logger.debug("%d device change(s) queued for %d client(s) (version %d).", len(updates), delivered, registry.version, extra={"rate_key": "state_diff"})
 
-    message = {"type": "device_update", "data": updates}
 
-    async with lock:
-        for client in list(websocket_clients):
-            try:
-                await client.send_json(message)
-                print(f"[Debug] Notification sent to client: {message}")
-            except Exception as e:
-                print(f"[Error] Failed to notify WebSocket client: {e}")
-                websocket_clients.discard(client)
+update_scheduler.register("devices", flush_device_updates)
+# 注册表中的每次变更都会开启（或加入）一个合并窗口
+registry.add_listener(lambda record, removed: update_scheduler.mark("devices", ()))
 
 
+async def wait_for_update(timeout):
+    """
+    等待下一次设备变更推送（与 WebSocket 增量使用同一个合并窗口）。
+    :return: 推送后的版本号；超时返回 None
+    """
+    waiter = asyncio.get_running_loop().create_future()
+    version_waiters.add(waiter)
+    try:
+        return await asyncio.wait_for(waiter, timeout)
+    except asyncio.TimeoutError:
+        return None
+    finally:
+        version_waiters.discard(waiter)
+
+
+# 通知所有 WebSocket 客户端设备状态更新
+async def notify_websocket_clients(full_update=False):
+    """
+    立即推送合并窗口中等待的设备变更。注册表的修改会自动进入合并窗口，
+    一般不需要调用本函数。
+    :param full_update: 是否同时向所有客户端发送完整快照
+    """
+    update_scheduler.flush()
+    if full_update:
+        started = time.perf_counter()
+        websocket_clients.publish(snapshot_message())
+        fanout_duration.observe(time.perf_counter() - started, "devices")
+        logger.debug("Full update: All device states sent.")
+
+
+async def handle_client_message(ws, data):
+    """
+    处理客户端请求：{"type": "sync", "since": N} 获取增量，{"type": "snapshot"} 获取完整快照，
+    {"type": "hello", "encoding": "compact" | "msgpack"} 切换之后消息的编码（回复 hello 和一次完整快照）。
+    """
+    try:
+        request = loads(data)
+    except ValueError:
+        if payloads_enabled():
+            logger.debug("Received from WebSocket client: %s", data)
+        return
+
+    if not isinstance(request, dict):
+        return
+    if request.get("type") == "sync" and isinstance(request.get("since"), int):
+        websocket_clients.send(ws, sync_message(request["since"]))
+    elif request.get("type") == "snapshot":
+        websocket_clients.send(ws, snapshot_message())
+    elif request.get("type") == "hello":
+        encoding = negotiate_encoding(request.get("encoding"))
+        websocket_clients.set_encoding(ws, encoding)
+        websocket_clients.send(ws, hello_message(encoding))
+        websocket_clients.send(ws, snapshot_message())
+    elif payloads_enabled():
+        logger.debug("Received from WebSocket client: %s", data)
+
 
 # WebSocket 路由处理函数
 async def websocket_handler(request):
     """
     处理 WebSocket 客户端的连接。
+    客户端通过 ?session=<会话 ID> 绑定实验会话；
+    重连的客户端可以通过 ?since=N 只获取版本 N 之后的变更，
+    通过 ?encoding=compact / msgpack 选择更紧凑的消息编码（默认 JSON）。
     """
     from aiohttp import web, WSMsgType
-    ws = web.WebSocketResponse()
+    ws = web.WebSocketResponse(compress=bool(WS_COMPRESS))
     await ws.prepare(request)
 
-    async with lock:
-        websocket_clients.add(ws)
+    logger.info("WebSocket client connected.")
+    await dispatch_event("app_opened", session_id=request.query.get("session"))
 
-    print("[Debug] WebSocket client connected.")
-    await check_task_1()
-
-    # 在客户端连接时，发送完整的设备状态
-    from shared_data import device_states  # 确保能访问最新设备状态
-    await notify_websocket_clients(device_states, full_update=True)
+    # 先推送窗口中等待的变更，再登记新客户端并只向它发送快照或增量，避免它收到早于快照的增量
+    update_scheduler.flush()
+    websocket_clients.add(ws, request.remote, negotiate_encoding(request.query.get("encoding")))
+    since = request.query.get("since")
+    if since is not None and since.isdigit():
+        websocket_clients.send(ws, sync_message(int(since)))
+    else:
+        websocket_clients.send(ws, snapshot_message())
 
     try:
         async for msg in ws:
             if msg.type == WSMsgType.TEXT:
-                print(f"[Debug] Received from WebSocket client: {msg.data}")
+                await handle_client_message(ws, msg.data)
             elif msg.type == WSMsgType.ERROR:
-                print(f"[Error] WebSocket connection error: {ws.exception()}")
+                logger.warning("WebSocket connection error: %s", ws.exception())
     except Exception as e:
-        print(f"[Error] WebSocket error: {e}")
+        logger.warning("WebSocket error: %s", e)
     finally:
-        async with lock:
-            websocket_clients.discard(ws)
-        print("[Debug] WebSocket client disconnected.")
+        websocket_clients.discard(ws)
+        logger.info("WebSocket client disconnected.")
     return ws
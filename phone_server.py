@@ -1,29 +1,123 @@
+import asyncio
+import hmac
+import ipaddress
+import logging
+import os
+import socket
+import time
 from aiohttp import web
 import aiohttp_cors
-from device_websocket import send_command_to_device
-from notifier import websocket_handler, notify_websocket_clients
-from shared_data import connected_clients, device_states
-from asyncio import Lock
-from tasktracker import check_task_2, check_task_3, check_task_4
+from codec import dumps
+from config import ADMIN_TOKEN, LONG_POLL_MAX_WAIT, PROFILE_INTERVAL_MS, PROFILE_MAX_SECONDS
+from device_websocket import send_command_to_device, registrations
+from notifier import websocket_handler, websocket_clients, wait_for_update
+from headset_server import headset_clients, headset_stats
+from scheduler import update_scheduler
+from heartbeat import heartbeat
+from action_log import action_log
+from admission import admission
+from bus import bus_server
+from history import device_history, query_window
+from logging_setup import logging_stats, set_level, set_payloads
+from metrics import metrics, start_loop_monitor
+from profiler import stall_watchdog, profiler
+from shared_data import registry
+from tasktracker import dispatch_event, bind_device, sessions, get_session, start_experiment, SessionError
+try:
+    import analytics  # 依赖 NumPy，未安装时 /analytics 不可用
+except ImportError:
+    analytics = None
+from scenes import groups, scenes, load_scenes, save_scenes, expand_commands, dispatch_batch, summarize
 
-lock = Lock()  # 确保全局线程安全的锁
+logger = logging.getLogger(__name__)
+
+# 进程标识：服务器重启后版本号从 0 开始，ETag 中带上它避免与旧版本混淆。
+# 多进程模式下工作进程通过 AR_BOOT_ID 继承主进程的标识，不同工作进程返回相同的 ETag
+BOOT_ID = os.environ.get("AR_BOOT_ID") or f"{int(time.time()):x}{os.getpid():x}"
+
+# 多进程模式下工作进程把客户端的原始地址放在这个头部中转发给主进程
+FORWARDED_FOR_HEADER = "X-AR-Forwarded-For"
+
+# 按注册表版本缓存的 /devices 响应体
+device_list_cache = {"version": None, "body": None}
+
+def device_list_etag(version):
+    return f'"{BOOT_ID}-{version}"'
+
+def device_list_body():
+    """
+    返回当前版本的设备列表 JSON；同一版本只序列化一次。
+    """
+    if device_list_cache["version"] != registry.version:
+        device_list_cache["body"] = dumps({"devices": registry.snapshot(), "version": registry.version})
+        device_list_cache["version"] = registry.version
+    return device_list_cache["body"]
+
+def client_address(request):
+    """
+    返回请求的客户端地址。经 Unix 域套接字到达的请求来自本机的工作进程，使用它转发的原始地址。
+    """
+    sock = request.transport.get_extra_info("socket") if request.transport is not None else None
+    if sock is not None and sock.family == socket.AF_UNIX:
+        return request.headers.get(FORWARDED_FOR_HEADER)
+    return request.remote
+
+def is_admin_request(request):
+    """
+    管理接口的访问检查：本机（回环地址）的请求，或携带正确令牌（AR_ADMIN_TOKEN）的请求。
+    """
+    if ADMIN_TOKEN:
+        scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+        if scheme.lower() == "bearer" and hmac.compare_digest(token.strip().encode(), ADMIN_TOKEN.encode()):
+            return True
+    try:
+        return ipaddress.ip_address(client_address(request) or "").is_loopback
+    except ValueError:
+        return False
+
+def admin_only(handler):
+    """
+    包装管理接口的处理函数：未通过访问检查时返回 403。
+    """
+    async def wrapper(request):
+        if not is_admin_request(request):
+            logger.warning("Rejected admin request %s %s from %s.", request.method, request.path, client_address(request), extra={"rate_key": "admin_rejected"})
+            return web.json_response({"status": "error", "message": "Admin access is limited to local clients or requests with the admin token."}, status=403)
+        return await handler(request)
+    return wrapper
 
 # 设备列表路由
 async def get_device_list(request):
     """
     Returns the list of currently connected devices with their states.
+    支持 If-None-Match 条件请求（未变化时返回 304），
+    以及 ?wait=<秒> 长轮询：ETag 仍然匹配时等待版本前进或超时。
     """
-    async with lock:  # 确保线程安全地访问 `connected_clients` 和 `device_states`
-        device_list = [
-            {
-                "device_name": name,
-                "status": device_states[name]["status"],
-                "brightness": device_states[name]["brightness"],
-                "color": device_states[name]["color"],
-            }
-            for name in connected_clients.keys()
-        ]
-    return web.json_response({"devices": device_list})
+    if_none_match = request.headers.get("If-None-Match")
+    wait = request.query.get("wait")
+    if wait and if_none_match == device_list_etag(registry.version):
+        try:
+            timeout = min(max(float(wait), 0), LONG_POLL_MAX_WAIT)
+        except ValueError:
+            return web.json_response({"status": "error", "message": "Invalid 'wait'."}, status=400)
+        await wait_for_update(timeout)
+
+    etag = device_list_etag(registry.version)
+    if if_none_match == etag:
+        return web.Response(status=304, headers={"ETag": etag})
+    return web.Response(
+        text=device_list_body(),
+        content_type="application/json",
+        headers={"ETag": etag, "Cache-Control": "no-cache"},
+    )
+
+def request_session(request, data=None):
+    """
+    读取请求所属的实验会话：JSON 中的 "session"、?session= 参数或 X-Session-Id 请求头。
+    """
+    if isinstance(data, dict) and data.get("session"):
+        return str(data["session"])
+    return request.query.get("session") or request.headers.get("X-Session-Id")
 
 # 命令路由
 async def handle_command(request):
@@ -35,15 +129,117 @@ async def handle_command(request):
         if not device_name or not command:
             return web.json_response({"status": "error", "message": "Missing 'device' or 'command'."}, status=400)
 
-        result = await send_command_to_device(device_name, command)
+        # 滑块等高频控制可以设置 "coalesce": true，只让最新的值到达设备
+        coalesce = data.get("coalesce")
+        if coalesce is not None and not isinstance(coalesce, bool):
+            return web.json_response({"status": "error", "message": "'coalesce' must be true, false or null."}, status=400)
+        session_id = request_session(request, data)
+        bind_device(device_name, session_id)
+        # 命令处理期间，设备重连风暴中的批量注册推迟执行，命令优先
+        with admission.command():
+            result = await send_command_to_device(device_name, command, coalesce=coalesce, session_id=session_id)
         if result.startswith("Error"):
             return web.json_response({"status": "error", "message": result}, status=400)
+        if result.startswith("Superseded"):
+            return web.json_response({"status": "superseded", "message": result}, status=200)
 
         return web.json_response({"status": "success", "message": result}, status=200)
 
     except Exception as e:
         return web.json_response({"status": "error", "message": str(e)}, status=500)
 
+def parse_batch_options(data):
+    """
+    读取批量请求的 timeout（毫秒）和 wait_ack 选项。
+    """
+    timeout_ms = data.get("timeout_ms")
+    if timeout_ms is not None and (not isinstance(timeout_ms, (int, float)) or timeout_ms < 0):
+        raise ValueError("'timeout_ms' must be a non-negative number.")
+    return timeout_ms, bool(data.get("wait_ack", True))
+
+# 批量命令路由
+async def handle_batch_command(request):
+    """
+    一次请求向多个设备（或分组）发送命令，并行下发并返回每个设备的结果。
+    请求格式：{"commands": [{"device" 或 "group": ..., "command": ...}], "timeout_ms": 2000, "wait_ack": true}
+    """
+    try:
+        data = await request.json()
+        if not isinstance(data, dict):
+            raise ValueError("Body must be a JSON object.")
+        entries = data.get("commands")
+        if not isinstance(entries, list) or not entries:
+            return web.json_response({"status": "error", "message": "Missing 'commands'."}, status=400)
+        timeout_ms, wait_ack = parse_batch_options(data)
+        targets = expand_commands(entries)
+    except ValueError as e:
+        return web.json_response({"status": "error", "message": str(e)}, status=400)
+
+    with admission.command():
+        results = await dispatch_batch(targets, timeout_ms, wait_ack)
+    return web.json_response({"status": "success", "summary": summarize(results), "results": results}, status=200)
+
+# 场景路由
+async def list_scenes(request):
+    return web.json_response({"groups": groups, "scenes": scenes})
+
+async def apply_scene(request):
+    """
+    执行命名场景，例如在两位参与者之间重置实验环境。
+    """
+    name = request.match_info["name"]
+    if name not in scenes:
+        return web.json_response({"status": "error", "message": f"Scene '{name}' not found."}, status=404)
+    try:
+        data = await request.json() if request.can_read_body else {}
+        if not isinstance(data, dict):
+            raise ValueError("Body must be a JSON object.")
+        timeout_ms, wait_ack = parse_batch_options(data)
+        targets = expand_commands(scenes[name])
+    except ValueError as e:
+        return web.json_response({"status": "error", "message": str(e)}, status=400)
+
+    with admission.command():
+        results = await dispatch_batch(targets, timeout_ms, wait_ack)
+    return web.json_response({"status": "success", "scene": name, "summary": summarize(results), "results": results}, status=200)
+
+async def define_group(request):
+    """
+    创建或替换设备分组：{"devices": ["Rectangle", ...]}
+    """
+    name = request.match_info["name"]
+    try:
+        data = await request.json()
+    except ValueError:
+        return web.json_response({"status": "error", "message": "Invalid JSON."}, status=400)
+    if not isinstance(data, dict):
+        return web.json_response({"status": "error", "message": "Body must be a JSON object."}, status=400)
+    devices = data.get("devices")
+    if not isinstance(devices, list) or not all(isinstance(d, str) for d in devices):
+        return web.json_response({"status": "error", "message": "'devices' must be a list of device names."}, status=400)
+    groups[name] = devices
+    save_scenes()
+    return web.json_response({"status": "success", "message": f"Group '{name}' saved."}, status=200)
+
+async def define_scene(request):
+    """
+    创建或替换场景：{"commands": [{"device" 或 "group": ..., "command": ...}]}
+    """
+    name = request.match_info["name"]
+    try:
+        data = await request.json()
+        if not isinstance(data, dict):
+            raise ValueError("Body must be a JSON object.")
+        entries = data.get("commands")
+        if not isinstance(entries, list) or not entries:
+            raise ValueError("Missing 'commands'.")
+        expand_commands(entries)  # 校验格式和分组是否存在
+    except ValueError as e:
+        return web.json_response({"status": "error", "message": str(e)}, status=400)
+    scenes[name] = entries
+    save_scenes()
+    return web.json_response({"status": "success", "message": f"Scene '{name}' saved."}, status=200)
+
 # 设备上线路由
 async def set_device_online(request):
     try:
@@ -53,28 +249,27 @@ async def set_device_online(request):
         if not device_name:
             return web.json_response({"status": "error", "message": "Missing 'device_name'."}, status=400)
 
-        async with lock:  # 确保线程安全
-            if device_name in device_states:
-                # 更新设备状态为 online
-                device_states[device_name]["status"] = "online"
-                print(f"Device '{device_name}' is now online.")
+        if device_name in registry:
+            # 更新设备状态为 online（注册表的修改会自动推送给 WebSocket 客户端）
+            registry.update(device_name, status="online")
+            logger.info("Device '%s' is now online.", device_name)
 
-                await check_task_3(device_name)
+            session_id = request_session(request, data)
+            bind_device(device_name, session_id)
+            await dispatch_event("device_selected", device_name, session_id)
 
-                # 通知 WebSocket 客户端设备状态变化
-                await notify_websocket_clients(device_states)
-
-                return web.json_response({"status": "success", "message": f"Device '{device_name}' is now online."}, status=200)
-            else:
-                return web.json_response({"status": "error", "message": f"Device '{device_name}' not found."}, status=404)
+            return web.json_response({"status": "success", "message": f"Device '{device_name}' is now online."}, status=200)
+        else:
+            return web.json_response({"status": "error", "message": f"Device '{device_name}' not found."}, status=404)
 
     except Exception as e:
-        print(f"Error in set_device_online: {e}")
+        logger.error("Error in set_device_online: %s", e)
         return web.json_response({"status": "error", "message": str(e)}, status=500)
  
 async def add_device_detector(request):
     try:
-        await check_task_2()
+        data = await request.json() if request.can_read_body else {}
+        await dispatch_event("add_device", session_id=request_session(request, data))
 
         return web.json_response({"status": "success", "message": "Task 2 (Add Device) completed."}, status=200)
 
@@ -93,25 +288,212 @@ async def enter_device(request):
             return web.json_response({"status": "error", "message": "Missing 'device_name'."}, status=400)
 
         # ✅ 任务 4 记录 (检测是否进入正确设备)
-        await check_task_4(device_name)
+        session_id = request_session(request, data)
+        bind_device(device_name, session_id)
+        await dispatch_event("device_entered", device_name, session_id)
 
         return web.json_response({"status": "success", "message": f"User entered device '{device_name}'."}, status=200)
 
     except Exception as e:
         return web.json_response({"status": "error", "message": str(e)}, status=500)
 
+# 实验会话路由
+async def create_session(request):
+    """
+    开始（或重新开始计时）一个实验会话：{"session": "P01"}
+    """
+    try:
+        data = await request.json()
+    except ValueError:
+        return web.json_response({"status": "error", "message": "Invalid JSON."}, status=400)
+    session_id = request_session(request, data)
+    if not session_id:
+        return web.json_response({"status": "error", "message": "Missing 'session'."}, status=400)
+    try:
+        session = start_experiment(session_id)
+    except SessionError as e:
+        return web.json_response({"status": "error", "message": str(e)}, status=400)
+    return web.json_response({"status": "success", "session": session.summary()}, status=200)
+
+async def list_sessions(request):
+    return web.json_response({"sessions": [session.summary() for session in sessions.values()]})
+
+async def get_session_tasks(request):
+    session_id = request.match_info["session"]
+    session = get_session(session_id)
+    if session is None:
+        return web.json_response({"status": "error", "message": f"Session '{session_id}' not found."}, status=404)
+    return web.json_response({"session": session.summary(), "tasks": session.task_list})
+
+# 设备状态历史路由
+async def get_device_history(request):
+    """
+    返回设备的状态历史：?since=&until=（Unix 时间戳，负数表示相对现在的秒数）&step=（秒，按该间隔降采样）。
+    """
+    name = request.match_info["name"]
+    try:
+        since, until, step = query_window(request.query.get("since"), request.query.get("until"), request.query.get("step"))
+    except ValueError as e:
+        return web.json_response({"status": "error", "message": str(e)}, status=400)
+    result = device_history.query(name, since, until, step)
+    if result is None:
+        return web.json_response({"status": "error", "message": f"No history for device '{name}'."}, status=404)
+    return web.json_response(result, dumps=dumps)
+
+# 实验指标路由
+async def get_analytics(request):
+    """
+    从操作日志计算各任务和各会话的指标（完成时间、尝试次数、错误设备、亮度超调）。
+    计算在线程池中执行，不阻塞事件循环。
+    """
+    if analytics is None:
+        return web.json_response({"status": "error", "message": "NumPy is not installed."}, status=501)
+    loop = asyncio.get_running_loop()
+    summary = await loop.run_in_executor(None, analytics.analyze)
+    return web.json_response(summary)
+
+# 发送队列统计路由
+async def get_client_stats(request):
+    """
+    返回手机端和头显客户端的发送队列深度、丢弃计数、更新合并窗口、各设备命令队列、设备准入以及操作日志写入的统计。
+    """
+    return web.json_response({
+        "devices": {record.name: record.actor.stats() for record in registry if record.actor is not None},
+        "phones": websocket_clients.stats(),
+        "headsets": headset_stats(),
+        "scheduler": update_scheduler.stats(),
+        "heartbeat": heartbeat.stats(),
+        "admission": dict(admission.stats(), registrations=registrations.stats()),
+        "bus": bus_server.stats(),
+        "history": device_history.stats(),
+        "action_log": action_log.stats(),
+        "logging": logging_stats(),
+    })
+
+# 仪表：抓取 /metrics 时才计算
+def _client_counts():
+    return [(("phone",), len(websocket_clients)), (("headset",), sum(len(clients) for clients in headset_clients.values()))]
+
+def _queue_depths(index):
+    phone = websocket_clients.queue_depth()[index]
+    headset = [clients.queue_depth()[index] for clients in headset_clients.values()]
+    headset = sum(headset) if index == 0 else max(headset, default=0)
+    return [(("phone",), phone), (("headset",), headset)]
+
+def _device_queues():
+    queued = awaiting = 0
+    for record in registry:
+        if record.actor is not None:
+            queued += record.actor.inbox.qsize()
+            awaiting += len(record.actor.awaiting_ack)
+    return [(("queued",), queued), (("awaiting_ack",), awaiting)]
+
+metrics.gauge("ar_connected_devices", "Devices currently registered (including bridged children).", lambda: len(registry))
+metrics.gauge("ar_connected_clients", "Connected WebSocket clients.", _client_counts, labelnames=("kind",))
+metrics.gauge("ar_send_queue_depth", "Frames waiting in client send queues.", lambda: _queue_depths(0), labelnames=("kind",))
+metrics.gauge("ar_send_queue_max_depth", "Deepest single client send queue.", lambda: _queue_depths(1), labelnames=("kind",))
+metrics.gauge("ar_device_commands", "Device commands waiting to be sent or acknowledged.", _device_queues, labelnames=("state",))
+metrics.gauge("ar_admission_handshakes", "Device registration handshakes by admission state.",
+              lambda: [(("active",), admission.in_handshake), (("waiting",), admission.waiting)], labelnames=("state",))
+metrics.gauge("ar_admission_rejected", "Device connections rejected by admission control since startup.", lambda: admission.rejected)
+metrics.gauge("ar_admission_rate_limited", "Device connections rejected by the registration rate limit since startup.", lambda: admission.rate_limited)
+metrics.gauge("ar_registration_batches", "Device registration batches processed since startup.", lambda: registrations.batches)
+metrics.gauge("ar_device_history_bytes", "Memory used by per-device state history buffers.", device_history.nbytes)
+metrics.gauge("ar_registry_version", "Current device registry version.", lambda: registry.version)
+
+# 性能指标路由（Prometheus 文本格式）
+async def get_metrics(request):
+    return web.Response(body=metrics.render().encode("utf-8"),
+                        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+async def start_metrics(app):
+    start_loop_monitor()
+
+# 诊断路由：卡顿记录和采样分析器
+async def get_stalls(request):
+    return web.json_response(stall_watchdog.stats())
+
+async def get_profile(request):
+    return web.json_response(profiler.stats())
+
+async def start_profile(request):
+    """
+    开始采样：{"interval_ms": 5, "max_seconds": 300}，两个字段都是可选的。
+    """
+    try:
+        data = await request.json() if request.can_read_body else {}
+        interval_ms = int(data.get("interval_ms", PROFILE_INTERVAL_MS))
+        max_seconds = int(data.get("max_seconds", PROFILE_MAX_SECONDS))
+    except (ValueError, TypeError, AttributeError):
+        return web.json_response({"status": "error", "message": "Invalid profile options."}, status=400)
+    try:
+        profiler.start(interval_ms, max_seconds)
+    except RuntimeError as e:
+        return web.json_response({"status": "error", "message": str(e)}, status=409)
+    return web.json_response({"status": "started", **profiler.stats()})
+
+async def stop_profile(request):
+    """
+    停止采样并返回结果文件（写文件在线程池中完成）。
+    """
+    if not profiler.running:
+        return web.json_response({"status": "error", "message": "Profiler is not running.", **profiler.stats()}, status=409)
+    result = await asyncio.get_running_loop().run_in_executor(None, profiler.stop)
+    return web.json_response({"status": "stopped", "result": result})
+
+# 日志设置路由
+async def get_logging(request):
+    return web.json_response(logging_stats())
+
+async def update_logging(request):
+    """
+    运行时修改日志级别和消息内容输出：{"level": "DEBUG", "payloads": true}，两个字段都是可选的。
+    """
+    try:
+        data = await request.json()
+    except ValueError:
+        return web.json_response({"status": "error", "message": "Invalid JSON body."}, status=400)
+    if not isinstance(data, dict):
+        return web.json_response({"status": "error", "message": "Body must be a JSON object."}, status=400)
+    if "level" in data:
+        try:
+            set_level(data["level"])
+        except (TypeError, ValueError) as e:
+            return web.json_response({"status": "error", "message": str(e)}, status=400)
+    if "payloads" in data:
+        set_payloads(data["payloads"])
+    logger.info("Logging settings changed: %s", logging_stats())
+    return web.json_response(logging_stats())
+
 # 启动 HTTP 服务
 def start_http_server():
     app = web.Application()
+    load_scenes()
+    app.on_startup.append(start_metrics)
 
     # 设置路由
     app.router.add_get("/devices", get_device_list)
+    app.router.add_get("/devices/{name}/history", get_device_history)
     app.router.add_post("/command", handle_command)
+    app.router.add_post("/commands", handle_batch_command)
     app.router.add_get("/ws", websocket_handler)
     app.router.add_post("/set_device_online", set_device_online)
     app.router.add_post("/add_device_detector", add_device_detector)
     app.router.add_post("/enter_device", enter_device)
 
+    # 分组、场景和实验会话
+    app.router.add_get("/scenes", list_scenes)
+    app.router.add_post("/scenes/{name}", apply_scene)
+    app.router.add_post("/sessions", create_session)
+    app.router.add_get("/sessions", list_sessions)
+    app.router.add_get("/sessions/{session}/tasks", get_session_tasks)
+
+    # 监控和统计
+    app.router.add_get("/clients", get_client_stats)
+    app.router.add_get("/analytics", get_analytics)
+    app.router.add_get("/logging", get_logging)
+    app.router.add_get("/metrics", get_metrics)
+
     # 配置 CORS 支持
     cors = aiohttp_cors.setup(app, defaults={
         "*": aiohttp_cors.ResourceOptions(
@@ -124,4 +506,13 @@ def start_http_server():
     for route in list(app.router.routes()):
         cors.add(route)
 
+    # 管理接口：只接受本机或携带令牌的请求，并且不启用 CORS
+    app.router.add_get("/admin/stalls", admin_only(get_stalls))
+    app.router.add_get("/admin/profile", admin_only(get_profile))
+    app.router.add_post("/admin/profile/start", admin_only(start_profile))
+    app.router.add_post("/admin/profile/stop", admin_only(stop_profile))
+    app.router.add_put("/logging", admin_only(update_logging))
+    app.router.add_put("/scenes/{name}", admin_only(define_scene))
+    app.router.add_put("/groups/{name}", admin_only(define_group))
+
     return app
@@ -0,0 +1,206 @@
+#profiler.py
+# 事件循环诊断工具，均在独立线程中工作，对事件循环本身几乎没有开销，可以在正式实验中开启：
+#   StallWatchdog     事件循环中的心跳任务定期更新时间戳；监视线程发现时间戳超过阈值未更新时，
+#                     说明某个回调或任务正在阻塞事件循环，立即抓取事件循环线程的调用栈。
+#   SamplingProfiler  按固定间隔采样事件循环线程的调用栈，停止后以折叠栈格式
+#                     （"帧;帧;帧 次数"，可直接用 flamegraph.pl / speedscope 查看）写入文件。
+import asyncio
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from config import STALL_THRESHOLD_MS, PROFILE_INTERVAL_MS, PROFILE_MAX_SECONDS, PROFILE_DIR
+
+logger = logging.getLogger(__name__)
+
+STALL_HISTORY = 50  # 保留的卡顿记录条数
+MAX_STACKS = 20000  # 采样分析器最多记录的不同调用栈数量，超出的样本计入 "[other]"
+
+
+class StallWatchdog:
+    """
+    事件循环卡顿检测。
+    """
+
+    def __init__(self, threshold_ms=STALL_THRESHOLD_MS, history=STALL_HISTORY):
+        self.threshold = threshold_ms / 1000
+        self.interval = self.threshold / 2
+        self.stalls = collections.deque(maxlen=history)
+        self.count = 0
+        self._beat = 0.0
+        self._loop_thread = None
+        self._task = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._current = None  # 正在进行的卡顿记录
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        """
+        在事件循环线程中调用。
+        """
+        if self.running:
+            return
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.get_running_loop().create_task(self._heartbeat())
+        self._thread = threading.Thread(target=self._watch, name="stall-watchdog", daemon=True)
+        self._thread.start()
+        logger.info("Stall watchdog started (threshold %d ms).", self.threshold * 1000)
+
+    def stop(self):
+        if not self.running:
+            return
+        self._stop.set()
+        self._task.cancel()
+        self._thread.join()
+        self._thread = None
+
+    async def _heartbeat(self):
+        while True:
+            self._beat = time.monotonic()
+            await asyncio.sleep(self.interval)
+
+    def _watch(self):
+        # 心跳本身每 interval 更新一次，超过 interval + threshold 未更新才算卡顿
+        limit = self.interval + self.threshold
+        while not self._stop.wait(self.interval / 2):
+            lag = time.monotonic() - self._beat
+            if lag > limit:
+                if self._current is None:
+                    frame = sys._current_frames().get(self._loop_thread)
+                    self._current = {
+                        "time": time.time() - lag,
+                        "duration_ms": None,
+                        "stack": traceback.format_stack(frame) if frame is not None else [],
+                    }
+                self._current["duration_ms"] = round((lag - self.interval) * 1000, 1)
+            elif self._current is not None:
+                self._finish()
+
+    def _finish(self):
+        stall, self._current = self._current, None
+        self.stalls.append(stall)
+        self.count += 1
+        logger.warning(
+            "Event loop blocked for about %.1f ms at:\n%s",
+            stall["duration_ms"], "".join(stall["stack"][-8:]),
+        )
+
+    def stats(self):
+        return {
+            "enabled": self.running,
+            "threshold_ms": self.threshold * 1000,
+            "count": self.count,
+            "stalls": list(self.stalls),
+        }
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    """
+    事件循环线程的采样分析器。同一时间只能运行一次采样。
+    """
+
+    def __init__(self, directory=PROFILE_DIR):
+        self.directory = directory
+        self._thread = None
+        self._stop = threading.Event()
+        self._counts = None
+        self._started = None
+        self._result = None
+        self.last_result = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, interval_ms=PROFILE_INTERVAL_MS, max_seconds=PROFILE_MAX_SECONDS):
+        """
+        在事件循环线程中调用，开始采样；超过 max_seconds 后自动停止并写出结果。
+        :raises RuntimeError: 已经在采样
+        """
+        if self.running:
+            raise RuntimeError("Profiler is already running.")
+        self._stop.clear()
+        self._counts = collections.Counter()
+        self._started = time.time()
+        self._thread = threading.Thread(
+            target=self._run,
+            args=(threading.get_ident(), max(interval_ms, 1) / 1000, max_seconds),
+            name="sampling-profiler",
+            daemon=True,
+        )
+        self._thread.start()
+        logger.info("Sampling profiler started (interval %d ms, max %d s).", interval_ms, max_seconds)
+
+    def stop(self):
+        """
+        停止采样并等待结果写入文件（阻塞，应在线程池中调用）。
+        :return: 结果摘要；没有运行时返回最近一次的结果
+        """
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        return self.last_result
+
+    def _run(self, thread_id, interval, max_seconds):
+        deadline = time.monotonic() + max_seconds
+        samples = 0
+        while not self._stop.wait(interval) and time.monotonic() < deadline:
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                break
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame))
+                frame = frame.f_back
+            key = ";".join(reversed(stack))
+            if key not in self._counts and len(self._counts) >= MAX_STACKS:
+                key = "[other]"
+            self._counts[key] += 1
+            samples += 1
+        self.last_result = self._write(samples)
+
+    def _write(self, samples):
+        name = time.strftime("profile-%Y%m%d-%H%M%S.folded", time.localtime(self._started))
+        path = os.path.join(self.directory, name)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(path, "w", encoding="utf-8") as f:
+                for stack, count in self._counts.most_common():
+                    f.write(f"{stack} {count}\n")
+        except OSError as e:
+            logger.error("Failed to write profile '%s': %s", path, e)
+            path = None
+        result = {
+            "file": path,
+            "samples": samples,
+            "stacks": len(self._counts),
+            "duration_s": round(time.time() - self._started, 2),
+        }
+        logger.info("Sampling profiler stopped: %s", result)
+        return result
+
+    def stats(self):
+        return {
+            "running": self.running,
+            "started": self._started if self.running else None,
+            "last_result": self.last_result,
+        }
+
+
+stall_watchdog = StallWatchdog()
+profiler = SamplingProfiler()
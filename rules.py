@@ -0,0 +1,128 @@
+#rules.py
+# 声明式任务规则：从 JSON 文件加载实验任务，事件只分发给按 (事件类型, 设备) 索引的规则。
+#
+# 规则字段：
+#   id / name   任务编号和名称
+#   on          触发事件类型，字符串或列表（app_opened / add_device / device_selected /
+#               device_entered / command_applied / status_reported）
+#   device      可选，只处理该设备的事件
+#   when        可选，完成条件：{字段: 值} 表示相等，{字段: {"ne"|"gt"|"gte"|"lt"|"lte"|"in": 值}}
+#   then        条件满足时的状态，默认 "completed"
+#   otherwise   可选，条件不满足时的状态；不设置时保持原状态
+#   record      可选，记录到操作日志的值；"$字段" 表示取事件中的字段
+import json
+
+_OPERATORS = {
+    "eq": lambda actual, expected: actual == expected,
+    "ne": lambda actual, expected: actual != expected,
+    "gt": lambda actual, expected: actual is not None and actual > expected,
+    "gte": lambda actual, expected: actual is not None and actual >= expected,
+    "lt": lambda actual, expected: actual is not None and actual < expected,
+    "lte": lambda actual, expected: actual is not None and actual <= expected,
+    "in": lambda actual, expected: actual in expected,
+}
+
+
+class RuleError(ValueError):
+    pass
+
+
+def _compile_condition(field, spec):
+    """
+    将单个字段的条件编译为 (字段, 比较函数, 期望值) 列表。
+    """
+    if not isinstance(spec, dict):
+        return [(field, _OPERATORS["eq"], spec)]
+    checks = []
+    for op, expected in spec.items():
+        if op not in _OPERATORS:
+            raise RuleError(f"Unknown operator '{op}' for field '{field}'.")
+        checks.append((field, _OPERATORS[op], expected))
+    return checks
+
+
+class Rule:
+    """
+    一条任务规则。
+    """
+
+    def __init__(self, definition):
+        try:
+            self.task_id = definition["id"]
+            self.task_name = definition["name"]
+            events = definition["on"]
+        except KeyError as e:
+            raise RuleError(f"Rule {definition} is missing {e}.")
+        self.events = (events,) if isinstance(events, str) else tuple(events)
+        self.device = definition.get("device")
+        self.then = definition.get("then", "completed")
+        self.otherwise = definition.get("otherwise")
+        self.record = definition.get("record")
+        self.when = definition.get("when", {})
+        self.checks = []
+        for field, spec in self.when.items():
+            self.checks.extend(_compile_condition(field, spec))
+
+    def satisfied(self, event):
+        return all(check(event.get(field), expected) for field, check, expected in self.checks)
+
+    def evaluate(self, event):
+        """
+        :return: 规则给出的新状态；不需要改变时返回 None
+        """
+        if self.satisfied(event):
+            return self.then
+        return self.otherwise
+
+    def record_value(self, event):
+        if isinstance(self.record, str) and self.record.startswith("$"):
+            return event.get(self.record[1:])
+        return self.record
+
+
+class RuleEngine:
+    """
+    按 (事件类型, 设备) 索引规则；设备为 None 的规则接收该类型的所有事件。
+    """
+
+    def __init__(self, definitions):
+        self.tasks = []  # 任务定义 [{"id", "name"}]，保持文件中的顺序
+        self.rules = []
+        self._index = {}
+        seen = set()
+        for definition in definitions:
+            rule = Rule(definition)
+            self.rules.append(rule)
+            if rule.task_name not in seen:
+                seen.add(rule.task_name)
+                self.tasks.append({"id": rule.task_id, "name": rule.task_name})
+            for event_type in rule.events:
+                self._index.setdefault((event_type, rule.device), []).append(rule)
+
+    def rules_for(self, event_type, device=None):
+        """
+        返回需要处理该事件的规则（先通用规则，后设备专属规则）。
+        """
+        rules = self._index.get((event_type, None), [])
+        if device is None:
+            return rules
+        specific = self._index.get((event_type, device))
+        if not specific:
+            return rules
+        return rules + specific
+
+
+def load_rules(path):
+    """
+    从 JSON 文件加载任务规则。
+    :raises RuleError: 文件格式错误
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        try:
+            data = json.load(f)
+        except ValueError as e:
+            raise RuleError(f"Invalid rule file '{path}': {e}")
+    definitions = data.get("tasks") if isinstance(data, dict) else None
+    if not isinstance(definitions, list):
+        raise RuleError(f"Rule file '{path}' must contain a 'tasks' list.")
+    return RuleEngine(definitions)
@@ -0,0 +1,122 @@
+#scenes.py
+# 批量命令、设备分组和场景：一次请求向多个设备并行发送命令，在截止时间内收集每个设备的结果
+import asyncio
+import json
+import logging
+import os
+from config import BATCH_TIMEOUT_MS, SCENES_FILE, SCENES_DATA_FILE
+from device_websocket import dispatch_command
+
+logger = logging.getLogger(__name__)
+
+groups = {}  # 分组名称 -> 设备名称列表
+scenes = {}  # 场景名称 -> 命令列表 [{"device" 或 "group": ..., "command": ...}]
+
+
+def load_scenes(path=SCENES_DATA_FILE, defaults=SCENES_FILE):
+    """
+    从 JSON 文件加载分组和场景定义：优先加载保存过的定义，没有时加载默认定义；都不存在时保持为空。
+    """
+    if not os.path.exists(path):
+        path = defaults
+    if not os.path.exists(path):
+        logger.info("Scene file '%s' not found. No groups or scenes loaded.", path)
+        return
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.error("Failed to load scene file '%s': %s", path, e)
+        return
+    groups.clear()
+    groups.update(data.get("groups", {}))
+    scenes.clear()
+    scenes.update(data.get("scenes", {}))
+    logger.info("Loaded %d group(s) and %d scene(s) from '%s'.", len(groups), len(scenes), path)
+
+
+def save_scenes(path=SCENES_DATA_FILE):
+    """
+    将当前的分组和场景写入数据文件（先写临时文件再替换），不修改随代码提供的默认定义。
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"groups": groups, "scenes": scenes}, f, ensure_ascii=False, indent=4)
+    os.replace(tmp_path, path)
+
+
+def expand_commands(entries):
+    """
+    将命令列表展开为 {设备名称: 命令}。分组会展开为其中的每个设备；
+    同一设备出现多次时以最后一条为准。
+    :raises ValueError: 条目格式错误或分组不存在
+    """
+    targets = {}
+    for entry in entries:
+        if not isinstance(entry, dict) or not entry.get("command"):
+            raise ValueError(f"Invalid command entry: {entry}")
+        if entry.get("group"):
+            if entry["group"] not in groups:
+                raise ValueError(f"Group '{entry['group']}' not found.")
+            devices = groups[entry["group"]]
+        elif entry.get("device"):
+            devices = [entry["device"]]
+        else:
+            raise ValueError(f"Missing 'device' or 'group' in entry: {entry}")
+        for device_name in devices:
+            targets[device_name] = entry["command"]
+    return targets
+
+
+def _command_result(command, cmd, wait_ack):
+    if cmd is None:
+        return {"command": command, "status": "not_connected"}
+    result = {"command": command, "id": cmd.id}
+    if not cmd.sent.done():
+        result["status"] = "timeout"
+    elif not cmd.sent.result().startswith("Success"):
+        result["status"] = "superseded" if cmd.sent.result().startswith("Superseded") else "error"
+        result["message"] = cmd.sent.result()
+    elif not wait_ack:
+        result["status"] = "sent"
+    elif not cmd.acked.done():
+        result["status"] = "timeout"
+    elif cmd.acked.result() == "acked":
+        result["status"] = "acked"
+        result["rtt_ms"] = round(cmd.rtt * 1000, 2)
+    else:
+        result["status"] = cmd.acked.result()
+    return result
+
+
+async def dispatch_batch(targets, timeout_ms=None, wait_ack=True):
+    """
+    并行向多个设备发送命令，最多等待 timeout_ms，返回每个设备的结果。
+    :param targets: {设备名称: 命令}
+    :param wait_ack: 是否等待设备的 STATUS 确认
+    :return: {设备名称: {"command", "status": sent/acked/timeout/not_connected/error, ...}}
+    """
+    if timeout_ms is None:
+        timeout_ms = BATCH_TIMEOUT_MS
+    dispatched = {name: dispatch_command(name, command) for name, command in targets.items()}
+    waiting = [
+        cmd.acked if wait_ack else cmd.sent
+        for cmd in dispatched.values() if cmd is not None
+    ]
+    if waiting:
+        await asyncio.wait(waiting, timeout=timeout_ms / 1000)
+    return {
+        name: _command_result(targets[name], cmd, wait_ack)
+        for name, cmd in dispatched.items()
+    }
+
+
+def summarize(results):
+    """
+    按状态统计结果数量。
+    """
+    summary = {}
+    for result in results.values():
+        summary[result["status"]] = summary.get(result["status"], 0) + 1
+    return summary
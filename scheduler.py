@@ -0,0 +1,81 @@
+#scheduler.py
+# 按时间窗口合并状态更新：窗口内对同一主题的多次变更只在窗口结束时推送一次
+import asyncio
+import logging
+from config import FLUSH_WINDOW_MS
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateScheduler:
+    """
+    收集各主题（例如 "devices"、"tasks"）在一个时间窗口内的变更，
+    窗口结束时每个主题只调用一次对应的推送函数。
+    """
+
+    def __init__(self, window_ms):
+        self.window = max(window_ms, 0) / 1000
+        self._handlers = {}  # 主题 -> 推送函数
+        self._pending = {}  # 主题 -> 变更的键集合（None 表示全部）
+        self._timer = None
+        self.marks = 0
+        self.flushes = 0
+
+    def register(self, topic, flush):
+        """
+        注册主题的推送函数。推送函数接收变更的键集合（None 表示全部），必须是同步函数。
+        """
+        self._handlers[topic] = flush
+
+    def mark(self, topic, keys=None):
+        """
+        记录一次变更，并在没有等待中的窗口时开启一个新窗口。
+        :param topic: 主题名称
+        :param keys: 变更的键（例如设备名称）；None 表示整个主题都需要推送
+        """
+        self.marks += 1
+        if keys is None:
+            self._pending[topic] = None
+        elif topic not in self._pending:
+            self._pending[topic] = set(keys)
+        elif self._pending[topic] is not None:
+            self._pending[topic].update(keys)
+
+        if self._timer is None:
+            loop = asyncio.get_running_loop()
+            if self.window > 0:
+                self._timer = loop.call_later(self.window, self.flush)
+            else:
+                self._timer = loop.call_soon(self.flush)
+
+    def flush(self):
+        """
+        立即推送所有等待中的变更。
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        pending, self._pending = self._pending, {}
+        for topic, keys in pending.items():
+            handler = self._handlers.get(topic)
+            if handler is None:
+                logger.error("No flush handler registered for topic '%s'.", topic)
+                continue
+            try:
+                handler(keys)
+            except Exception as e:
+                logger.exception("Flush failed for topic '%s': %s", topic, e)
+        if pending:
+            self.flushes += 1
+
+    def stats(self):
+        return {
+            "window_ms": self.window * 1000,
+            "pending_topics": sorted(self._pending),
+            "marks": self.marks,
+            "flushes": self.flushes,
+        }
+
+
+# 全局调度器实例
+update_scheduler = UpdateScheduler(FLUSH_WINDOW_MS)
@@ -1,8 +1,7 @@
 #shared_data.py
-# 用于存储 WebSocket 连接和设备状态的共享数据
+# 用于存储设备连接和设备状态的共享数据
 
-# 连接的设备字典：键是设备名称，值是 WebSocket 对象
-connected_clients = {}
+from device_registry import DeviceRegistry
 
-# 存储设备状态的字典：键是设备名称，值是设备状态
-device_states = {}
+# 设备注册表：保存每个设备的 WebSocket 连接、Actor 和状态
+registry = DeviceRegistry()
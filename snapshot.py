@@ -0,0 +1,135 @@
+#snapshot.py
+# 状态快照与热重启：设备注册表（版本号和每个设备的状态）、各会话的任务进度和计时写入一个紧凑的 JSON 文件。
+# 启动时在开始监听之前恢复，版本号延续重启前的值：带 ?since= 重连的手机端和头显只会收到空的增量，
+# 重新连接的设备保留恢复的状态（由之后的 STATUS 校正），客户端看不到状态闪烁。
+#
+# 写入：先写临时文件并 fsync，再原子替换，崩溃时不会留下半个快照。
+import asyncio
+import logging
+import os
+import time
+from codec import dumps, loads
+from config import SNAPSHOT_FILE, SNAPSHOT_INTERVAL_MS, SNAPSHOT_GRACE_MS
+from notifier import sync_published_version
+from shared_data import registry
+from tasktracker import sessions, session_snapshot, restore_sessions
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FORMAT = 1
+
+
+def build_snapshot():
+    return {
+        "format": SNAPSHOT_FORMAT,
+        "saved_at": time.time(),
+        "registry": {
+            "version": registry.version,
+            "devices": [dict(record.as_dict(), version=record.version) for record in registry],
+        },
+        **session_snapshot(),
+    }
+
+
+def write_snapshot(path, data):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def save_snapshot(path=SNAPSHOT_FILE):
+    """
+    同步写入快照（关闭时调用）。
+    """
+    try:
+        write_snapshot(path, dumps(build_snapshot()))
+        logger.info("State snapshot saved to '%s' (%d device(s), %d session(s)).", path, len(registry), len(sessions))
+    except OSError as e:
+        logger.error("Failed to save state snapshot '%s': %s", path, e)
+
+
+def restore_snapshot(path=SNAPSHOT_FILE):
+    """
+    启动时恢复快照。
+    :return: 是否恢复了快照
+    """
+    if not os.path.exists(path):
+        return False
+    started = time.perf_counter()
+    try:
+        with open(path, "rb") as f:
+            data = loads(f.read())
+        if data.get("format") != SNAPSHOT_FORMAT:
+            raise ValueError(f"unsupported format {data.get('format')!r}")
+        registry.restore(data["registry"]["version"], data["registry"]["devices"])
+        sync_published_version()
+        restore_sessions(data)
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        logger.error("Ignoring unreadable state snapshot '%s': %s", path, e)
+        return False
+    logger.info(
+        "Restored %d device(s) and %d session(s) from '%s' (version %d, saved %.0f s ago) in %.1f ms.",
+        len(registry), len(sessions), path, registry.version,
+        time.time() - data.get("saved_at", time.time()), (time.perf_counter() - started) * 1000,
+    )
+    return True
+
+
+class SnapshotWriter:
+    """
+    定期写入快照：只有注册表或任务状态发生变化时才写，序列化在事件循环中完成，写文件在线程池中完成。
+    """
+
+    def __init__(self, path=SNAPSHOT_FILE, interval_ms=SNAPSHOT_INTERVAL_MS, grace_ms=SNAPSHOT_GRACE_MS):
+        self.path = path
+        self.interval = interval_ms / 1000
+        self.grace = grace_ms / 1000
+        self.saves = 0
+        self._saved_state = None
+        self._tasks = []
+
+    def _state(self):
+        return registry.version, len(sessions), sum(session.version for session in sessions.values())
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        self._saved_state = self._state()
+        self._tasks = [loop.create_task(self._run()), loop.create_task(self._expire_restored())]
+
+    def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.interval)
+            state = self._state()
+            if state == self._saved_state:
+                continue
+            data = dumps(build_snapshot())
+            try:
+                await loop.run_in_executor(None, write_snapshot, self.path, data)
+            except OSError as e:
+                logger.error("Failed to save state snapshot '%s': %s", self.path, e)
+                continue
+            self._saved_state = state
+            self.saves += 1
+
+    async def _expire_restored(self):
+        """
+        宽限期结束后仍未重新连接的恢复设备按正常断开处理（推送移除消息）。
+        """
+        await asyncio.sleep(self.grace)
+        names = registry.restored_names()
+        for name in names:
+            registry.remove(name)
+        if names:
+            logger.info("Removed %d restored device(s) that did not reconnect: %s", len(names), ", ".join(names))
+
+
+snapshot_writer = SnapshotWriter()
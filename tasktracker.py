@@ -1,131 +1,312 @@
-import json
-import os
 import asyncio
+import contextlib
 import datetime
-from shared_data import device_states  # 获取设备当前状态
-CORRECT_DEVICE = "Rectangle"
-CORRECT_BRIGHTNESS = 80
-CORRECT_COLOR = "Blue"
+import logging
+import re
+import time
+from collections import deque
+from config import TASKS_FILE, ACTION_MEMORY_LIMIT, MAX_SESSIONS
+from rules import load_rules
+from action_log import action_log
+from logging_setup import payloads_enabled
+from metrics import lock_wait
 
+logger = logging.getLogger(__name__)
 
-lock = asyncio.Lock()  # 线程安全锁
-experiment_start_time = None  # 记录实验开始时间
+DEFAULT_SESSION = "default"  # 未指定会话的连接和请求使用的会话
+TASK_HISTORY_SIZE = 256  # 每个会话保留的任务变更记录条数，超出后重连的头显需要完整快照
+SESSION_ID_PATTERN = re.compile(r"[A-Za-z0-9_.-]{1,64}")  # 合法的会话 ID
 
-# 任务列表
-task_list = [
-    {"id": 1, "name": "open_app", "status": "pending"},
-    {"id": 2, "name": "add_device", "status": "pending"},
-    {"id": 3, "name": "select_device", "status": "pending"},
-    {"id": 4, "name": "enter_device", "status": "pending"},
-    {"id": 5, "name": "control_device", "status": "pending"},
-    {"id": 6, "name": "adjust_brightness", "status": "pending"},
-    {"id": 7, "name": "change_color", "status": "pending"},
-]
+# 任务规则（从 TASKS_FILE 加载，新的实验流程只需要修改规则文件）
+rule_engine = load_rules(TASKS_FILE)
 
-# 用户操作记录
-user_actions = []
 
-# ✅ 记录实验开始时间
-def start_experiment():
-    global experiment_start_time
-    experiment_start_time = datetime.datetime.now()
-    print(f"实验开始: {experiment_start_time.isoformat()}")
+class ExperimentSession:
+    """
+    一位参与者（或一个实验工位）的实验会话：独立的任务进度、计时和操作记录。
+    """
 
-# ✅ 记录用户操作（带有时间戳）
-async def record_user_action(task_name: str, actual_value):
-    async with lock:
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.lock = asyncio.Lock()  # 会话内的事件按顺序处理
+        self.start_time = None  # 记录实验开始时间
+        self.task_list = [
+            {"id": task["id"], "name": task["name"], "status": "pending", "version": 0}
+            for task in rule_engine.tasks
+        ]
+        self.tasks_by_name = {task["name"]: task for task in self.task_list}
+        # 任务版本：每次状态变化分配单调递增的版本号，头显只接收变化的任务
+        self.version = 0
+        self.published_version = 0  # 最近一次推送给头显的版本号
+        self._dirty = {}  # 待推送的任务：任务名称 -> 任务
+        self._history = deque(maxlen=TASK_HISTORY_SIZE)  # (版本号, 任务名称)
+        # 最近的用户操作记录（内存中只保留有限条数，完整记录写入操作日志）
+        self.user_actions = deque(maxlen=ACTION_MEMORY_LIMIT)
+        self.action_count = 0
+
+    def start(self):
+        self.start_time = datetime.datetime.now()
+        action_log.append({
+            "kind": "session_start",
+            "ts": time.time(),
+            "session": self.session_id,
+            "time": self.start_time.isoformat(),
+        })
+        logger.info("实验开始 [%s]: %s", self.session_id, self.start_time.isoformat())
+
+    @contextlib.asynccontextmanager
+    async def critical_section(self):
+        """
+        持有会话锁执行，并记录等待锁的时间。
+        """
+        started = time.perf_counter()
+        async with self.lock:
+            lock_wait.observe(time.perf_counter() - started)
+            yield
+
+    def record_action(self, task_name: str, actual_value):
         action_record = {
             "task": task_name,
             "time": datetime.datetime.now().isoformat(),
             "value": actual_value
         }
-        user_actions.append(action_record)
-        print(f"记录操作: {action_record}")
+        self.user_actions.append(action_record)
+        self.action_count += 1
+        action_log.append(dict(action_record, kind="action", ts=time.time(), session=self.session_id))
+        if payloads_enabled():
+            logger.debug("记录操作 [%s]: %s", self.session_id, action_record)
 
-async def check_task_1():
-    await record_user_action("open_app", "WebSocket Connected")
-    await update_task_status("open_app", "completed")
+    def set_status(self, task_name: str, new_status: str):
+        """
+        修改任务状态，返回是否确实发生了变化。
+        """
+        task = self.tasks_by_name.get(task_name)
+        if task is None or task["status"] == new_status:
+            return False
+        task["status"] = new_status
+        self.version += 1
+        task["version"] = self.version
+        self._dirty[task_name] = task
+        self._history.append((self.version, task_name))
+        action_log.append({
+            "kind": "task",
+            "ts": time.time(),
+            "session": self.session_id,
+            "task": task_name,
+            "status": new_status,
+        })
+        logger.info("任务状态更新 [%s]: %s -> %s", self.session_id, task_name, new_status)
+        return True
 
-async def check_task_2():
-    await record_user_action("add_device", "User clicked add device")
-    await update_task_status("add_device", "completed")
+    def take_dirty(self):
+        """
+        取出自上次调用以来状态发生变化的任务（副本），并更新已推送的版本号。
+        :return: (上次推送的版本号, 变化的任务列表)
+        """
+        since = self.published_version
+        updates = [dict(task) for task in self._dirty.values()]
+        self._dirty = {}
+        self.published_version = self.version
+        return since, updates
 
-async def check_task_3(selected_device: str):
-    await record_user_action("select_device", selected_device)
+    def changes_since(self, version):
+        """
+        返回指定版本之后发生变化的任务（每个任务只保留当前状态）。
+        :param version: 头显已知的最新版本号
+        :return: 任务列表；历史不足以覆盖时返回 None，头显应改用完整快照
+        """
+        if version == self.version:
+            return []
+        if version < 0 or version > self.version or not self._history or self._history[0][0] > version + 1:
+            return None
+        names = {name for entry_version, name in self._history if entry_version > version}
+        return [dict(task) for task in self.task_list if task["name"] in names]
 
-    if selected_device == CORRECT_DEVICE:
-        await update_task_status("select_device", "completed")
-        print(f"任务 3 完成: 正确选择了设备 {selected_device}")
-    else:
-        print(f"任务 3 失败: 选择了错误设备 {selected_device}")
+    def snapshot(self):
+        """
+        返回用于热重启的会话状态（任务状态、版本号和计时）。
+        """
+        return {
+            "start_time": self.start_time.isoformat() if self.start_time else None,
+            "version": self.version,
+            "actions": self.action_count,
+            "tasks": {task["name"]: [task["status"], task["version"]] for task in self.task_list},
+        }
 
-async def check_task_4(selected_device: str):
-    await record_user_action("enter_device", selected_device)
+    def restore(self, state):
+        """
+        从快照恢复会话状态。规则文件中已不存在的任务会被忽略。
+        """
+        start_time = state.get("start_time")
+        self.start_time = datetime.datetime.fromisoformat(start_time) if start_time else None
+        self.version = self.published_version = state.get("version", 0)
+        self.action_count = state.get("actions", 0)
+        for name, (status, version) in state.get("tasks", {}).items():
+            task = self.tasks_by_name.get(name)
+            if task is not None:
+                task["status"] = status
+                task["version"] = version
+
+    def summary(self):
+        return {
+            "session": self.session_id,
+            "start_time": self.start_time.isoformat() if self.start_time else None,
+            "completed": sum(1 for task in self.task_list if task["status"] == "completed"),
+            "tasks": len(self.task_list),
+            "version": self.version,
+            "actions": self.action_count,
+        }
 
-    if selected_device == CORRECT_DEVICE:
-        await update_task_status("enter_device", "completed")
-        print(f"任务 4 完成: 正确进入设备 {selected_device}")
-    else:
-        print(f"任务 4 失败: 进入了错误设备 {selected_device}")
 
-# ✅ 简化检测逻辑
-async def check_tasks_5_to_7(device_name: str, actual_brightness: int, actual_color: str):
+sessions = {}  # 会话 ID -> ExperimentSession
+device_sessions = {}  # 设备名称 -> 最近操作该设备的会话 ID（用于路由设备上报的事件）
+
+
+class SessionError(ValueError):
+    """
+    会话 ID 不合法，或会话数量已达上限。
+    """
+
+
+def open_session(session_id=None):
+    """
+    返回会话，不存在时创建。只用于明确开始会话的地方（POST /sessions、启动和快照恢复），
+    客户端在其他请求中携带的会话 ID 不会创建会话。
+    :raises SessionError: 会话 ID 不合法或会话数量已达 MAX_SESSIONS
     """
-    统一检测任务 5、6、7 的逻辑。
+    session_id = session_id or DEFAULT_SESSION
+    session = sessions.get(session_id)
+    if session is None:
+        if not SESSION_ID_PATTERN.fullmatch(session_id):
+            raise SessionError(f"Invalid session id '{session_id[:64]}'.")
+        if len(sessions) >= MAX_SESSIONS:
+            raise SessionError(f"Too many sessions (limit {MAX_SESSIONS}).")
+        session = ExperimentSession(session_id)
+        sessions[session_id] = session
+    return session
+
+def get_session(session_id=None):
     """
-    if device_name != CORRECT_DEVICE:
-        print(f"错误的设备: {device_name}")
+    返回已存在的会话。session_id 为空时使用默认会话（总是存在）；未知的会话返回 None。
+    """
+    if not session_id or session_id == DEFAULT_SESSION:
+        return open_session()
+    return sessions.get(session_id)
+
+# ✅ 记录实验开始时间
+def start_experiment(session_id=None):
+    session = open_session(session_id)
+    session.start()
+    return session
+
+# ✅ 记录用户操作（带有时间戳）
+async def record_user_action(task_name: str, actual_value, session_id=None):
+    session = get_session(session_id)
+    if session is None:
+        logger.warning("忽略未知会话的操作记录 [%s]", session_id, extra={"rate_key": "unknown_session"})
+        return
+    async with session.critical_section():
+        session.record_action(task_name, actual_value)
+
+def bind_device(device_name, session_id):
+    """
+    将设备绑定到会话：之后该设备上报的状态事件只交给这个会话处理。未知的会话不绑定。
+    """
+    if device_name and get_session(session_id) is not None:
+        device_sessions[device_name] = session_id or DEFAULT_SESSION
+
+def schedule_task_push(session_id):
+    from headset_server import push_task_list  # 动态导入以避免循环依赖
+    push_task_list(session_id)
+
+# 多进程模式的手机端工作进程中由状态总线设置：事件转发给拥有会话状态的主进程处理
+event_forwarder = None
+
+# ✅ 事件分发
+async def dispatch_event(event_type: str, device: str = None, session_id: str = None, **data):
+    """
+    将事件交给索引到的规则处理。同一事件的所有记录和状态变更在会话锁内一次完成，
+    有任务状态变化时才推送给该会话的头显。
+    :param event_type: app_opened / add_device / device_selected / device_entered /
+                       command_applied / status_reported
+    :param device: 事件相关的设备名称
+    :param session_id: 会话 ID；为空时设备事件路由到绑定该设备的会话，否则使用默认会话
+    :param data: 事件字段，例如 brightness、color
+    """
+    if event_forwarder is not None:
+        event_forwarder(event_type, device, session_id, data)
+        return
+    if session_id is None and device is not None:
+        session_id = device_sessions.get(device)
+    rules = rule_engine.rules_for(event_type, device)
+    if not rules:
+        return
+
+    session = get_session(session_id)
+    if session is None:
+        logger.warning("忽略未知会话的事件 [%s]: %s", session_id, event_type, extra={"rate_key": "unknown_session"})
         return
+    event = dict(data, type=event_type, device=device)
+    changed = False
+    async with session.critical_section():
+        # 事件本身也写入操作日志，供离线分析（尝试次数、错误设备、亮度超调）使用
+        action_log.append({
+            "kind": "event",
+            "ts": time.time(),
+            "session": session.session_id,
+            "event": event_type,
+            "device": device,
+            "brightness": data.get("brightness"),
+            "color": data.get("color"),
+        })
+        for rule in rules:
+            if rule.record is not None:
+                session.record_action(rule.task_name, rule.record_value(event))
+            new_status = rule.evaluate(event)
+            if new_status is not None and session.set_status(rule.task_name, new_status):
+                changed = True
 
-    # 检测任务 5: 检查设备是否开启
-    if actual_color != "off":
-        await update_task_status("control_device", "completed")
-        print(f"任务 5 完成: {device_name} 开关开启")
-    else:
-        await update_task_status("control_device", "pending")
-        print(f"任务 5 重置为 pending: {device_name} 开关关闭")
-
-    # 检测任务 6: 检查亮度
-    if actual_brightness == CORRECT_BRIGHTNESS:
-        await update_task_status("adjust_brightness", "completed")
-        print(f"任务 6 完成: {device_name} 亮度正确 ({actual_brightness})")
-    else:
-        await update_task_status("adjust_brightness", "pending")
-        print(f"任务 6 重置为 pending: {device_name} 亮度错误 ({actual_brightness})")
-
-    # 检测任务 7: 检查颜色
-    if actual_color == CORRECT_COLOR:
-        await update_task_status("change_color", "completed")
-        print(f"任务 7 完成: {device_name} 颜色正确 ({actual_color})")
-    else:
-        await update_task_status("change_color", "pending")
-        print(f"任务 7 重置为 pending: {device_name} 颜色错误 ({actual_color})")
+    if changed:
+        schedule_task_push(session.session_id)
 
 # ✅ 更新任务状态
-async def update_task_status(task_name: str, new_status: str):
-    async with lock:
-        for task in task_list:
-            if task["name"] == task_name:
-                task["status"] = new_status
-                print(f"任务状态更新: {task_name} -> {new_status}")
+async def update_task_status(task_name: str, new_status: str, session_id=None):
+    """
+    更新任务状态，并推送更新到该会话的头显。
+    """
+    session = get_session(session_id)
+    if session is None:
+        logger.warning("忽略未知会话的任务更新 [%s]", session_id, extra={"rate_key": "unknown_session"})
+        return
+    async with session.critical_section():
+        changed = session.set_status(task_name, new_status)
 
+    if changed:
+        schedule_task_push(session.session_id)
 
-async def update_task_status(task_name: str, new_status: str):
+def session_snapshot():
     """
-    更新任务状态，并推送更新到 WebSocket 客户端。
+    返回所有会话和设备绑定的状态，用于热重启。
     """
-    async with lock:
-        for task in task_list:
-            if task["name"] == task_name:
-                task["status"] = new_status
-                print(f"任务状态更新: {task_name} -> {new_status}")
+    return {
+        "sessions": {session_id: session.snapshot() for session_id, session in sessions.items()},
+        "device_sessions": dict(device_sessions),
+    }
 
-                # 动态导入以避免循环依赖
-                from headset_server import push_task_list
-                await push_task_list()
-def get_task_list():
+def restore_sessions(state):
     """
-    获取当前的任务列表。
+    从快照恢复会话（启动时、开始监听之前调用）。
     """
-    return task_list
+    for session_id, session_state in state.get("sessions", {}).items():
+        try:
+            open_session(session_id).restore(session_state)
+        except SessionError as e:
+            logger.warning("未恢复会话 [%s]: %s", session_id, e)
+    device_sessions.update(state.get("device_sessions", {}))
 
+def get_task_list(session_id=None):
+    """
+    获取会话当前的任务列表（未知的会话返回 None）。
+    """
+    session = get_session(session_id)
+    return session.task_list if session is not None else None
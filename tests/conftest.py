@@ -0,0 +1,6 @@
+#tests/conftest.py
+# 服务器模块位于仓库根目录（不是包），测试直接按模块名导入
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,69 @@
+#tests/test_action_log.py
+import asyncio
+import os
+from action_log import INDEX_ENTRY, ActionLogWriter, SegmentReader, index_path, list_segments, read_log
+
+
+def write_records(directory, records, segment_bytes=1 << 20, batch_size=8, index_every=4, pause=0):
+    """
+    :param pause: 每写满一批后等待的秒数，让后台任务分批写入
+    """
+    async def run():
+        writer = ActionLogWriter(str(directory), segment_bytes, batch_size, 10, index_every)
+        for i, record in enumerate(records, 1):
+            writer.append(record)
+            if pause and i % batch_size == 0:
+                await asyncio.sleep(pause)
+        await writer.close()
+        return writer
+    return asyncio.run(run())
+
+
+def test_records_round_trip(tmp_path):
+    records = [{"n": i, "action": f"a{i}"} for i in range(20)]
+    writer = write_records(tmp_path, records)
+    assert writer.written == 20
+    assert writer.errors == 0
+    assert list(read_log(str(tmp_path))) == records
+
+
+def test_index_entries_every_n_records(tmp_path):
+    write_records(tmp_path, [{"n": i} for i in range(10)], index_every=4)
+    (segment,) = list_segments(str(tmp_path))
+    with open(index_path(segment), "rb") as f:
+        entries = list(INDEX_ENTRY.iter_unpack(f.read()))
+    assert [number for number, _ in entries] == [0, 4, 8]
+    with open(segment, "rb") as f:
+        lines = f.readlines()
+    assert entries[1][1] == sum(len(line) for line in lines[:4])
+
+
+def test_reader_seeks_from_index(tmp_path):
+    write_records(tmp_path, [{"n": i} for i in range(50)], index_every=8)
+    (segment,) = list_segments(str(tmp_path))
+    assert [r["n"] for r in SegmentReader(segment).records(start=21)] == list(range(21, 50))
+
+
+def test_reader_skips_partial_and_corrupt_lines(tmp_path):
+    write_records(tmp_path, [{"n": 0}, {"n": 1}])
+    (segment,) = list_segments(str(tmp_path))
+    with open(segment, "ab") as f:
+        f.write(b"not json\n{\"n\": 3")
+    assert [r["n"] for r in SegmentReader(segment)] == [0, 1]
+
+
+def test_reader_without_index(tmp_path):
+    write_records(tmp_path, [{"n": i} for i in range(5)])
+    (segment,) = list_segments(str(tmp_path))
+    os.remove(index_path(segment))
+    assert [r["n"] for r in SegmentReader(segment).records(start=3)] == [3, 4]
+
+
+def test_segments_roll_over_and_restart_opens_new_segment(tmp_path):
+    write_records(tmp_path, [{"n": i, "pad": "x" * 50} for i in range(20)], segment_bytes=200, batch_size=2, pause=0.02)
+    first_run = list_segments(str(tmp_path))
+    assert len(first_run) > 1
+    write_records(tmp_path, [{"n": 20}])
+    segments = list_segments(str(tmp_path))
+    assert segments[:-1] == first_run
+    assert [r["n"] for r in read_log(str(tmp_path))] == list(range(21))
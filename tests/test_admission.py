@@ -0,0 +1,79 @@
+#tests/test_admission.py
+import asyncio
+import pytest
+from admission import AdmissionController, AdmissionRejected, RegistrationBatcher, TokenBucket
+
+
+def test_token_bucket_burst_then_rate():
+    async def run():
+        loop = asyncio.get_running_loop()
+        bucket = TokenBucket(rate=100, burst=3)
+        start = loop.time()
+        for _ in range(3):
+            await bucket.acquire(start + 1)
+        assert loop.time() - start < 0.005
+        await bucket.acquire(start + 1)
+        assert loop.time() - start >= 0.009
+    asyncio.run(run())
+
+
+def test_token_bucket_rejects_after_deadline():
+    async def run():
+        loop = asyncio.get_running_loop()
+        bucket = TokenBucket(rate=1, burst=1)
+        await bucket.acquire(loop.time() + 1)
+        with pytest.raises(AdmissionRejected, match="rate limit"):
+            await bucket.acquire(loop.time() + 0.05)
+    asyncio.run(run())
+
+
+def test_token_bucket_serves_waiters_in_order():
+    async def run():
+        loop = asyncio.get_running_loop()
+        bucket = TokenBucket(rate=200, burst=1)
+        order = []
+
+        async def take(i):
+            await bucket.acquire(loop.time() + 1)
+            order.append(i)
+        await asyncio.gather(*(take(i) for i in range(5)))
+        return order
+    assert asyncio.run(run()) == [0, 1, 2, 3, 4]
+
+
+def test_handshake_reports_concurrency_cap():
+    async def run():
+        controller = AdmissionController(max_handshakes=1, rate=1000, burst=10, timeout_ms=50)
+        async with controller.handshake():
+            with pytest.raises(AdmissionRejected, match="concurrent"):
+                async with controller.handshake():
+                    pass
+        return controller.stats()
+    stats = asyncio.run(run())
+    assert (stats["admitted"], stats["rejected"], stats["rate_limited"], stats["in_handshake"]) == (1, 1, 0, 0)
+
+
+def test_handshake_reports_rate_limit():
+    async def run():
+        controller = AdmissionController(max_handshakes=10, rate=1, burst=1, timeout_ms=50)
+        async with controller.handshake():
+            pass
+        with pytest.raises(AdmissionRejected, match="rate limit"):
+            async with controller.handshake():
+                pass
+        return controller.stats()
+    stats = asyncio.run(run())
+    assert (stats["rejected"], stats["rate_limited"]) == (1, 1)
+
+
+def test_registration_batcher_registers_in_one_batch():
+    async def run():
+        registered = []
+        batcher = RegistrationBatcher(lambda name: registered.append(name) or name.upper(),
+                                      AdmissionController(10, 0, 1, 1000), batch_size=10, max_defer_ms=0)
+        results = await asyncio.gather(*(batcher.submit(f"d{i}") for i in range(5)))
+        return registered, results, batcher.batches
+    registered, results, batches = asyncio.run(run())
+    assert registered == [f"d{i}" for i in range(5)]
+    assert results == [f"D{i}" for i in range(5)]
+    assert batches == 1
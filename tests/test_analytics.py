@@ -0,0 +1,51 @@
+#tests/test_analytics.py
+import pytest
+
+np = pytest.importorskip("numpy")
+from analytics import ActionColumns, compute_metrics  # noqa: E402
+from rules import RuleEngine  # noqa: E402
+
+RULES = RuleEngine([
+    {"id": 1, "name": "open_app", "on": "app_opened"},
+    {"id": 6, "name": "adjust_brightness", "on": "command_applied", "device": "Rectangle",
+     "when": {"brightness": 80}, "otherwise": "pending"},
+])
+
+
+def event(session, ts, event_type, device=None, brightness=None):
+    return {"kind": "event", "ts": ts, "session": session, "event": event_type, "device": device, "brightness": brightness}
+
+
+def metrics_for(records):
+    return compute_metrics(ActionColumns.from_records(records), RULES)
+
+
+def test_overshoot_distinguishes_untried_sessions():
+    metrics = metrics_for([
+        {"kind": "session_start", "ts": 0.0, "session": "over"},
+        event("over", 1.0, "command_applied", "Rectangle", 95),
+        event("over", 2.0, "command_applied", "Rectangle", 80),
+        {"kind": "session_start", "ts": 0.0, "session": "under"},
+        event("under", 1.0, "command_applied", "Rectangle", 60),
+        event("under", 1.5, "command_applied", "Circle", 100),
+        {"kind": "session_start", "ts": 0.0, "session": "untried"},
+        event("untried", 1.0, "app_opened"),
+    ])
+    column = metrics.tasks.index("adjust_brightness")
+    overshoot = dict(zip(metrics.sessions, metrics.values["overshoot"][:, column]))
+    assert overshoot["over"] == 15
+    assert overshoot["under"] == 0
+    assert np.isnan(overshoot["untried"])
+
+    sessions = metrics.session_summary()
+    assert sessions["over"]["overshoot"] == 15
+    assert sessions["untried"]["overshoot"] is None
+    assert metrics.task_summary()["adjust_brightness"]["max_overshoot"] == 15
+
+
+def test_overshoot_is_none_when_no_session_tried():
+    metrics = metrics_for([
+        {"kind": "session_start", "ts": 0.0, "session": "a"},
+        event("a", 1.0, "app_opened"),
+    ])
+    assert metrics.task_summary()["adjust_brightness"]["max_overshoot"] is None
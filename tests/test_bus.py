@@ -0,0 +1,51 @@
+#tests/test_bus.py
+import asyncio
+import pytest
+from bus import FRAME_HEADER, encode, read_frame
+
+MESSAGES = [
+    {"t": "subscribe", "worker": 1},
+    {"t": "devices", "since": 3, "version": 4, "data": [{"device_name": "灯", "brightness": 10}]},
+    {"t": "resync"},
+]
+
+
+def feed(*chunks, eof=True):
+    reader = asyncio.StreamReader()
+    for chunk in chunks:
+        reader.feed_data(chunk)
+    if eof:
+        reader.feed_eof()
+    return reader
+
+
+def test_encode_prefixes_length():
+    frame = encode(MESSAGES[1])
+    (length,) = FRAME_HEADER.unpack_from(frame)
+    assert length == len(frame) - FRAME_HEADER.size
+
+
+def test_frames_round_trip_in_order():
+    async def run():
+        reader = feed(b"".join(encode(message) for message in MESSAGES))
+        return [await read_frame(reader) for _ in MESSAGES]
+    assert asyncio.run(run()) == MESSAGES
+
+
+def test_frame_split_across_reads():
+    async def run():
+        data = encode(MESSAGES[1])
+        reader = feed(eof=False)
+        task = asyncio.ensure_future(read_frame(reader))
+        for i in range(0, len(data), 3):
+            reader.feed_data(data[i:i + 3])
+            await asyncio.sleep(0)
+        return await task
+    assert asyncio.run(run()) == MESSAGES[1]
+
+
+def test_truncated_frame_raises_incomplete_read():
+    async def run():
+        await read_frame(feed(encode(MESSAGES[0])[:-1]))
+    with pytest.raises(asyncio.IncompleteReadError):
+        asyncio.run(run())
@@ -0,0 +1,45 @@
+#tests/test_codec.py
+import pytest
+from codec import JSON, COMPACT, MSGPACK, ENCODINGS, compact_message, encode_frame, hello_message, loads, negotiate_encoding
+
+DELTA = {
+    "type": "device_delta",
+    "since": 3,
+    "version": 5,
+    "data": [
+        {"device_name": "a", "status": "online", "brightness": 10, "color": "Red"},
+        {"device_name": "b", "status": "offline", "brightness": 0, "color": "off", "removed": True},
+    ],
+}
+
+
+def test_compact_message_uses_field_rows():
+    compacted = compact_message(DELTA)
+    assert compacted["version"] == 5
+    assert compacted["data"]["fields"] == ["device_name", "status", "brightness", "color", "removed"]
+    assert compacted["data"]["rows"] == [["a", "online", 10, "Red", None], ["b", "offline", 0, "off", True]]
+
+
+def test_compact_message_keeps_other_values():
+    message = {"type": "x", "empty": [], "names": ["a", "b"], "nested": {"k": 1}}
+    assert compact_message(message) == message
+
+
+def test_json_and_compact_frames_are_text():
+    assert loads(encode_frame(DELTA)) == DELTA
+    assert loads(encode_frame(DELTA, COMPACT)) == compact_message(DELTA)
+
+
+def test_negotiate_encoding():
+    assert negotiate_encoding(COMPACT) == COMPACT
+    assert negotiate_encoding("xml") == JSON
+    assert negotiate_encoding(None) == JSON
+    assert hello_message(COMPACT)["encodings"] == list(ENCODINGS)
+
+
+def test_msgpack_frame_round_trip():
+    msgpack = pytest.importorskip("msgpack")
+    frame = encode_frame(DELTA, MSGPACK)
+    assert isinstance(frame, bytes)
+    assert msgpack.unpackb(frame) == compact_message(DELTA)
+    assert len(frame) < len(encode_frame(DELTA, COMPACT).encode("utf-8"))
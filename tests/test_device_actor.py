@@ -0,0 +1,50 @@
+#tests/test_device_actor.py
+import asyncio
+from device_actor import DeviceActor
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, frame):
+        self.sent.append(frame)
+
+
+def run_actor(echo_ids, scenario):
+    async def run():
+        ws = FakeWebSocket()
+        actor = DeviceActor("lamp", ws, echo_ids=echo_ids)
+        try:
+            return await scenario(actor, ws)
+        finally:
+            actor.close()
+    return asyncio.run(run())
+
+
+def test_text_command_carries_id_when_device_echoes_ids():
+    async def scenario(actor, ws):
+        first = actor.submit("Red 80")
+        second = actor.submit("Red 80")
+        await first.sent
+        await second.sent
+        assert ws.sent == [f"Red 80;id={first.id}", f"Red 80;id={second.id}"]
+        # 两条命令的期望状态相同，只有命令 ID 能区分确认的是哪一条
+        await actor.on_status(80, "Red", first.id)
+        assert first.acked.result() == "acked"
+        assert not second.acked.done()
+        await actor.on_status(80, "Red", second.id)
+        assert second.acked.result() == "acked"
+    run_actor(True, scenario)
+
+
+def test_text_command_without_ids_is_acked_by_state():
+    async def scenario(actor, ws):
+        first = actor.submit("Red 80")
+        second = actor.submit("Blue 40")
+        await second.sent
+        assert ws.sent == ["Red 80", "Blue 40"]
+        await actor.on_status(40, "blue")
+        assert first.acked.result() == "superseded"
+        assert second.acked.result() == "acked"
+    run_actor(False, scenario)
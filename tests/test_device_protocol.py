@@ -0,0 +1,71 @@
+#tests/test_device_protocol.py
+import struct
+import pytest
+from device_protocol import (
+    VERSION, HEADER, COUNT, STATE, SLOT_STATE, STATUS, STATUS_BATCH, CHILDREN, COMMAND, CHILD_COMMAND, PING,
+    ProtocolError, decode_frame, encode_command, parse_registration, parse_status,
+)
+
+
+def test_parse_registration_with_parameters():
+    assert parse_registration("DEVICE_NAME:Lamp;proto=bin1;bridge=1") == ("Lamp", {"proto": "bin1", "bridge": "1"})
+    assert parse_registration("DEVICE_NAME: Lamp ") == ("Lamp", {})
+
+
+def test_parse_status():
+    assert parse_status("STATUS:brightness=80,color=Blue,id=7") == (80, "Blue", 7)
+    assert parse_status("STATUS:color=Red") == (None, "Red", None)
+
+
+def test_encode_command_direct_and_child():
+    frame = encode_command(7, 80, "blue")
+    assert HEADER.unpack_from(frame) == (VERSION, COMMAND)
+    assert STATE.unpack_from(frame, HEADER.size) == (7, 80, 3)
+    frame = encode_command(2**32 + 5, 10, "Red", slot=4)
+    assert HEADER.unpack_from(frame) == (VERSION, CHILD_COMMAND)
+    assert SLOT_STATE.unpack_from(frame, HEADER.size) == (4, 5, 10, 1)
+
+
+def test_encode_command_falls_back_to_text():
+    assert encode_command(1, 80, "Magenta") is None
+    assert encode_command(1, 70000, "Red") is None
+
+
+def test_decode_status():
+    frame = HEADER.pack(VERSION, STATUS) + STATE.pack(0, 55, 2)
+    assert decode_frame(frame) == (STATUS, (None, 55, "Green"))
+
+
+def test_decode_status_batch():
+    entries = [(0, 1, 10, 1), (3, 0, 20, 4)]
+    frame = HEADER.pack(VERSION, STATUS_BATCH) + COUNT.pack(len(entries)) + b"".join(SLOT_STATE.pack(*e) for e in entries)
+    assert decode_frame(frame) == (STATUS_BATCH, [(0, 1, 10, "Red"), (3, None, 20, "White")])
+
+
+def test_decode_children():
+    names = ["Lamp", "灯"]
+    body = b"".join(bytes([len(n.encode())]) + n.encode() for n in names)
+    assert decode_frame(HEADER.pack(VERSION, CHILDREN) + COUNT.pack(2) + body) == (CHILDREN, names)
+
+
+def test_decode_ping():
+    assert decode_frame(HEADER.pack(VERSION, PING)) == (PING, None)
+
+
+@pytest.mark.parametrize("frame", [
+    b"\x01",
+    HEADER.pack(VERSION + 1, PING),
+    HEADER.pack(VERSION, 0x7F),
+    HEADER.pack(VERSION, STATUS) + STATE.pack(1, 1, 200),
+    HEADER.pack(VERSION, STATUS_BATCH) + COUNT.pack(2) + SLOT_STATE.pack(0, 1, 1, 1),
+    HEADER.pack(VERSION, CHILDREN) + COUNT.pack(2) + b"\x01a",
+    HEADER.pack(VERSION, CHILDREN) + COUNT.pack(1) + b"\x05ab",
+])
+def test_decode_invalid_frames(frame):
+    with pytest.raises((ProtocolError, struct.error)):
+        decode_frame(frame)
+
+
+def test_decode_invalid_utf8_name_is_protocol_error():
+    with pytest.raises(ProtocolError):
+        decode_frame(HEADER.pack(VERSION, CHILDREN) + COUNT.pack(1) + b"\x02\xff\xfe")
@@ -0,0 +1,117 @@
+#tests/test_device_registry.py
+from device_registry import DeviceRegistry
+
+
+def make_registry(*names, history_size=16):
+    registry = DeviceRegistry(history_size)
+    for name in names:
+        registry.add(name)
+    return registry
+
+
+def test_changes_since_current_version_is_empty():
+    registry = make_registry("a", "b")
+    assert registry.changes_since(registry.version) == []
+
+
+def test_changes_since_returns_latest_state_once_per_device():
+    registry = make_registry("a", "b")
+    since = registry.version
+    registry.update("a", brightness=10)
+    registry.update("a", brightness=20)
+    registry.remove("b")
+    updates = registry.changes_since(since)
+    assert [u["device_name"] for u in updates] == ["a", "b"]
+    assert updates[0]["brightness"] == 20
+    assert updates[1]["removed"] is True
+
+
+def test_changes_since_future_or_negative_version_needs_snapshot():
+    registry = make_registry("a")
+    assert registry.changes_since(registry.version + 1) is None
+    assert registry.changes_since(-1) is None
+
+
+def test_changes_since_beyond_history_needs_snapshot():
+    registry = make_registry("a", history_size=4)
+    for brightness in range(1, 10):
+        registry.update("a", brightness=brightness)
+    assert registry.changes_since(1) is None
+    assert registry.changes_since(registry.version - 2) == [registry.get("a").as_dict()]
+
+
+def test_update_without_change_keeps_version():
+    registry = make_registry("a")
+    version = registry.version
+    assert registry.update("a", color="OFF") is False
+    assert registry.version == version
+
+
+def test_take_dirty_includes_removed_devices():
+    registry = make_registry("a", "b")
+    registry.take_dirty()
+    registry.update("a", status="online")
+    registry.remove("b")
+    updates = registry.take_dirty()
+    assert {u["device_name"] for u in updates} == {"a", "b"}
+    assert registry.take_dirty() == []
+
+
+def test_remove_ignores_other_connection():
+    registry = DeviceRegistry()
+    old, new = object(), object()
+    registry.add("a", websocket=old)
+    registry.add("a", websocket=new)
+    assert registry.remove("a", old) is None
+    assert registry.remove("a", new) is not None
+    assert "a" not in registry
+
+
+def test_changes_since_after_restore_starts_at_restored_version():
+    registry = DeviceRegistry()
+    registry.restore(42, [{"device_name": "a", "status": "online", "brightness": 5, "color": "Red", "version": 40}])
+    assert registry.changes_since(42) == []
+    assert registry.changes_since(10) is None
+
+
+def test_apply_follows_primary_versions():
+    primary = make_registry("a")
+    replica = DeviceRegistry()
+    replica.replace(primary.version, [dict(r.as_dict(), version=r.version) for r in primary])
+    replica.take_dirty()
+
+    since = primary.version
+    primary.update("a", brightness=50)
+    primary.add("b")
+    assert replica.apply(since, primary.version, primary.take_dirty())
+    assert replica.version == primary.version
+    assert replica.snapshot() == primary.snapshot()
+    assert replica.changes_since(since) == primary.changes_since(since)
+
+
+def test_apply_rejects_gap():
+    replica = DeviceRegistry()
+    replica.replace(5, [])
+    assert not replica.apply(6, 7, [{"device_name": "a", "status": "online", "brightness": 1, "color": "Red"}])
+    assert replica.version == 5
+    assert "a" not in replica
+
+
+def test_apply_removal():
+    replica = DeviceRegistry()
+    replica.replace(1, [{"device_name": "a", "status": "online", "brightness": 1, "color": "Red", "version": 1}])
+    replica.take_dirty()
+    assert replica.apply(1, 2, [{"device_name": "a", "status": "offline", "brightness": 0, "color": "off", "removed": True}])
+    assert "a" not in replica
+    assert replica.take_dirty()[0]["removed"] is True
+
+
+def test_replace_drops_missing_devices_and_resets_history():
+    replica = DeviceRegistry()
+    replica.replace(3, [{"device_name": "a", "status": "online", "brightness": 1, "color": "Red", "version": 2},
+                        {"device_name": "b", "status": "online", "brightness": 1, "color": "Red", "version": 3}])
+    replica.replace(9, [{"device_name": "a", "status": "online", "brightness": 1, "color": "Red", "version": 2}])
+    assert replica.names() == ["a"]
+    assert replica.version == 9
+    assert replica.changes_since(9) == []
+    assert replica.changes_since(3) is None
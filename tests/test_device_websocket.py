@@ -0,0 +1,39 @@
+#tests/test_device_websocket.py
+import asyncio
+import device_websocket
+from device_protocol import CHILDREN, COUNT, HEADER, VERSION
+from device_websocket import bridges, process_binary_frame, register_device, unregister_device
+from shared_data import registry
+
+
+class FakeWebSocket:
+    async def send(self, frame):
+        pass
+
+
+def children_frame(*names):
+    body = b"".join(bytes([len(name)]) + name.encode() for name in names)
+    return HEADER.pack(VERSION, CHILDREN) + COUNT.pack(len(names)) + body
+
+
+def test_children_cannot_shadow_devices_or_bridges():
+    async def run():
+        lamp_ws, hub_ws, other_hub_ws = FakeWebSocket(), FakeWebSocket(), FakeWebSocket()
+        register_device("lamp", lamp_ws)
+        bridges["hub"] = hub_ws
+        bridges["other-hub"] = other_hub_ws
+        children = []
+        try:
+            await process_binary_frame("hub", hub_ws, children_frame("lamp", "hub", "other-hub", "kid"), children)
+            # 被拒绝的名称仍占用槽位，网桥的槽位编号保持一致
+            assert children == ["lamp", "hub", "other-hub", "kid"]
+            assert registry.get("lamp").websocket is lamp_ws
+            assert "hub" not in registry and "other-hub" not in registry
+            kid = device_websocket.device_actor("kid")
+            assert kid.websocket is hub_ws and kid.slot == 3
+        finally:
+            for name in children:
+                unregister_device(name, hub_ws)
+            unregister_device("lamp", lamp_ws)
+            bridges.clear()
+    asyncio.run(run())
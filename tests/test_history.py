@@ -0,0 +1,107 @@
+#tests/test_history.py
+import time
+import pytest
+from history import CodeTable, DeviceHistory, Ring, UNKNOWN, parse_levels, query_window
+
+
+class Record:
+    def __init__(self, name, brightness=0, color="off", status="online"):
+        self.name = name
+        self.brightness = brightness
+        self.color = color
+        self.status = status
+
+
+def test_code_table_is_case_insensitive_and_bounded():
+    table = CodeTable(("Red",))
+    assert table.encode("red") == table.encode("RED") == 0
+    assert table.decode(0) == "Red"
+    for i in range(300):
+        table.encode(f"c{i}")
+    assert table.encode("new") == UNKNOWN
+    assert table.decode(UNKNOWN) is None
+
+
+def test_raw_ring_overwrites_oldest():
+    ring = Ring(0, 3)
+    for ts in range(5):
+        ring.add(float(ts), ts, 0, 1)
+    assert ring.full
+    assert [ring.t[ring._pos(i)] for i in range(len(ring))] == [2.0, 3.0, 4.0]
+    assert ring.oldest() == 2.0
+    assert ring.bisect(3.0) == 2
+
+
+def test_bucketed_ring_merges_changes():
+    ring = Ring(10, 4)
+    for ts, value in ((100, 5), (103, 50), (107, 20), (112, 7)):
+        ring.add(float(ts), value, 0, 1)
+    assert len(ring) == 2
+    assert (ring.t[0], ring.value[0], ring.low[0], ring.high[0], ring.count[0]) == (100.0, 20, 5, 50, 3)
+    assert ring.t[1] == 110.0
+
+
+def test_ring_entry_size():
+    ring = Ring(0, 1)
+    ring.add(0.0, 1, 0, 1)
+    assert ring.nbytes() == 20
+
+
+def test_parse_levels():
+    assert parse_levels("300:2, 0:5,10:3") == [(0.0, 5), (10.0, 3), (300.0, 2)]
+    with pytest.raises(ValueError):
+        parse_levels("10:0")
+    with pytest.raises(ValueError):
+        parse_levels("abc")
+
+
+def test_query_window_relative_times():
+    since, until, step = query_window("-60", None, "5")
+    assert until is None and step == 5
+    assert since == pytest.approx(time.time() - 60, abs=5)
+    with pytest.raises(ValueError):
+        query_window(None, None, "-1")
+
+
+def test_query_uses_coarse_level_for_old_data():
+    history = DeviceHistory([(0, 4), (10, 100)])
+    for ts in range(0, 100, 2):
+        history.record("a", ts, "Red", "online", ts=1000.0 + ts)
+    raw = history.query("a", since=1095.0)
+    assert raw["resolution"] == 0
+    assert raw["t"] == [1094.0, 1096.0, 1098.0]
+    old = history.query("a", since=1000.0)
+    assert old["resolution"] == 10
+    assert old["t"][:2] == [1000.0, 1010.0]
+    assert old["count"][0] == 5
+
+
+def test_query_downsamples_by_step():
+    history = DeviceHistory([(0, 100)])
+    for ts in range(20):
+        history.record("a", ts, "Red", "online", ts=float(ts))
+    result = history.query("a", since=0.0, step=5)
+    assert result["step"] == 5
+    assert result["t"] == [0.0, 5.0, 10.0, 15.0]
+    assert result["brightness"] == [4, 9, 14, 19]
+    assert result["min"] == [0, 5, 10, 15]
+    assert result["color"] == ["Red"] * 4
+
+
+def test_query_unknown_device():
+    assert DeviceHistory([(0, 4)]).query("missing") is None
+
+
+def test_removed_devices_are_evicted_after_retention():
+    history = DeviceHistory([(0, 4)], retention=10)
+    history.on_change(Record("a", 5, "Red"), False)
+    history.on_change(Record("b", 5, "Red"), False)
+    history.on_change(Record("a"), True)
+    history.on_change(Record("b"), True)
+    history.on_change(Record("b", 7, "Blue"), False)  # 重新注册的设备不会被丢弃
+    removed_at = history._removed["a"]
+    assert history.evict(removed_at + 5) == 0
+    assert history.evict(removed_at + 11) == 1
+    assert "a" not in history
+    assert "b" in history
+    assert history.query("b")["status"][-1] == "online"
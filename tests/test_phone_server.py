@@ -0,0 +1,64 @@
+#tests/test_phone_server.py
+import asyncio
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+import phone_server
+from admission import admission
+
+
+def request(method, path, **kwargs):
+    async def run():
+        async with TestClient(TestServer(phone_server.start_http_server())) as client:
+            response = await client.request(method, path, **kwargs)
+            return response.status, await response.json()
+    return asyncio.run(run())
+
+
+@pytest.mark.parametrize("method, path", [
+    ("PUT", "/groups/g"),
+    ("PUT", "/scenes/s"),
+    ("POST", "/commands"),
+])
+@pytest.mark.parametrize("body", [[], "x", 3])
+def test_non_object_bodies_are_rejected(method, path, body):
+    status, data = request(method, path, json=body)
+    assert status == 400
+    assert data["message"] == "Body must be a JSON object."
+
+
+def test_scene_runs_under_command_admission(monkeypatch):
+    in_flight = []
+
+    async def fake_dispatch(targets, timeout_ms, wait_ack):
+        in_flight.append(admission.commands_in_flight)
+        return {name: {"status": "success"} for name in targets}
+
+    monkeypatch.setattr(phone_server, "dispatch_batch", fake_dispatch)
+    monkeypatch.setattr(phone_server, "summarize", lambda results: {"total": len(results)})
+    monkeypatch.setitem(phone_server.scenes, "reset", [{"device": "lamp", "command": "off 0"}])
+    status, data = request("POST", "/scenes/reset")
+    assert status == 200
+    assert in_flight == [1]
+    assert admission.commands_in_flight == 0
+
+
+@pytest.mark.parametrize("coalesce", ["false", 0, 1, [], {}])
+def test_command_rejects_non_boolean_coalesce(coalesce):
+    status, data = request("POST", "/command", json={"device": "lamp", "command": "Red 80", "coalesce": coalesce})
+    assert status == 400
+    assert "coalesce" in data["message"]
+
+
+@pytest.mark.parametrize("coalesce", [True, False, None])
+def test_command_accepts_boolean_coalesce(monkeypatch, coalesce):
+    calls = []
+
+    async def fake_send(device_name, command, wait_ack=False, coalesce=None, session_id=None):
+        calls.append(coalesce)
+        return "Success"
+
+    monkeypatch.setattr(phone_server, "send_command_to_device", fake_send)
+    monkeypatch.setattr(phone_server, "bind_device", lambda device, session: None)
+    status, _ = request("POST", "/command", json={"device": "lamp", "command": "Red 80", "coalesce": coalesce})
+    assert status == 200
+    assert calls == [coalesce]
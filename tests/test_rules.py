@@ -0,0 +1,63 @@
+#tests/test_rules.py
+import json
+import pytest
+from rules import RuleEngine, RuleError, load_rules
+
+DEFINITIONS = [
+    {"id": 1, "name": "open_app", "on": "app_opened", "record": "opened"},
+    {"id": 3, "name": "select_device", "on": "device_selected", "record": "$device", "when": {"device": "Rectangle"}},
+    {"id": 5, "name": "control_device", "on": ["command_applied", "status_reported"], "device": "Rectangle",
+     "when": {"color": {"ne": "off"}}, "otherwise": "pending"},
+    {"id": 6, "name": "adjust_brightness", "on": "command_applied", "device": "Rectangle",
+     "when": {"brightness": {"gte": 50, "lt": 90}}},
+]
+
+
+def test_tasks_keep_file_order():
+    engine = RuleEngine(DEFINITIONS)
+    assert [task["name"] for task in engine.tasks] == ["open_app", "select_device", "control_device", "adjust_brightness"]
+
+
+def test_rules_indexed_by_event_and_device():
+    engine = RuleEngine(DEFINITIONS)
+    assert [rule.task_name for rule in engine.rules_for("command_applied", "Rectangle")] == ["control_device", "adjust_brightness"]
+    assert engine.rules_for("command_applied", "Circle") == []
+    assert [rule.task_name for rule in engine.rules_for("device_selected", "Circle")] == ["select_device"]
+    assert engine.rules_for("unknown_event") == []
+
+
+def test_evaluate_then_and_otherwise():
+    engine = RuleEngine(DEFINITIONS)
+    control, brightness = engine.rules_for("command_applied", "Rectangle")
+    assert control.evaluate({"color": "Blue"}) == "completed"
+    assert control.evaluate({"color": "off"}) == "pending"
+    assert brightness.evaluate({"brightness": 80}) == "completed"
+    assert brightness.evaluate({"brightness": 95}) is None
+    assert brightness.evaluate({}) is None
+
+
+def test_record_value():
+    engine = RuleEngine(DEFINITIONS)
+    (select,) = engine.rules_for("device_selected")
+    assert select.record_value({"device": "Rectangle"}) == "Rectangle"
+    (opened,) = engine.rules_for("app_opened")
+    assert opened.record_value({}) == "opened"
+
+
+def test_invalid_rules():
+    with pytest.raises(RuleError):
+        RuleEngine([{"id": 1, "name": "x"}])
+    with pytest.raises(RuleError):
+        RuleEngine([{"id": 1, "name": "x", "on": "app_opened", "when": {"a": {"between": 1}}}])
+
+
+def test_load_rules(tmp_path):
+    path = tmp_path / "tasks.json"
+    path.write_text(json.dumps({"tasks": DEFINITIONS}), encoding="utf-8")
+    assert len(load_rules(str(path)).rules) == len(DEFINITIONS)
+    path.write_text("[]", encoding="utf-8")
+    with pytest.raises(RuleError):
+        load_rules(str(path))
+    path.write_text("{", encoding="utf-8")
+    with pytest.raises(RuleError):
+        load_rules(str(path))
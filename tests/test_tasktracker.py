@@ -0,0 +1,92 @@
+#tests/test_tasktracker.py
+import asyncio
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+import headset_server
+import phone_server
+import tasktracker
+
+
+@pytest.fixture(autouse=True)
+def isolated_sessions(monkeypatch):
+    saved_sessions, saved_devices = dict(tasktracker.sessions), dict(tasktracker.device_sessions)
+    tasktracker.sessions.clear()
+    tasktracker.device_sessions.clear()
+    monkeypatch.setattr(tasktracker.action_log, "append", lambda record: None)
+    monkeypatch.setattr(tasktracker, "schedule_task_push", lambda session_id: None)
+    yield
+    tasktracker.sessions.clear()
+    tasktracker.sessions.update(saved_sessions)
+    tasktracker.device_sessions.clear()
+    tasktracker.device_sessions.update(saved_devices)
+
+
+def request(make_app, method, path, **kwargs):
+    async def run():
+        async with TestClient(TestServer(make_app())) as client:
+            response = await client.request(method, path, **kwargs)
+            return response.status, await response.json()
+    return asyncio.run(run())
+
+
+def test_unknown_session_ids_do_not_create_sessions():
+    assert tasktracker.get_session("P01") is None
+    tasktracker.bind_device("lamp", "P01")
+    asyncio.run(tasktracker.dispatch_event("device_entered", "lamp", "P01"))
+    asyncio.run(tasktracker.record_user_action("task", 1, "P01"))
+    asyncio.run(tasktracker.update_task_status("task", "completed", "P01"))
+    assert "P01" not in tasktracker.sessions
+    assert "lamp" not in tasktracker.device_sessions
+
+
+def test_default_session_always_exists():
+    assert tasktracker.get_session().session_id == tasktracker.DEFAULT_SESSION
+    assert tasktracker.get_session(tasktracker.DEFAULT_SESSION) is tasktracker.sessions[tasktracker.DEFAULT_SESSION]
+
+
+@pytest.mark.parametrize("session_id", ["a b", "x" * 65, "../P01", "P01\n"])
+def test_invalid_session_ids_are_rejected(session_id):
+    with pytest.raises(tasktracker.SessionError):
+        tasktracker.start_experiment(session_id)
+    assert session_id not in tasktracker.sessions
+
+
+def test_session_count_is_capped(monkeypatch):
+    monkeypatch.setattr(tasktracker, "MAX_SESSIONS", 2)
+    tasktracker.start_experiment("P01")
+    tasktracker.start_experiment("P02")
+    tasktracker.start_experiment("P01")  # 重新开始已有的会话不受上限影响
+    with pytest.raises(tasktracker.SessionError):
+        tasktracker.start_experiment("P03")
+    assert sorted(tasktracker.sessions) == ["P01", "P02"]
+
+
+def test_restore_skips_sessions_over_the_cap(monkeypatch):
+    monkeypatch.setattr(tasktracker, "MAX_SESSIONS", 1)
+    tasktracker.restore_sessions({"sessions": {"P01": {"version": 3}, "P02": {"version": 4}}})
+    assert list(tasktracker.sessions) == ["P01"]
+    assert tasktracker.sessions["P01"].version == 3
+
+
+def test_sessions_are_created_by_post_and_read_by_id():
+    make_app = phone_server.start_http_server
+    assert request(make_app, "GET", "/sessions/P01/tasks")[0] == 404
+    status, data = request(make_app, "POST", "/sessions", json={"session": "P01"})
+    assert status == 200
+    assert data["session"]["session"] == "P01"
+    status, data = request(make_app, "GET", "/sessions/P01/tasks")
+    assert status == 200
+    assert data["session"]["session"] == "P01"
+
+
+def test_post_rejects_invalid_session_id():
+    status, data = request(phone_server.start_http_server, "POST", "/sessions", json={"session": "a b"})
+    assert status == 400
+    assert "a b" not in tasktracker.sessions
+
+
+def test_headset_cannot_subscribe_to_unknown_session():
+    status, data = request(headset_server.start_headset_server, "GET", "/ws?session=P01")
+    assert status == 404
+    assert "P01" not in tasktracker.sessions
+    assert "P01" not in headset_server.headset_clients
@@ -0,0 +1,111 @@
+#worker.py
+# 多进程模式的手机端工作进程：多个进程以 SO_REUSEPORT 共同监听手机端 HTTP 端口，由内核分配连接。
+# 设备列表（/devices 及其长轮询）和手机端 WebSocket 推送由本进程根据状态总线同步的注册表副本处理；
+# 其余请求（命令、场景、会话、管理接口等）原样转发给主进程，命令因此总是到达拥有设备连接的进程。
+import asyncio
+import logging
+import signal
+import aiohttp
+import aiohttp_cors
+from aiohttp import web
+from multidict import CIMultiDict
+from bus import BusClient
+from config import HTTP_PORT, PHONE_SOCKET
+from notifier import websocket_handler
+from phone_server import FORWARDED_FOR_HEADER, get_device_list
+
+logger = logging.getLogger(__name__)
+
+# 逐跳头部不转发
+HOP_HEADERS = {"connection", "keep-alive", "proxy-connection", "transfer-encoding", "te", "trailer", "upgrade", "content-length", "content-encoding"}
+
+
+def _forwardable(headers):
+    return CIMultiDict((key, value) for key, value in headers.items() if key.lower() not in HOP_HEADERS)
+
+
+class PhoneProxy:
+    """
+    通过主进程的 Unix 域套接字转发手机端请求（保持长连接）。
+    """
+
+    def __init__(self, path=PHONE_SOCKET):
+        self.path = path
+        self._session = None
+        self.forwarded = 0
+        self.errors = 0
+
+    async def start(self):
+        self._session = aiohttp.ClientSession(connector=aiohttp.UnixConnector(path=self.path))
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+    async def handle(self, request):
+        body = await request.read()
+        headers = _forwardable(request.headers)
+        headers[FORWARDED_FOR_HEADER] = request.remote or ""  # 覆盖客户端自带的同名头部
+        try:
+            async with self._session.request(
+                request.method, f"http://primary{request.rel_url}",
+                headers=headers, data=body, allow_redirects=False,
+            ) as response:
+                data = await response.read()
+                self.forwarded += 1
+                return web.Response(status=response.status, body=data, headers=_forwardable(response.headers))
+        except aiohttp.ClientError as e:
+            self.errors += 1
+            logger.error("Failed to forward %s %s to the primary process: %s", request.method, request.path, e, extra={"rate_key": "proxy_error"})
+            return web.json_response({"status": "error", "message": "Primary process unavailable."}, status=502)
+
+
+def build_worker_app(proxy):
+    app = web.Application()
+    devices = app.router.add_get("/devices", get_device_list)
+    ws = app.router.add_get("/ws", websocket_handler)
+
+    # 配置 CORS 支持（转发的请求由主进程添加 CORS 头部）
+    cors = aiohttp_cors.setup(app, defaults={
+        "*": aiohttp_cors.ResourceOptions(
+            allow_credentials=True,
+            expose_headers="*",
+            allow_headers="*",
+        )
+    })
+    cors.add(devices)
+    cors.add(ws)
+
+    app.router.add_route("*", "/{tail:.*}", proxy.handle)
+    return app
+
+
+async def run_worker(worker_id):
+    """
+    工作进程主函数：同步状态后开始监听；主进程关闭总线或收到 SIGTERM 时退出。
+    """
+    loop = asyncio.get_running_loop()
+    bus = BusClient(worker_id)
+    await bus.connect()
+    proxy = PhoneProxy()
+    await proxy.start()
+
+    runner = web.AppRunner(build_worker_app(proxy))
+    await runner.setup()
+    site = web.TCPSite(runner, "0.0.0.0", HTTP_PORT, reuse_port=True)
+    await site.start()
+    logger.info("Phone worker %d listening on port %d.", worker_id, HTTP_PORT)
+
+    stop = asyncio.Event()
+    loop.add_signal_handler(signal.SIGTERM, stop.set)
+    closed = loop.create_task(bus.wait_closed())
+    stopping = loop.create_task(stop.wait())
+    try:
+        await asyncio.wait((closed, stopping), return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        closed.cancel()
+        stopping.cancel()
+        await runner.cleanup()
+        await proxy.close()
+        bus.close()
+        logger.info("Phone worker %d stopped.", worker_id)